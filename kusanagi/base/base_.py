@@ -24,6 +24,12 @@ def apply_controller(env, policy, max_steps, preprocess=None, callback=None):
         p = policy.get_params()
         if len(p) == 0:
             policy.init_params()
+        # the policy parameters may have changed since the last run
+        if hasattr(policy, 'update_inference_cache'):
+            try:
+                policy.update_inference_cache()
+            except NotImplementedError:
+                pass
         # making sure we initialize the policy before resetting the plant
         policy(np.zeros((policy.D,)))
 
@@ -313,6 +313,6 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
 def build_rollout(*args, **kwargs):
     kwargs['intermediate_outs'] = True
     outs, inps, updts = get_loss(*args, **kwargs)
-    rollout_fn = theano.function(inps, outs, updates=updts,
-                                 allow_input_downcast=True)
+    rollout_fn = utils.function_cache.function(
+        inps, outs, updates=updts, allow_input_downcast=True)
     return rollout_fn
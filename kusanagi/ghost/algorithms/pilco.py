@@ -197,6 +197,6 @@ def get_loss(policy, dynmodel, cost, angle_dims, intermediate_outs=False,
 def build_rollout(*args, **kwargs):
     kwargs['intermediate_outs'] = True
     outs, inps, updts = get_loss(*args, **kwargs)
-    rollout_fn = theano.function(inps, outs, updates=updts,
-                                 allow_input_downcast=True)
+    rollout_fn = utils.function_cache.function(
+        inps, outs, updates=updts, allow_input_downcast=True)
     return rollout_fn
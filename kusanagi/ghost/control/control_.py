@@ -65,6 +65,8 @@ class RBFPolicy(RBFGP):
 
         # hyp is no longer the trainable paramter
         self.predict_fn = None
+        self.predict_ic_fn = None
+        self.predict_batch_fn = None
 
     def init_params(self, compile_funcs=False):
         utils.print_with_stamp('Initializing parameters', self.name)
@@ -113,6 +115,9 @@ class RBFPolicy(RBFGP):
         self.__call__(np.zeros((self.D, )))
 
     def __call__(self, m, s=None, t=None, **kwargs):
+        if s is None and len(kwargs) == 0:
+            # deterministic controls, evaluated from the inference cache
+            return self.fast_predict(m)
         return super(RBFPolicy, self).__call__(m, s, **kwargs)
 
 
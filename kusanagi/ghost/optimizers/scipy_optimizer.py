@@ -1,12 +1,15 @@
 # pylint: disable=C0103
 import numpy as np
 import theano
+import theano.tensor as tt
 import time
 from kusanagi import utils
 from scipy.optimize import minimize
 from theano.updates import OrderedUpdates
 import traceback
 
+floatX = theano.config.floatX
+
 SCIPY_MIN_METHODS = ['L-BFGS-B', 'TNC', 'BFGS', 'SLSQP', 'CG']
 
 
@@ -71,51 +74,85 @@ class ScipyOptimizer(object):
                                    self.name)
             grads = theano.grad(loss, params)
 
-        utils.print_with_stamp('Compiling function for loss', self.name)
-
-        self.loss_fn = theano.function(
-            inputs, loss, updates=updts, allow_input_downcast=True,
-            mode=compilation_mode)
+        # a single function is compiled for the loss and its gradients; the
+        # loss-only evaluations are served from it. The gradients are
+        # returned as a single flat vector, matching the layout of the flat
+        # parameter vector used by scipy
         utils.print_with_stamp('Compiling function for loss+gradients',
                                self.name)
-        self.grads_fn = theano.function(
-            inputs, [loss, ]+grads, updates=updts, allow_input_downcast=True,
-            mode=compilation_mode)
+        flat_grads = tt.concatenate([g.flatten() for g in grads])
+        self.grads_fn = utils.function_cache.function(
+            inputs, [loss, flat_grads], updates=updts,
+            allow_input_downcast=True, mode=compilation_mode)
+        self.loss_fn = self.eval_loss
 
         self.n_evals = 0
         self.start_time = 0
         self.iter_time = 0
         self.params = params
 
-    def loss_wrapper(self, p, p_shapes, *inputs):
+    def eval_loss(self, *inputs):
+        '''
+            Evaluates the loss (and applies the updates) with the compiled
+            loss+gradients function
+        '''
+        return self.grads_fn(*inputs)[0]
+
+    def init_flat_params(self):
+        '''
+            Copies the current parameter values into a contiguous flat
+            vector, and makes every parameter shared variable hold a view
+            into it. Setting the values of the flat vector then updates the
+            parameters without any further copies.
+        '''
+        p0 = [p.get_value() for p in self.params]
+        self.flat_p = utils.wrap_params(p0).astype(floatX)
+        self.p_views = []
+        i = 0
+        for p in p0:
+            self.p_views.append(self.flat_p[i:i+p.size].reshape(p.shape))
+            i += p.size
+        self.bind_flat_params()
+
+    def bind_flat_params(self):
+        '''
+            Makes sure that the parameter shared variables hold the views
+            into the flat parameter vector (their values may have been
+            replaced with set_value, or the shared variables may not support
+            borrowing host memory; e.g. when running on the GPU).
+        '''
+        for sp_i, v_i in zip(self.params, self.p_views):
+            if sp_i.get_value(borrow=True,
+                              return_internal_type=True) is not v_i:
+                sp_i.set_value(v_i, borrow=True)
+
+    def set_flat_params(self, p):
+        '''
+            Sets the values of the parameters from a flat vector
+        '''
+        np.copyto(self.flat_p, p, casting='unsafe')
+        self.bind_flat_params()
+
+    def loss_wrapper(self, p, *inputs):
         '''
             Loss function wrapper compatible with scipy optimize
             @param p numpy array with the current evaluation point for the loss
-            @param p_shapes array with the shapes of every parameter
         '''
-        # transform flattened parameter vector into array of parameters
-        p = utils.unwrap_params(p, p_shapes)
-
         # set new parameter values
-        for i in range(len(self.params)):
-            self.params[i].set_value(p[i])
+        self.set_flat_params(p)
 
         # compute value + derivatives
-        ret = self.grads_fn(*inputs)
-        loss, dloss = ret[0], ret[1:]
-
-        # flatten gradients
-        dloss = utils.wrap_params(dloss)
+        loss, dloss = self.grads_fn(*inputs)
 
         # cast value and gradients as double precision floats
         # (required by fmin_l_bfgs_b)
-        loss, dloss = (np.array(loss).astype(np.float64),
-                       np.array(dloss).astype(np.float64))
+        loss = np.array(loss).astype(np.float64)
+        dloss = dloss.astype(np.float64, copy=False)
 
         # update internal state variables
         self.n_evals += 1
         if loss < self.best_p[0]:
-            self.best_p = [loss, p, self.n_evals]
+            self.best_p = [loss, self.flat_p.copy(), self.n_evals]
         end_time = time.time()
         iter_time_upt = ((end_time - self.start_time) - self.iter_time)
         iter_time_upt /= self.n_evals
@@ -127,7 +164,9 @@ class ScipyOptimizer(object):
         self.start_time = time.time()
 
         if callable(self.callback):
-            self.callback(p, loss, dloss)
+            # the parameter values passed to the callback are views into the
+            # flat parameter vector
+            self.callback(self.p_views, loss, dloss)
 
         # return loss+gradients
         return loss, dloss
@@ -136,64 +175,81 @@ class ScipyOptimizer(object):
         '''
             @param inputs python variables to pass as inputs to the compiled
                    theano functions for the loss and gradients
+            @param callback function called after every evaluation, with the
+                   parameter values, the loss and its gradients
+            @param on_failure function called with the exception when an
+                   optimization run fails. If it returns True (e.g. after
+                   making the objective better conditioned), the run is
+                   restarted with the same method from the best parameters
+                   found so far; otherwise, we move on to the next method
         '''
         self.callback = kwargs.get('callback')
+        on_failure = kwargs.get('on_failure')
         utils.print_with_stamp('Optimizing parameters', self.name)
 
         # set initial loss and parameters
-        loss0 = self.loss_fn(*inputs)
+        self.init_flat_params()
+        loss0, dloss0 = self.grads_fn(*inputs)
         utils.print_with_stamp('Initial loss [%s]' % (loss0), self.name)
-        p0 = [p.get_value() for p in self.params]
-        self.best_p = [loss0, p0, 0]
+        p0 = self.flat_p.astype(np.float64)
+        self.best_p = [loss0, self.flat_p.copy(), 0]
+
+        mloss = utils.MemoizeJac(self.loss_wrapper, args=inputs)
 
-        # get parameter shapes
-        p_shapes = [p.shape for p in p0]
-        mloss = utils.MemoizeJac(self.loss_wrapper,
-                                 args=(p_shapes,)+inputs)
+        # the first evaluation of the optimizer is served from the initial
+        # loss and gradients
+        mloss.x = p0.copy()
+        mloss.value = np.array(loss0).astype(np.float64)
+        mloss.jac = dloss0.astype(np.float64)
 
         # keep on trying to optimize with all the methods, until one succeeds,
         # or we go through all of them
         self.iter_time = 0
         self.start_time = time.time()
         self.n_evals = 0
-        for min_method in self.alt_min_methods:
+        k = 0
+        while k < len(self.alt_min_methods):
+            min_method = self.alt_min_methods[k]
             try:
                 utils.print_with_stamp("Using %s optimizer" % (min_method),
                                        self.name)
-                p0_wrapped = utils.wrap_params(p0)
                 opts = {'maxiter': self.max_evals,
                         'ftol': 1e5*np.finfo(float).eps,
                         'gtol': 1.0e-7}
                 if min_method.lower() == 'l-bfgs-b':
                     opts['maxfun'] = self.max_evals
-                    opts['maxcor'] = min(100, p0_wrapped.size)
+                    opts['maxcor'] = min(100, p0.size)
                     opts['maxls'] = 30
 
-                opt_res = minimize(mloss, p0_wrapped,
+                opt_res = minimize(mloss, p0,
                                    jac=mloss.derivative,
                                    method=min_method,
                                    tol=self.conv_thr,
                                    options=opts)
                 # set params to new values
-                popt = utils.unwrap_params(opt_res.x, p_shapes)
-                for i in range(len(self.params)):
-                    self.params[i].set_value(popt[i])
+                self.set_flat_params(opt_res.x)
                 # break the loop since we succeeded
                 break
-            except (ValueError, np.linalg.LinAlgError):
+            except (ValueError, np.linalg.LinAlgError) as e:
                 print('')
                 traceback.print_exc()
                 traceback.print_stack()
                 msg = "Optimization with %s failed"
-                utils.print_with_stamp(msg % (self.min_method),
+                utils.print_with_stamp(msg % (min_method),
                                        self.name)
-                loss, popt = self.best_p[:2]
-                for i in range(len(self.params)):
-                    self.params[i].set_value(popt[i])
+                self.set_flat_params(self.best_p[1])
+                if callable(on_failure) and on_failure(e):
+                    # the objective has changed; restart from the best
+                    # parameters, discarding the memoized evaluations and
+                    # the losses computed with the previous objective
+                    p0 = self.best_p[1].astype(np.float64)
+                    mloss.x, mloss.value, mloss.jac = None, None, None
+                    self.best_p = [np.inf, self.best_p[1], self.best_p[2]]
+                    continue
+                k += 1
         print('')
         v, p, i = self.best_p
-        for sp_i, p_i in zip(self.params, p):
-            sp_i.set_value(p_i)
+        self.set_flat_params(p)
         v = self.loss_fn(*inputs)
         msg = 'Done training. New loss [%f] iter: [%d]'
         utils.print_with_stamp(msg % (v, i), self.name)
@@ -6,6 +6,7 @@ import theano
 import time
 
 from collections import OrderedDict
+from theano.compile.sharedvalue import SharedVariable
 from theano.updates import OrderedUpdates
 from kusanagi import utils
 
@@ -41,6 +42,7 @@ class SGDOptimizer(object):
         self.best_p = [None, None, self.n_evals]
         self.params = None
         self.callback = None
+        self.update_params_idx_fn = None
 
     @property
     def min_method(self):
@@ -129,7 +131,7 @@ class SGDOptimizer(object):
                                            name=inp.name) for inp in inputs]
 
         givens_dict = dict(zip(inputs, self.shared_inpts))
-        self.loss_fn = theano.function(
+        self.loss_fn = utils.function_cache.function(
             [], loss, updates=updts,
             on_unused_input='ignore',
             allow_input_downcast=True,
@@ -139,7 +141,7 @@ class SGDOptimizer(object):
 
         utils.print_with_stamp("Compiling parameter updates", self.name)
 
-        self.update_params_fn = theano.function(
+        self.update_params_fn = utils.function_cache.function(
             [], outputs,
             updates=grad_updates,
             on_unused_input='ignore',
@@ -148,15 +150,125 @@ class SGDOptimizer(object):
             mode=compilation_mode)
         self.update_params_fn.trust_input = trust_input
 
+        # the on-device minibatch updates are compiled on demand
+        self.minibatch_graph = (inputs, outputs, grad_updates,
+                                compilation_mode, trust_input)
+        self.update_params_idx_fn = None
+
         self.n_evals = 0
         self.start_time = 0
         self.iter_time = 0
         self.params = params
         self.optimizer_state = [s for s in grad_updates.keys()]
 
+    def init_indexed_updates(self):
+        '''
+            Compiles a version of the parameter updates where the minibatch
+            is selected inside the graph. The dataset is stored in the shared
+            variables X_data and Y_data, the minibatch corresponds to the
+            entries batch_perm[batch_start:batch_start+batch_size] and
+            batch_start is advanced after every update. The noise for
+            smoothing is added to the minibatch inputs in the graph.
+        '''
+        inputs, outputs, grad_updates, mode, trust_input = \
+            self.minibatch_graph
+        x, y = inputs[0], inputs[1]
+        self.X_data = theano.shared(np.empty([1]*x.ndim, dtype=x.dtype),
+                                    name='%s>X_data' % (self.name))
+        self.Y_data = theano.shared(np.empty([1]*y.ndim, dtype=y.dtype),
+                                    name='%s>Y_data' % (self.name))
+        self.batch_perm = theano.shared(np.zeros((1,), dtype='int64'),
+                                        name='%s>batch_perm' % (self.name))
+        self.batch_start = theano.shared(np.array(0, dtype='int64'),
+                                         name='%s>batch_start' % (self.name))
+        self.batch_size = theano.shared(np.array(1, dtype='int64'),
+                                        name='%s>batch_size' % (self.name))
+
+        # the last minibatch of an epoch may be smaller than batch_size
+        batch_end = self.batch_start + self.batch_size
+        idx = self.batch_perm[self.batch_start:batch_end]
+        x_batch = self.X_data[idx]
+        # add small amount of noise for smoothing
+        z = utils.get_mrng().normal(x_batch.shape, dtype=x_batch.dtype)
+        x_batch += 1e-4*(x_batch.max()-x_batch.min())*z
+        y_batch = self.Y_data[idx]
+
+        givens_dict = dict(zip(inputs,
+                               [x_batch, y_batch] + self.shared_inpts[2:]))
+        updates = OrderedUpdates(grad_updates)
+        updates[self.batch_start] = batch_end
+
+        utils.print_with_stamp("Compiling on-device minibatch updates",
+                               self.name)
+        self.update_params_idx_fn = utils.function_cache.function(
+            [], outputs,
+            updates=updates,
+            on_unused_input='ignore',
+            allow_input_downcast=True,
+            givens=givens_dict,
+            mode=mode)
+        self.update_params_idx_fn.trust_input = trust_input
+
+    def host_minibatches(self, X, Y, batch_size):
+        '''
+            Generates the parameter update function for every minibatch,
+            after copying the (noisy) minibatch to the shared inputs. The
+            last incomplete minibatch of every epoch is skipped.
+        '''
+        while True:
+            b_iter = utils.iterate_minibatches(X, Y, batch_size, shuffle=True)
+            for x, y in b_iter:
+                # add small amount of noise for smoothing
+                x += 1e-4*(x.max()-x.min())*np.random.randn(*x.shape)
+
+                # mini batch update
+                self.shared_inpts[0].set_value(x)
+                self.shared_inpts[1].set_value(y)
+                yield self.update_params_fn
+
+    def device_minibatches(self, X, Y, batch_size):
+        '''
+            Generates the parameter update function for every minibatch, when
+            the dataset is stored in X_data and Y_data. Only the shuffled
+            indices are transferred, once per epoch. Every sample is visited
+            once per epoch.
+        '''
+        if self.update_params_idx_fn is None:
+            self.init_indexed_updates()
+        if isinstance(X, np.ndarray):
+            X = X.astype(self.X_data.dtype, copy=False)
+        if isinstance(Y, np.ndarray):
+            Y = Y.astype(self.Y_data.dtype, copy=False)
+        self.X_data.set_value(X, borrow=True)
+        self.Y_data.set_value(Y, borrow=True)
+        self.batch_size.set_value(np.array(batch_size, dtype='int64'))
+        N = X.shape[0]
+        n_batches = (N + batch_size - 1)//batch_size
+        while True:
+            self.batch_perm.set_value(np.random.permutation(N).astype('int64'))
+            self.batch_start.set_value(np.array(0, dtype='int64'))
+            for i in range(n_batches):
+                yield self.update_params_idx_fn
+
     def minibatch_minimize(self, X, Y, *inputs, **kwargs):
+        '''
+            @param X, Y training inputs and targets, as numpy arrays or
+                        theano shared variables
+            @param inputs python variables to pass as the remaining inputs to
+                          the compiled theano functions
+            @param on_device if True, X and Y are stored once in shared
+                             variables and the minibatches are selected in
+                             the compiled update function; i.e. there are no
+                             per-minibatch transfers. If X and Y are shared
+                             variables, their values are not copied
+        '''
         callback = kwargs.get('callback', None)
         return_best = kwargs.get('return_best', False)
+        on_device = kwargs.get('on_device', False)
+        if isinstance(X, SharedVariable):
+            X = X.get_value(borrow=on_device, return_internal_type=on_device)
+        if isinstance(Y, SharedVariable):
+            Y = Y.get_value(borrow=on_device, return_internal_type=on_device)
         batch_size = kwargs.get('batch_size', 100)
         batch_size = min(batch_size, X.shape[0])
         self.iter_time = 0
@@ -180,48 +292,39 @@ class SGDOptimizer(object):
 
         # go through the dataset
         out_str = 'Curr loss: %E [%d: %E], n_evals: %d, Avg. time per updt: %f'
-        while True:
-            start_time = time.time()
-            should_exit = False
-            b_iter = utils.iterate_minibatches(X, Y, batch_size, shuffle=True)
-            for x, y in b_iter:
-                start_time = time.time()
+        if on_device:
+            batches = self.device_minibatches(X, Y, batch_size)
+        else:
+            batches = self.host_minibatches(X, Y, batch_size)
+        start_time = time.time()
+        for update_params_fn in batches:
+            ret = update_params_fn()
 
-                # add small amount of noise for smoothing
-                x += 1e-4*(x.max()-x.min())*np.random.randn(*x.shape)
+            # the returned loss and gradients correspond to the parameters
+            # BEFORE the update
+            loss = ret[0]
 
-                # mini batch update
-                self.shared_inpts[0].set_value(x)
-                self.shared_inpts[1].set_value(y)
-                ret = self.update_params_fn()
-
-                # the returned loss and gradients correspond to the parameters
-                # BEFORE the update
-                loss = ret[0]
-
-                if loss < self.best_p[0] or self.n_evals < 10:
-                    # get current optimizer state
-                    state = [s.get_value(return_internal_type=True,
-                                         borrow=False)
-                             for s in self.optimizer_state]
-                    self.best_p = [loss, state, self.n_evals]
-                if callable(callback):
-                    callback(*ret)
-
-                self.n_evals += 1
-                if self.n_evals >= self.max_evals:
-                    should_exit = True
-                    break
-
-                end_time = time.time()
-                dt = end_time - start_time
-                it_updt = (dt - self.iter_time)/self.n_evals
-                self.iter_time += it_updt
-                str_params = (loss, self.best_p[2], self.best_p[0],
-                              self.n_evals, self.iter_time)
-                utils.print_with_stamp(out_str % str_params, self.name, True)
-            if should_exit:
+            if loss < self.best_p[0] or self.n_evals < 10:
+                # get current optimizer state
+                state = [s.get_value(return_internal_type=True,
+                                     borrow=False)
+                         for s in self.optimizer_state]
+                self.best_p = [loss, state, self.n_evals]
+            if callable(callback):
+                callback(*ret)
+
+            self.n_evals += 1
+            if self.n_evals >= self.max_evals:
                 break
+
+            end_time = time.time()
+            dt = end_time - start_time
+            it_updt = (dt - self.iter_time)/self.n_evals
+            self.iter_time += it_updt
+            str_params = (loss, self.best_p[2], self.best_p[0],
+                          self.n_evals, self.iter_time)
+            utils.print_with_stamp(out_str % str_params, self.name, True)
+            start_time = time.time()
         print('')
 
         i = self.n_evals
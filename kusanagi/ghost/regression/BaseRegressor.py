@@ -20,6 +20,7 @@ class BaseRegressor(Loadable):
         # compiled functions
         self.predict_fn = None
         self.predict_ic_fn = None
+        self.predict_batch_fn = None
 
     def get_all_shared_vars(self, as_dict=False):
         '''
@@ -197,10 +198,9 @@ class BaseRegressor(Loadable):
                    if input_covariance else '%s>predict' % (self.name))
         if len(prediction) == 1:
             prediction = prediction[0]
-        predict_fn = theano.function(input_vars, prediction,
-                                     on_unused_input='ignore',
-                                     name=fn_name,
-                                     allow_input_downcast=True)
+        predict_fn = utils.function_cache.function(
+            input_vars, prediction, on_unused_input='ignore', name=fn_name,
+            allow_input_downcast=True)
 
         utils.print_with_stamp('Done compiling', self.name)
 
@@ -209,9 +209,30 @@ class BaseRegressor(Loadable):
     def get_updates(self):
         return theano.updates.OrderedUpdates()
 
+    def predict_in_chunks(self, predict, X, chunk_size):
+        ''' Evaluates the compiled prediction function on the rows of X, in
+        chunks of (at most) chunk_size rows, and concatenates the results
+        along the first axis'''
+        res = [predict(X[i:i+chunk_size])
+               for i in range(0, X.shape[0], chunk_size)]
+        if not isinstance(res[0], (list, tuple)):
+            return np.concatenate(res, axis=0)
+        return [np.concatenate(r, axis=0) for r in zip(*res)]
+
     def __call__(self, mx, Sx=None, *args, **kwargs):
         # check if we need to compile the prediction functions
-        if Sx is None:
+        if Sx is None and mx.ndim == 2:
+            # deterministic predictions for a batch of inputs
+            if getattr(self, 'predict_batch_fn', None) is None:
+                self.predict_batch_fn = self.init_predict(
+                    input_covariance=False, input_ndim=2, *args, **kwargs)
+                self.state_changed = True  # for saving
+            chunk_size = getattr(self, 'predict_chunk_size', None)
+            if chunk_size:
+                return self.predict_in_chunks(
+                    self.predict_batch_fn, mx, chunk_size)
+            return self.predict_batch_fn(mx)
+        elif Sx is None:
             if not hasattr(self, 'predict_fn') or self.predict_fn is None:
                 self.predict_fn = self.init_predict(
                     input_covariance=False, input_ndim=mx.ndim,
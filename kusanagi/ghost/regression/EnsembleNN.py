@@ -0,0 +1,238 @@
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi import utils
+from kusanagi.ghost.regression import nonlinearities
+from kusanagi.ghost.regression import BaseRegressor
+from kusanagi.ghost.regression.NN import BNN
+
+floatX = theano.config.floatX
+
+
+class EnsembleNN(BNN):
+    ''' Ensemble of K neural networks (Lakshminarayanan et al 2017), where
+    every member is trained on its own bootstrap resample of each minibatch.
+    The weights of the members are stored as stacked tensors (K x fan_in x
+    fan_out), so all the members are evaluated with batched matrix products
+    in a single pass. When predicting for a set of particles, particle i is
+    propagated through member i % K; i.e. over a rollout, every particle
+    follows a single member of the ensemble. Can be used in place of BNN
+    as the dynamics model for mc_pilco'''
+    def __init__(self, idims, odims, n_members=5, hidden_dims=[200]*2,
+                 n_samples=100, heteroscedastic=True, bootstrap=True,
+                 weight_decay=1e-4, nonlinearity=nonlinearities.rectify,
+                 name='EnsembleNN', filename=None, **kwargs):
+        self.n_members = n_members
+        self.hidden_dims = list(hidden_dims)
+        self.n_layers = len(self.hidden_dims) + 1
+        self.bootstrap = bootstrap
+        self.weight_decay = weight_decay
+        self.nonlinearity = nonlinearity
+        # the members are not lasagne networks
+        kwargs.pop('network', None)
+        kwargs.pop('network_spec', None)
+        super(EnsembleNN, self).__init__(
+            idims, odims, n_samples=n_samples,
+            heteroscedastic=heteroscedastic, name=name, filename=filename,
+            **kwargs)
+        if getattr(self, 'W_0', None) is None:
+            self.init_params()
+
+    def init_params(self):
+        ''' Initializes the weights (Glorot uniform, with the gain for
+        rectifiers) and biases of every member independently'''
+        K = self.n_members
+        odims = 2*self.E if self.heteroscedastic else self.E
+        dims = [self.D] + self.hidden_dims + [odims]
+        params = {}
+        for i in range(self.n_layers):
+            limit = np.sqrt(2.0)*np.sqrt(6.0/(dims[i] + dims[i+1]))
+            W = np.random.uniform(-limit, limit, (K, dims[i], dims[i+1]))
+            b = np.random.uniform(-0.01, 0.01, (K, dims[i+1]))
+            params['W_%d' % (i)] = W.astype(floatX)
+            params['b_%d' % (i)] = b.astype(floatX)
+        self.set_params(params)
+
+    def get_weights(self):
+        ''' Returns the list of (W, b) pairs for every layer'''
+        return [(getattr(self, 'W_%d' % (i)), getattr(self, 'b_%d' % (i)))
+                for i in range(self.n_layers)]
+
+    def save(self, output_folder=None, output_filename=None):
+        BaseRegressor.save(self, output_folder, output_filename)
+
+    def get_intermediate_outputs(self):
+        return BaseRegressor.get_intermediate_outputs(self)
+
+    def get_updates(self, network=None):
+        return theano.updates.OrderedUpdates()
+
+    def members_output(self, x):
+        ''' Evaluates every member of the ensemble on its own set of inputs
+        @param x K x n x D tensor of (whitened) inputs
+        @return K x n x O tensor of outputs
+        '''
+        h = x
+        for i, (W, b) in enumerate(self.get_weights()):
+            h = tt.batched_dot(h, W) + b[:, None, :]
+            if i < self.n_layers - 1:
+                h = self.nonlinearity(h)
+        return h
+
+    def particles_output(self, x):
+        ''' Evaluates particle i with member i % K
+        @param x n x D matrix of (whitened) inputs
+        @return n x O matrix of outputs
+        '''
+        K = self.n_members
+        n, D = x.shape[0], x.shape[1]
+        m = (n + K - 1)//K
+        # pad to a multiple of K, so that row i goes to member i % K
+        xp = tt.set_subtensor(tt.zeros((m*K, D), dtype=x.dtype)[:n], x)
+        ret = self.members_output(xp.reshape((m, K, D)).transpose(1, 0, 2))
+        return ret.transpose(1, 0, 2).reshape((m*K, ret.shape[2]))[:n]
+
+    def output_distribution(self, ret, whiten_outputs=True):
+        ''' Returns the predicted means and noise standard deviations from
+        the raw n x O outputs of the networks'''
+        y = ret[:, :self.E]
+        sn = (0.1*tt.nnet.sigmoid(ret[:, self.E:])
+              if self.heteroscedastic
+              else tt.tile(self.sn, (y.shape[0], 1)))
+        # fudge factor
+        sn += 1e-6
+        if whiten_outputs and self.Ym is not None:
+            # scale and center outputs
+            y = y.dot(self.Ys) + self.Ym
+            # rescale variances
+            sn = sn*tt.diag(self.Ys)
+        return y, sn
+
+    def get_loss(self):
+        ''' initializes the loss function for training '''
+        utils.print_with_stamp('Initialising loss function', self.name)
+        K = self.n_members
+        train_inputs = tt.matrix('%s>train_inputs' % (self.name))
+        train_targets = tt.matrix('%s>train_targets' % (self.name))
+        B = train_inputs.shape[0]
+
+        # K x B indices of the samples in the minibatch seen by each member
+        if self.bootstrap:
+            u = utils.get_mrng().uniform((K, B))
+            idx = tt.minimum(tt.cast(tt.floor(u*B), 'int64'), B - 1)
+        else:
+            idx = tt.tile(tt.arange(B)[None, :], (K, 1))
+        x = (train_inputs[idx] - self.Xm).dot(self.iXs)
+        ret = self.members_output(x)
+        ret = ret.reshape((K*B, ret.shape[2]))
+        train_predictions, sn = self.output_distribution(ret)
+        targets = train_targets[idx].reshape((K*B, self.E))
+
+        # the sum over members of the average negative log likelihood, so
+        # every member is trained as if it were on its own
+        N = self.X.shape[0].astype(floatX)
+        lml = self.likelihood(targets, train_predictions, sn)
+        reg = sum([tt.square(W).sum() for W, b in self.get_weights()])
+        loss = -lml/B.astype(floatX) + 0.5*self.weight_decay*reg/N
+
+        inputs = [train_inputs, train_targets]
+        updates = theano.updates.OrderedUpdates()
+
+        # get trainable network parameters
+        params = {}
+        for i, (W, b) in enumerate(self.get_weights()):
+            params['W_%d' % (i)] = W
+            params['b_%d' % (i)] = b
+        # if we are learning the noise
+        if not self.heteroscedastic:
+            params['unconstrained_sn'] = self.unconstrained_sn
+        self.set_params(params)
+        return loss, inputs, updates
+
+    def predict(self, mx, Sx=None, deterministic=False,
+                iid_per_eval=False, return_samples=False,
+                whiten_inputs=True, whiten_outputs=True, **kwargs):
+        ''' returns symbolic expressions for the evaluations of the ensemble.
+        For a matrix of inputs, every row is evaluated with one member
+        (particle i with member i % K), unless deterministic is True, in
+        which case we return the average over members. For a single input
+        (without Sx), the samples are the outputs of all the members. If Sx
+        is specified, the output will correspond to the mean, covariance and
+        input-output covariance of the ensemble predictions'''
+        K = self.n_members
+        if Sx is not None:
+            # generate random samples from input (assuming gaussian
+            # distributed inputs)
+            z_std = utils.get_mrng().normal((self.n_samples, self.D))
+
+            # scale and center particles
+            Lx = tt.slinalg.cholesky(Sx)
+            x = mx + z_std.dot(Lx.T)
+        else:
+            x = mx[None, :] if mx.ndim == 1 else mx
+
+        xw = x
+        if whiten_inputs and self.Xm is not None:
+            # standardize inputs
+            xw = (x - self.Xm).dot(self.iXs)
+
+        if Sx is None and (deterministic or mx.ndim == 1):
+            # evaluate all members for every input
+            ret = self.members_output(tt.tile(xw[None, :, :], (K, 1, 1)))
+            if deterministic:
+                ret = ret.mean(0)
+            else:
+                ret = ret[:, 0, :]
+        else:
+            ret = self.particles_output(xw)
+        y, sn = self.output_distribution(ret, whiten_outputs)
+        y.name = '%s>output_samples' % (self.name)
+        if return_samples:
+            return y, sn
+        else:
+            n = tt.cast(y.shape[0], dtype=floatX)
+            # empirical mean
+            M = y.mean(axis=0)
+            # empirical covariance
+            deltay = y - M
+            S = deltay.T.dot(deltay)/tt.maximum(n-1, 1)
+            # noise
+            S += tt.diag((sn**2).mean(axis=0))
+            # empirical input output covariance
+            if Sx is not None:
+                deltax = x - x.mean(0)
+                C = deltax.T.dot(deltay)/(n-1)
+            else:
+                C = tt.zeros((self.D, self.E))
+            return [M, S, C]
+
+    def update(self, n_samples=None):
+        ''' Sets the number of particles used for moment matching. There are
+        no masks to resample; the particles are always assigned to members
+        in the same way'''
+        if n_samples is not None:
+            if isinstance(n_samples, tt.sharedvar.SharedVariable):
+                self.n_samples = n_samples
+            else:
+                self.n_samples.set_value(n_samples)
+
+    def train(self, batch_size=100, lr=1e-3, optimizer=None, callback=None,
+              on_device=True, **kwargs):
+        if optimizer is None:
+            optimizer = self.optimizer
+        if optimizer.loss_fn is None or self.should_recompile:
+            loss, inps, updts = self.get_loss()
+            # we pass the learning rate as an input, and as a parameter to the
+            # updates method
+            learning_rate = theano.tensor.scalar('lr')
+            inps.append(learning_rate)
+            optimizer.set_objective(loss, self.get_params(symbolic=True),
+                                    inps, updts, learning_rate=learning_rate)
+
+        X, Y = self.X, self.Y
+        if not on_device:
+            X, Y = X.get_value(), Y.get_value()
+        optimizer.minibatch_minimize(X, Y, lr, batch_size=batch_size,
+                                     callback=callback, on_device=on_device)
+        self.trained = True
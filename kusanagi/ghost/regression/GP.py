@@ -1,14 +1,16 @@
+import multiprocessing
 import numpy as np
+import scipy.linalg
 import theano
 import theano.tensor as tt
+import time
 
 from functools import partial
 from kusanagi.ghost.optimizers import ScipyOptimizer
 from theano import function as F, shared as S
-from theano.tensor.nlinalg import matrix_dot, det
 from theano.tensor.slinalg import (solve_lower_triangular,
                                    solve_upper_triangular,
-                                   solve, Cholesky)
+                                   Cholesky)
 
 from . import cov
 from . import SNRpenalty
@@ -16,16 +18,98 @@ from kusanagi import utils
 from kusanagi.ghost.regression import BaseRegressor
 floatX = theano.config.floatX
 
+# model and optimizer used by the multi-start training workers. These are set
+# before forking the worker processes, so every worker shares the compiled
+# loss function
+_multistart_state = None
+
+
+def _multistart_worker(args):
+    ''' Runs one restart of the hyperparameter optimization, starting from
+    the given parameters. Returns the index of the restart, the best loss,
+    the corresponding parameters and the elapsed time'''
+    i, params, seed = args
+    model, optimizer, callback = _multistart_state
+    np.random.seed(seed)
+    start_time = time.time()
+    model.set_params(params)
+    optimizer.minimize(callback=callback)
+    loss = float(optimizer.best_p[0])
+    params = model.get_params(as_dict=True, ignore_fixed=False)
+    return i, loss, params, time.time() - start_time
+
 
 class GP(BaseRegressor):
+    # whether the predictive equations of the full GP (used by the numpy
+    # inference cache in fast_predict) apply to this model
+    supports_fast_predict = True
+
     def __init__(self, X_dataset=None, Y_dataset=None, name='GP', idims=None,
-                 odims=None, snr_penalty=SNRpenalty.SEard, filename=None, **kwargs):
+                 odims=None, snr_penalty=SNRpenalty.SEard, filename=None,
+                 batched_loss=False, n_restarts=1, n_workers=None,
+                 cg_loss=False, cg_iters=50, cg_probes=10, cg_block_size=1024,
+                 cache_iK=True, pairwise_cache=None, pairwise_cache_mb=256,
+                 mixed_precision=False, jitter=None, max_jitter_tries=6,
+                 predict_chunk_size=1024, **kwargs):
         # GP options
         self.state_changed = True
         self.should_recompile = False
         self.trained = False
         self.snr_penalty = snr_penalty
         self.covs = (cov.SEard, cov.Noise)
+        self.batched_covs = (cov.SEard_batched, cov.Noise_batched)
+        # whether to compute the loss for all output dimensions with batched
+        # linear algebra ops (instead of a scan over output dimensions)
+        self.batched_loss = batched_loss
+        # number of independent restarts of the hyperparameter optimization,
+        # and number of worker processes used to run them
+        self.n_restarts = n_restarts
+        self.n_workers = n_workers
+        # whether to train with the matrix-free conjugate gradients loss;
+        # i.e. without computing cholesky factors or inverse kernel matrices.
+        # The CG iterations are not preconditioned, so for badly conditioned
+        # kernel matrices (e.g. long lengthscales with small noise) cg_iters
+        # iterations may not converge, and the loss and its gradients will
+        # be inaccurate. Only deterministic predictions are supported
+        self.cg_loss = cg_loss
+        self.cg_iters = cg_iters
+        self.cg_probes = cg_probes
+        self.cg_block_size = cg_block_size
+        self.cg_Z = None
+        # whether to keep the inverse kernel matrices in memory. If False,
+        # only the cholesky factors and beta are kept, and the products with
+        # the inverse kernel matrices are done with triangular solves
+        self.cache_iK = cache_iK
+        # precomputed squared differences between training inputs, for
+        # evaluating the SE kernel matrices during training. pairwise_cache
+        # can be 'full' (D x N x N), 'triu' (D x N(N-1)/2, upper triangle),
+        # None (no cache, the default) or 'auto' (choose the first of the
+        # previous that fits in pairwise_cache_mb megabytes, including the
+        # int32 indices of the upper triangle)
+        if pairwise_cache not in ('auto', 'full', 'triu', None):
+            raise ValueError('Unknown pairwise_cache mode %s' % (
+                pairwise_cache))
+        self.pairwise_cache = pairwise_cache
+        self.pairwise_cache_mb = pairwise_cache_mb
+        self.pairwise_cache_mode = None
+        self.X_sqdist = None
+        self.X_sqdist_idx = None
+        # whether to do the cholesky decompositions, triangular solves and
+        # log determinants in float64, while keeping the kernel evaluations
+        # and the rest of the graph in floatX (e.g. float32). The jitter is
+        # added to the diagonal of the kernel matrices, and is increased by
+        # a factor of 10 (up to max_jitter_tries times) whenever a cholesky
+        # decomposition fails during training. Failures in the middle of an
+        # optimization run are only caught with optimizers that support the
+        # on_failure hook (ScipyOptimizer); otherwise, only failures at the
+        # initial parameters trigger a retry
+        self.mixed_precision = mixed_precision
+        if jitter is None:
+            jitter = 1e-6 if mixed_precision else 0.0
+        self.max_jitter_tries = max_jitter_tries
+        # maximum number of inputs per call to the compiled batch prediction
+        # function (bounds the memory used by the N x n kernel matrices)
+        self.predict_chunk_size = predict_chunk_size
 
         # dimension related variables
         self.N = 0
@@ -57,9 +141,14 @@ class GP(BaseRegressor):
         self.Y_var = None
         self.X_cov = None
         self.kernel_func = None
+        # numpy arrays for fast deterministic predictions (see
+        # update_inference_cache)
+        self.inference_cache = None
 
         # name of this class for printing command line output and saving
         self.name = name
+        self.jitter = S(np.array(jitter, dtype=self.factor_dtype),
+                        name='%s>jitter' % (self.name))
         # filename for saving
         self.filename = filename if filename else '%s_%d_%d_%s_%s' % (
             self.name, self.D, self.E, theano.config.device,
@@ -88,6 +177,8 @@ class GP(BaseRegressor):
 
         self.ready = False
         self.predict_fn = None
+        self.predict_batch_fn = None
+        self.inference_cache_fn = None
 
     def load(self, output_folder=None, output_filename=None):
         ''' loads the state from file, and initializes additional variables'''
@@ -104,6 +195,30 @@ class GP(BaseRegressor):
             eps = np.finfo(np.__dict__[floatX]).eps
             self.hyp = tt.nnet.softplus(self.unconstrained_hyp) + eps
             self.sn = self.hyp[:, -1]
+        self.inference_cache = None
+
+        # the pairwise difference cache is not saved, so it has to be rebuilt
+        # for the loaded dataset (on the next call to get_loss)
+        if self.X_sqdist is not None:
+            self.should_recompile = True
+        self.X_sqdist, self.X_sqdist_idx = None, None
+        self.pairwise_cache_mode = None
+
+    def get_instance_state(self):
+        ''' Returns the state for saving. The cached factorizations are left
+        out, since they take O(E N^2) space and can be recomputed from the
+        dataset and the hyperparameters'''
+        state = super(GP, self).get_instance_state()
+        shared = tt.sharedvar.SharedVariable
+        for key in ['iK', 'L', 'beta', 'X_sqdist', 'X_sqdist_idx']:
+            if isinstance(state.get(key), shared):
+                del state[key]
+        return state
+
+    def set_params(self, params, trainable=False):
+        super(GP, self).set_params(params, trainable)
+        # the inference cache was computed from the previous parameters
+        self.inference_cache = None
 
     def set_dataset(self, X_dataset, Y_dataset, X_cov=None, Y_var=None):
         # set dataset
@@ -112,8 +227,14 @@ class GP(BaseRegressor):
         # extra operations when setting the dataset (specific to this class)
         if X_cov is not None:
             self.X_cov = X_cov
-            self.nigp = S(np.zeros((self.E, self.N)),
-                          name="%s>nigp" % (self.name))
+            nigp = np.zeros((self.E, self.N), dtype=floatX)
+            if self.nigp is None:
+                self.nigp = S(nigp, name="%s>nigp" % (self.name))
+            else:
+                self.nigp.set_value(nigp)
+            # X_cov is a constant in the nigp update graph
+            self.nigp_fn = None
+        self.inference_cache = None
         if Y_var is not None:
             if self.Y_var is None:
                 self.Y_var = S(Y_var, name='%s>Y_var' % (self.name),
@@ -125,6 +246,12 @@ class GP(BaseRegressor):
             # init log hyperparameters and intermediate variables
             self.init_params()
 
+        if self.cg_Z is not None:
+            self.cg_Z.set_value(self.sample_cg_probes())
+
+        if self.X_sqdist is not None:
+            self.update_pairwise_cache()
+
         # we should be saving, since we updated the trianing dataset
         self.state_changed = True
         if self.N > 0:
@@ -135,12 +262,22 @@ class GP(BaseRegressor):
         if self.X is None:
             self.set_dataset(X_dataset, Y_dataset, X_cov, Y_var)
         else:
+            # if the hyperparameters are fixed, we can extend the cached
+            # factorizations instead of recomputing them from scratch
+            update_factorization = (
+                self.trained and X_cov is None and Y_var is None
+                and self.X_cov is None and self.Y_var is None
+                and self.has_cached_factorization())
+            if update_factorization:
+                K12, K22 = self.get_kernel_append_fn()(
+                    X_dataset.astype(self.X.dtype))
+
             X_ = np.vstack((self.X.get_value(),
                             X_dataset.astype(self.X.dtype)))
             Y_ = np.vstack((self.Y.get_value(),
                             Y_dataset.astype(self.Y.dtype)))
             X_cov_ = None
-            if X_cov is not None and hasattr(self, 'X_cov') and self.X_cov:
+            if X_cov is not None and getattr(self, 'X_cov', None) is not None:
                 X_cov_ = np.vstack((self.X_cov,
                                     X_cov.astype(self.X_cov.dtype)))
             Y_var_ = None
@@ -150,6 +287,104 @@ class GP(BaseRegressor):
 
             self.set_dataset(X_, Y_, X_cov_, Y_var_)
 
+            if update_factorization:
+                self.update_factorization(K12, K22)
+
+    def has_cached_factorization(self):
+        ''' Returns True if the cholesky factors and the inverse kernel
+        matrices are stored in shared variables and correspond to the current
+        dataset'''
+        shared = tt.sharedvar.SharedVariable
+        cached = [self.L, self.beta] + ([self.iK] if self.cache_iK else [])
+        if not all([isinstance(v, shared) for v in cached]):
+            return False
+        return self.L.get_value(borrow=True).shape[-1] == self.N
+
+    def get_kernel_append_fn(self):
+        ''' Returns a compiled function that evaluates the cross covariance
+        between the training inputs and a set of new inputs, and the
+        covariance of the new inputs (with the same jitter as the cached
+        factorization); using the current hyperparameters'''
+        if getattr(self, 'kernel_append_fn', None) is None:
+            idims = self.D
+            X_new = tt.matrix('%s>X_new' % (self.name))
+            hyps = (self.hyp[:, :idims+1], self.hyp[:, idims+1])
+            K12 = cov.SEard_batched(hyps[0], self.X, X_new)
+            K22 = cov.Sum_batched(hyps, self.batched_covs, X_new)
+            K22 += self.jitter*tt.eye(X_new.shape[0])
+            self.kernel_append_fn = F(
+                [X_new], [K12, K22], name='%s>kernel_append' % (self.name),
+                allow_input_downcast=True)
+        return self.kernel_append_fn
+
+    def update_factorization(self, K12, K22):
+        ''' Extends the cached cholesky factors, inverse kernel matrices and
+        beta to account for H new training points, with a block rank-H
+        update that keeps the hyperparameters fixed'''
+        msg = 'Updating cached factorization with %d new samples'
+        utils.print_with_stamp(msg % (K12.shape[-1]), self.name)
+        L, L22 = utils.linalg.cholesky_append(
+            self.L.get_value(), K12, K22)
+        Y = self.Y.get_value()
+        beta = np.stack([
+            scipy.linalg.cho_solve((L[i], True), Y[:, i])
+            for i in range(self.E)])
+        self.L.set_value(L.astype(floatX))
+        self.beta.set_value(beta.astype(floatX))
+        if self.cache_iK:
+            iK = utils.linalg.inverse_append(self.iK.get_value(), K12, L22)
+            self.iK.set_value(iK.astype(floatX))
+        self.state_changed = True
+
+    def update_cached_factorization(self):
+        ''' Recomputes the cached cholesky factors, beta and (if
+        self.cache_iK) inverse kernel matrices from the current dataset and
+        hyperparameters, outside of the training graph. This is used after
+        loading a saved model, since the factorizations are not saved'''
+        utils.print_with_stamp('Updating cached factorization', self.name)
+        idims = self.D
+        N, E = self.N, self.E
+        hyp = self.hyp.eval()
+        X = self.X.get_value()
+        Y = self.Y.get_value()
+        noise = np.tile(hyp[:, idims+1, None]**2, (1, N))
+        noise += self.jitter.get_value()
+        if self.nigp is not None:
+            noise += self.nigp.get_value()
+        if self.Y_var is not None:
+            noise += self.Y_var.get_value().T
+        eyeN = np.eye(N)
+        cache = {'L': np.empty((E, N, N), dtype=floatX),
+                 'beta': np.empty((E, N), dtype=floatX)}
+        if self.cache_iK:
+            cache['iK'] = np.empty((E, N, N), dtype=floatX)
+        for i in range(E):
+            Xs = X/hyp[i, :idims]
+            sq = np.sum(Xs**2, 1)
+            K = sq[:, None] + sq[None, :] - 2*Xs.dot(Xs.T)
+            K = hyp[i, idims]**2*np.exp(-0.5*K) + np.diag(noise[i])
+            for j in range(self.max_jitter_tries + 1):
+                try:
+                    L = np.linalg.cholesky(K)
+                    break
+                except np.linalg.LinAlgError:
+                    if j == self.max_jitter_tries:
+                        raise
+                    jitter = self.jitter.get_value()
+                    self.increase_jitter()
+                    K += np.eye(N)*(self.jitter.get_value() - jitter)
+            cache['L'][i] = L
+            cache['beta'][i] = scipy.linalg.cho_solve((L, True), Y[:, i])
+            if self.cache_iK:
+                cache['iK'][i] = scipy.linalg.cho_solve((L, True), eyeN)
+
+        shared = tt.sharedvar.SharedVariable
+        for key, value in cache.items():
+            if isinstance(getattr(self, key), shared):
+                getattr(self, key).set_value(value)
+            else:
+                setattr(self, key, S(value, name="%s>%s" % (self.name, key)))
+
     def init_params(self):
         utils.print_with_stamp('Initialising parameters', self.name)
         idims = self.D
@@ -177,51 +412,306 @@ class GP(BaseRegressor):
         if self.sn is None:
             self.sn = self.hyp[:, -1]
 
+    def sample_restart_params(self, scale=0.5):
+        ''' Returns a random starting point for a restart of the
+        hyperparameter optimization, obtained by perturbing the current
+        hyperparameters with log-normal noise'''
+        params = self.get_params(as_dict=True, ignore_fixed=False)
+        hyp = np.logaddexp(0, params['unconstrained_hyp'])
+        hyp *= np.exp(scale*np.random.randn(*hyp.shape))
+        params['unconstrained_hyp'] = np.log(np.expm1(hyp)).astype(floatX)
+        return params
+
+    @property
+    def factor_dtype(self):
+        ''' dtype of the cholesky factors, solves and log determinants'''
+        return 'float64' if self.mixed_precision else floatX
+
+    def upcast(self, x):
+        ''' Casts x to the dtype used for the factorizations'''
+        return tt.cast(x, self.factor_dtype)
+
+    def downcast(self, x):
+        ''' Casts x back to floatX, after the factorizations'''
+        return tt.cast(x, floatX)
+
+    def increase_jitter(self):
+        ''' Multiplies the jitter added to the diagonal of the kernel
+        matrices by 10 (or sets it to 1e-6, if it was zero)'''
+        jitter = self.jitter.get_value()
+        jitter = 10*jitter if jitter > 0 else 1e-6
+        self.jitter.set_value(np.array(jitter, dtype=self.jitter.dtype))
+        utils.print_with_stamp('Increased jitter to %g' % (jitter), self.name)
+
+    def update_pairwise_cache(self):
+        ''' Precomputes the squared differences between every pair of
+        training inputs, for every input dimension. With these, the SE kernel
+        matrices are evaluated as a single weighted reduction over input
+        dimensions, instead of recomputing the distances between inputs on
+        every evaluation of the loss'''
+        X = self.X.get_value()
+        N, D = X.shape
+        mode = self.pairwise_cache
+        itemsize = np.dtype(floatX).itemsize
+        full_mb = D*N*N*itemsize/2.0**20
+        # the upper triangle also needs the 2 x N(N-1)/2 int32 indices
+        triu_mb = (N*(N-1)//2)*(D*itemsize + 2*4)/2.0**20
+        if mode == 'auto':
+            if full_mb <= self.pairwise_cache_mb:
+                mode = 'full'
+            elif triu_mb <= self.pairwise_cache_mb:
+                mode = 'triu'
+            else:
+                mode = None
+
+        if mode != self.pairwise_cache_mode:
+            # the loss needs to be rebuilt with the new shared variables
+            self.X_sqdist, self.X_sqdist_idx = None, None
+            self.should_recompile = True
+        self.pairwise_cache_mode = mode
+        if mode is None:
+            msg = 'Not using a pairwise difference cache (%.1f MB needed)'
+            utils.print_with_stamp(msg % (full_mb), self.name)
+            return
+
+        if mode == 'full':
+            sqdist = np.square(X.T[:, :, None] - X.T[:, None, :])
+            idx = np.zeros((2, 0), dtype='int32')
+        else:
+            idx = np.stack(np.triu_indices(N, 1)).astype('int32')
+            sqdist = np.square(X.T[:, idx[0]] - X.T[:, idx[1]])
+        sqdist = sqdist.astype(floatX)
+        if self.X_sqdist is None:
+            self.X_sqdist = S(sqdist, name='%s>X_sqdist' % (self.name),
+                              borrow=True)
+            self.X_sqdist_idx = S(idx, name='%s>X_sqdist_idx' % (self.name))
+        else:
+            self.X_sqdist.set_value(sqdist, borrow=True)
+            self.X_sqdist_idx.set_value(idx)
+        msg = 'Using %s pairwise difference cache (%.1f MB)'
+        cache_mb = (sqdist.size*itemsize + idx.size*4)/2.0**20
+        utils.print_with_stamp(msg % (mode, cache_mb), self.name)
+
+    def training_kernel(self, hyp, X=None, X_sqdist=None, X_sqdist_idx=None):
+        ''' Returns the E x N x N SE kernel matrices (without noise) of the
+        training inputs, for the E rows of hyp. Uses the pairwise difference
+        cache, if enabled. The training inputs and the cache default to the
+        shared variables of this object (these can be passed explicitly for
+        use inside strict scans)'''
+        idims = self.D
+        X = self.X if X is None else X
+        if self.pairwise_cache is not None and self.X_sqdist is None\
+                and self.pairwise_cache_mode is None:
+            self.update_pairwise_cache()
+        if self.X_sqdist is None:
+            return cov.SEard_batched(hyp[:, :idims+1], X)
+        X_sqdist = self.X_sqdist if X_sqdist is None else X_sqdist
+        X_sqdist_idx = self.X_sqdist_idx if X_sqdist_idx is None\
+            else X_sqdist_idx
+
+        N = X.shape[0]
+        sf2 = hyp[:, idims]**2
+        iL2 = 1.0/tt.square(hyp[:, :idims])
+        r2 = tt.tensordot(iL2, X_sqdist, axes=[1, 0])
+        if self.pairwise_cache_mode == 'full':
+            return sf2[:, None, None]*tt.exp(-0.5*r2)
+        # fill the upper triangle, and make the matrices symmetric
+        i, j = X_sqdist_idx[0], X_sqdist_idx[1]
+        K = tt.zeros((hyp.shape[0], N, N))
+        K = tt.set_subtensor(K[:, i, j], sf2[:, None]*tt.exp(-0.5*r2))
+        K = K + K.transpose(0, 2, 1) + sf2[:, None, None]*tt.eye(N)
+        return K
+
     def nigp_updates(self):
+        ''' Returns the updates for the input noise contribution to the
+        output variances (NIGP, McHutchon and Rasmussen 2011); i.e.
+        dM^T X_cov dM, where dM is the derivative of the posterior mean at
+        every training input. For the SE kernel the derivative is
+        dM[e, i] = -iL_e^2 sum_j beta_ej K_e[i, j] (X_i - X_j), which we
+        evaluate for all outputs and training inputs at once'''
         idims = self.D
-        msg = 'Compiling derivative of mean function at training inputs'
+        msg = 'Building derivative of mean function at training inputs'
         utils.print_with_stamp(msg, self.name)
 
-        # we need to evaluate the derivative of the mean function at the
-        # training inputs
-        def dM2_f_i(mx, beta, hyp, X):
-            hyps = (hyp[:idims+1], hyp[idims+1])
-            kernel_func = partial(cov.Sum, hyps, self.covs)
-            k = kernel_func(mx[None, :], X).flatten()
-            mean = k.dot(beta)
-            dmean = tt.jacobian(mean.flatten(), mx)
-            return tt.square(dmean.flatten())
-
-        def dM2_f(beta, hyp, X):
-            # iterate over training inputs
-            dM2_o, updts = theano.scan(fn=dM2_f_i, sequences=[X],
-                                       non_sequences=[beta, hyp, X],
-                                       allow_gc=False)
-            return dM2_o
-
-        # iterate over output dimensions
-        dM2, updts = theano.scan(fn=dM2_f, sequences=[self.beta, self.hyp],
-                                 non_sequences=[self.X], allow_gc=False)
+        # E x N x N kernel matrices (without noise) times beta
+        K = self.training_kernel(self.hyp)
+        Kb = K*self.beta[:, None, :]
+
+        # E x N x D derivatives of the mean function at the training inputs
+        lscales = self.hyp[:, :idims]
+        dM = tt.dot(Kb, self.X) - Kb.sum(2)[:, :, None]*self.X[None, :, :]
+        dM = dM/tt.square(lscales)[:, None, :]
 
         # update the nigp parameter using the derivative of the mean function
-        nigp = ((dM2[:, :, :, None]*self.X_cov[None]).sum(2)*dM2).sum(-1)
-        nigp_updts = updts + (self.nigp, nigp)
+        nigp = ((dM[:, :, :, None]*self.X_cov[None]).sum(2)*dM).sum(-1)
+        nigp_updts = [(self.nigp, nigp)]
 
         return nigp_updts
 
+    def nlml_batched(self):
+        ''' Returns the inverse kernel matrices, their cholesky factors and
+        the product of the inverse kernel matrices with the targets for all
+        output dimensions, computed as 3d tensor operations'''
+        idims = self.D
+        N = self.X.shape[0]
+        hyps = (self.hyp[:, :idims+1], self.hyp[:, idims+1])
+        kernel_func = partial(cov.Sum_batched, hyps, self.batched_covs)
+
+        # E x N x N kernel matrices
+        if self.pairwise_cache is not None:
+            K = self.training_kernel(self.hyp)
+            K += cov.Noise_batched(self.hyp[:, idims+1], self.X)
+        else:
+            K = kernel_func(self.X)
+
+        # add the contribution from the input noise
+        if self.nigp:
+            K += self.nigp[:, :, None]*tt.eye(N)
+        # add the contribution from the output uncertainty (acts as weight)
+        if self.Y_var:
+            K += self.Y_var.T[:, :, None]*tt.eye(N)
+
+        # compute chol(K), in float64 if using mixed precision
+        K = self.upcast(K) + self.jitter*tt.eye(N)
+        L = utils.linalg.batched_cholesky(K)
+
+        # compute K^-1 and (K^-1)dot(y). If we are not caching K^-1, we
+        # solve only for (K^-1)dot(y), and iK has no columns
+        if self.cache_iK:
+            EyeN = tt.tile(tt.eye(N)[None, :, :], (self.E, 1, 1))
+        else:
+            EyeN = tt.zeros((self.E, N, 0))
+        EyeN = tt.unbroadcast(EyeN, 0)
+        rhs = tt.concatenate([EyeN, self.Y.T[:, :, None]], axis=2)
+        sol = utils.linalg.batched_cho_solve(L, self.upcast(rhs))
+        iK = sol[:, :, :-1]
+        beta = sol[:, :, -1]
+
+        return iK, L, beta
+
+    def kernel_matvec(self, V):
+        ''' Returns the E x N x R products (K + sn2*I) V, where K are the
+        kernel matrices of the training inputs. The kernel matrices are
+        evaluated in blocks of self.cg_block_size rows, so that only
+        E x cg_block_size x N matrices are kept in memory'''
+        idims = self.D
+        N = self.X.shape[0]
+        B = self.cg_block_size
+        n_blocks = (N + B - 1)//B
+        # pad the inputs to a multiple of the block size
+        idx = tt.arange(n_blocks*B) % N
+        X_blocks = self.X[idx].reshape((n_blocks, B, idims))
+
+        def block_matvec(Xb, V, hyp, X):
+            Kb = cov.SEard_batched(hyp[:, :idims+1], Xb, X)
+            return tt.batched_dot(Kb, V)
+
+        KV, updts = theano.scan(
+            fn=block_matvec, sequences=[X_blocks],
+            non_sequences=[V, self.hyp, self.X],
+            name='%s>kernel_matvec' % (self.name))
+        KV = KV.transpose(1, 0, 2, 3).reshape(
+            (self.E, n_blocks*B, V.shape[2]))[:, :N]
+        sn2 = self.hyp[:, idims+1]**2
+        return KV + sn2[:, None, None]*V
+
+    def sample_cg_probes(self):
+        ''' Returns E x N x cg_probes rademacher vectors, used for
+        estimating the log determinants and their derivatives'''
+        Z = 2*np.random.randint(2, size=(self.E, self.N, self.cg_probes)) - 1
+        return Z.astype(floatX)
+
+    def get_cg_loss(self, cache_intermediate=True):
+        ''' Returns the negative log marginal likelihood, where the
+        linear solves are done with batched conjugate gradients and the
+        log determinants are estimated with stochastic Lanczos quadrature
+        (Gardner et al 2018). The kernel matrices are only accessed through
+        matrix-vector products, so memory is O(E N cg_block_size). The
+        returned loss is a surrogate, whose value is the estimated negative
+        log marginal likelihood and whose gradient is
+        0.5*(tr(K^-1 dK) - beta^T dK beta), with the trace estimated by
+        Hutchinson's method using the same probe vectors'''
+        msg = 'Building conjugate gradients GP loss'
+        utils.print_with_stamp(msg, self.name)
+        idims = self.D
+        N = self.X.shape[0].astype(floatX)
+        if self.cg_Z is None:
+            self.cg_Z = S(self.sample_cg_probes(),
+                          name='%s>cg_Z' % (self.name))
+        Z = self.cg_Z
+        no_grad = theano.gradient.disconnected_grad
+
+        # solve K [beta, U] = [Y, Z]
+        rhs = tt.concatenate([self.Y.T[:, :, None], Z], axis=2)
+        sol, alpha, cg_beta = utils.linalg.batched_cg(
+            self.kernel_matvec, rhs, self.cg_iters)
+        sol = no_grad(sol)
+        beta, U = sol[:, :, 0], sol[:, :, 1:]
+        logdet = utils.linalg.lanczos_logdet(
+            no_grad(alpha[:, :, 1:]), no_grad(cg_beta[:, :, 1:]),
+            tt.sum(Z**2, 1))
+
+        # K [beta, Z]; the only terms that depend on the hyperparameters
+        KV = self.kernel_matvec(tt.concatenate([beta[:, :, None], Z], 2))
+        data_fit = tt.sum(self.Y.T*beta, 1)
+        data_fit -= 0.5*tt.sum(beta*KV[:, :, 0], 1)
+        logdet_grad = tt.sum(U*KV[:, :, 1:], 1).mean(1)
+        logdet += logdet_grad - no_grad(logdet_grad)
+
+        loss = data_fit + 0.5*logdet + 0.5*N*tt.log(2*np.pi)
+
+        if cache_intermediate:
+            shared = tt.sharedvar.SharedVariable
+            if not isinstance(self.beta, shared):
+                self.beta = S(np.ones((self.E, self.N), dtype=floatX),
+                              name="%s>beta" % (self.name))
+            updts = [(self.beta, beta)]
+        else:
+            self.beta = beta
+            updts = None
+
+        # we add some penalty to avoid having parameters that are too large
+        if self.snr_penalty is not None:
+            penalty_params = {'log_snr': np.log(1000, dtype=floatX),
+                              'log_ls': np.log(100, dtype=floatX),
+                              'log_std': tt.log(self.X.std(0)*(N/(N-1.0))),
+                              'p': 30}
+            loss += self.snr_penalty(tt.log(self.hyp), **penalty_params)
+        inps = []
+        self.state_changed = True  # for saving
+        return loss.sum(), inps, updts
+
     def get_loss(self, unroll_scan=False, cache_intermediate=True):
+        # build the pairwise difference cache before building the graphs
+        if self.pairwise_cache is not None and self.X_sqdist is None\
+                and self.pairwise_cache_mode is None:
+            self.update_pairwise_cache()
+        # the graphs below use the current shared variables
+        self.should_recompile = False
+        if self.cg_loss:
+            return self.get_cg_loss(cache_intermediate=cache_intermediate)
         msg = 'Building full GP loss'
         utils.print_with_stamp(msg, self.name)
         idims = self.D
         N = self.X.shape[0].astype(floatX)
-
-        def nlml(Y, hyp, i, X, EyeN, nigp=None, y_var=None):
+        use_sqdist = self.X_sqdist is not None
+
+        def nlml(Y, hyp, i, X, EyeN, jitter, *args):
+            args = list(args)
+            sqdist = args[:2] if use_sqdist else []
+            args = args[2:] if use_sqdist else args
+            nigp = args.pop(0) if self.nigp else None
+            y_var = args.pop(0) if self.Y_var else None
             # initialise the (before compilation) kernel function
             hyps = (hyp[:idims+1], hyp[idims+1])
             kernel_func = partial(cov.Sum, hyps, self.covs)
 
             # We initialise the kernel matrices (one for each output dimension)
-            K = kernel_func(X)
+            if use_sqdist:
+                K = self.training_kernel(hyp[None, :], X, *sqdist)[0]
+                K += tt.eye(X.shape[0])*hyp[idims+1]**2
+            else:
+                K = kernel_func(X)
 
             # add the contribution from the input noise
             if nigp:
@@ -230,56 +720,76 @@ class GP(BaseRegressor):
             if y_var:
                 K += tt.diag(y_var[i])
 
-            # compute chol(K)
+            # compute chol(K), in float64 if using mixed precision
+            K = self.upcast(K) + jitter*tt.eye(X.shape[0])
             L = Cholesky()(K)
 
             # compute K^-1 and (K^-1)dot(y)
-            rhs = tt.concatenate([EyeN, Y[:, None]], axis=1)
+            rhs = self.upcast(tt.concatenate([EyeN, Y[:, None]], axis=1))
             sol = solve_upper_triangular(L.T, solve_lower_triangular(L, rhs))
             iK = sol[:, :-1]
             beta = sol[:, -1]
 
             return iK, L, beta
 
-        nseq = [self.X, tt.eye(self.X.shape[0])]
-        if self.nigp:
-            nseq.append(self.nigp)
-        if self.Y_var:
-            nseq.append(self.Y_var.T)
-
-        seq = [self.Y.T, self.hyp, tt.arange(self.X.shape[0])]
-
-        if unroll_scan:
-            from lasagne.utils import unroll_scan
-            [iK, L, beta] = unroll_scan(nlml, seq, [], nseq, self.E)
+        if self.batched_loss:
+            iK, L, beta = self.nlml_batched()
             updts = {}
         else:
-            (iK, L, beta), updts = theano.scan(
-                fn=nlml, sequences=seq, non_sequences=nseq, allow_gc=False,
-                strict=True, return_list=True,
-                name="%s>logL_scan" % (self.name))
+            # if we are not caching K^-1, we solve only for (K^-1)dot(y)
+            if self.cache_iK:
+                nseq = [self.X, tt.eye(self.X.shape[0])]
+            else:
+                nseq = [self.X, tt.zeros((self.X.shape[0], 0))]
+            nseq.append(self.jitter)
+            if use_sqdist:
+                nseq.extend([self.X_sqdist, self.X_sqdist_idx])
+            if self.nigp:
+                nseq.append(self.nigp)
+            if self.Y_var:
+                nseq.append(self.Y_var.T)
+
+            seq = [self.Y.T, self.hyp, tt.arange(self.X.shape[0])]
+
+            if unroll_scan:
+                from lasagne.utils import unroll_scan
+                [iK, L, beta] = unroll_scan(nlml, seq, [], nseq, self.E)
+                updts = {}
+            else:
+                (iK, L, beta), updts = theano.scan(
+                    fn=nlml, sequences=seq, non_sequences=nseq,
+                    allow_gc=False, strict=True, return_list=True,
+                    name="%s>logL_scan" % (self.name))
 
         # And finally, the negative log marginal likelihood
         loss = 0.5*tt.sum(self.Y.T*beta, 1)
         idx = [theano.tensor.arange(L.shape[i]) for i in [1, 2]]
         loss += tt.sum(tt.log(L[:, idx[0], idx[1]]), 1)
         loss += 0.5*N*tt.log(2*np.pi)
+        # the factorizations are kept in floatX
+        loss = self.downcast(loss)
+        iK, L, beta = self.downcast(iK), self.downcast(L), self.downcast(beta)
 
         if cache_intermediate:
             # we are going to save the intermediate results in the following
             # shared variables, so we can use them during prediction without
             # having to recompute them
             N, E = self.N, self.E
-            if type(self.iK) is not tt.sharedvar.SharedVariable:
-                self.iK = S(np.tile(np.eye(N, dtype=floatX), (E, 1, 1)),
-                            name="%s>iK" % (self.name))
-            if type(self.L) is not tt.sharedvar.SharedVariable:
+            shared = tt.sharedvar.SharedVariable
+            if not isinstance(self.L, shared):
                 self.L = S(np.tile(np.eye(N, dtype=floatX), (E, 1, 1)),
                            name="%s>L" % (self.name))
-            if type(self.beta) is not tt.sharedvar.SharedVariable:
+            if not isinstance(self.beta, shared):
                 self.beta = S(np.ones((E, N), dtype=floatX),
                               name="%s>beta" % (self.name))
-            updts = [(self.iK, iK), (self.L, L), (self.beta, beta)]
+            updts = [(self.L, L), (self.beta, beta)]
+            if self.cache_iK:
+                if not isinstance(self.iK, shared):
+                    self.iK = S(np.tile(np.eye(N, dtype=floatX), (E, 1, 1)),
+                                name="%s>iK" % (self.name))
+                updts.append((self.iK, iK))
+            else:
+                self.iK = None
         else:
             # save intermediate graphs (in case we require grads wrt params)
             self.iK, self.L, self.beta = iK, L, beta
@@ -296,26 +806,140 @@ class GP(BaseRegressor):
         self.state_changed = True  # for saving
         return loss.sum(), inps, updts
 
-    def predict(self, mx, Sx, **kwargs):
-        idims = self.D
+    def predict(self, mx, Sx=None, **kwargs):
+        if self.cg_loss:
+            return self.predict_cg(mx)
+        if self.beta is None or self.L is None:
+            self.update_cached_factorization()
 
-        # compute the mean and variance for each output dimension
-        def predict_odim(L, beta, hyp, X, mx):
-            hyps = (hyp[:idims+1], hyp[idims+1])
-            kernel_func = partial(cov.Sum, hyps, self.covs)
+        M, S = self.predict_batched(mx[None, :] if mx.ndim == 1 else mx)
+        if mx.ndim == 2:
+            return M, S
 
-            k = kernel_func(mx[None, :], X)
-            mean = k.dot(beta)
-            kc = solve_lower_triangular(L, k.flatten())
-            variance = kernel_func(mx[None, :], all_pairs=False) - kc.dot(kc)
+        # reshape output variables
+        M = M.flatten()
+        S = tt.diag(S.flatten())
+        V = tt.zeros((self.D, self.E))
 
-            return mean, variance
+        return M, S, V
 
-        (M, S), updts = theano.scan(fn=predict_odim,
-                                    sequences=[self.L, self.beta, self.hyp],
-                                    non_sequences=[self.X, mx],
-                                    allow_gc=False,
-                                    name='%s>predict_scan' % (self.name))
+    def predict_batched(self, X):
+        ''' Returns the n x E predictive means and variances (including the
+        observation noise) at the n x D (deterministic) inputs X, for all
+        output dimensions at once
+        @param X n x D test inputs
+        @return the tuple (M, S)
+        '''
+        idims = self.D
+        sf2 = self.hyp[:, idims]**2
+        sn2 = self.hyp[:, idims+1]**2
+
+        # E x N x n kernel matrices between training and test inputs
+        k = cov.SEard_batched(self.hyp[:, :idims+1], self.X, X)
+        M = (k*self.beta[:, :, None]).sum(1)
+        if self.iK is not None:
+            iKk = tt.batched_dot(self.iK, k)
+            S = sf2[:, None] + sn2[:, None] - (k*iKk).sum(1)
+        else:
+            kc = utils.linalg.batched_solve_lower_triangular(
+                self.upcast(self.L), self.upcast(k))
+            S = sf2[:, None] + sn2[:, None] - self.downcast((kc**2).sum(1))
+
+        return M.T, S.T
+
+    def update_inference_cache(self):
+        ''' Precomputes (as numpy arrays) everything that deterministic
+        predictions need from the training inputs, beta, the cholesky factors
+        and the hyperparameters. This is used by fast_predict, which skips
+        the theano function call overhead. Call this after changing the
+        parameters (it is invalidated after training and on set_dataset).
+        Raises NotImplementedError for models that do not support it (see
+        supports_fast_predict) or that are trained with cg_loss'''
+        idims = self.D
+        if not self.supports_fast_predict:
+            raise NotImplementedError(
+                'fast_predict is not implemented for %s; use predict' % (
+                    self.__class__.__name__))
+        if self.cg_loss:
+            # these would need the dense cholesky factors, which are never
+            # computed with the matrix-free loss
+            raise NotImplementedError(
+                'fast_predict is not supported with cg_loss; use predict')
+        if self.beta is None or self.L is None:
+            self.update_cached_factorization()
+
+        # the factors may be symbolic (e.g. for RBF policies); we evaluate
+        # them with a single function, so that their common subgraphs (e.g.
+        # the cholesky factorization) are only computed once
+        factors = [self.hyp, self.beta, self.L]
+        cached_fn = getattr(self, 'inference_cache_fn', None)
+        if cached_fn is None or any(
+                a is not b for a, b in zip(cached_fn[0], factors)):
+            fn = F([], factors, name='%s>inference_cache' % (self.name),
+                   allow_input_downcast=True)
+            self.inference_cache_fn = (factors, fn)
+        hyp, beta, L = self.inference_cache_fn[1]()
+        X = self.X.get_value()
+        iL = 1.0/hyp[:, :idims]
+        Xs = X[None, :, :]*iL[:, None, :]
+        # L^-1, so that the variances need a matrix product instead of a
+        # triangular solve per query
+        eyeN = np.eye(L.shape[1], dtype=L.dtype)
+        iLchol = np.array([scipy.linalg.solve_triangular(Li, eyeN, lower=True)
+                           for Li in L])
+        self.inference_cache = {
+            'iL': iL, 'Xs': Xs, 'Xs_sq': (Xs**2).sum(-1), 'beta': beta,
+            'iLchol': iLchol, 'sf2': hyp[:, idims]**2,
+            'sn2': hyp[:, idims+1]**2}
+
+    def fast_predict(self, x, return_variance=True):
+        ''' Deterministic predictions, evaluated with numpy from the
+        inference cache (built on the first call)
+        @param x D input vector or n x D matrix of inputs
+        @param return_variance whether to compute the predictive variances
+        @return the n x E predictive means (and variances, including the
+                observation noise), or E vectors if x is a vector
+        '''
+        if self.inference_cache is None:
+            self.update_inference_cache()
+        c = self.inference_cache
+        X = np.atleast_2d(x)
+
+        # E x N x n kernel matrices between training and test inputs
+        xs = X[None, :, :]*c['iL'][:, None, :]
+        r2 = c['Xs_sq'][:, :, None] + (xs**2).sum(-1)[:, None, :]
+        r2 -= 2*np.matmul(c['Xs'], xs.transpose(0, 2, 1))
+        k = c['sf2'][:, None, None]*np.exp(-0.5*np.maximum(r2, 0))
+        M = np.einsum('en,enm->me', c['beta'], k)
+        M = M[0] if x.ndim == 1 else M
+        if not return_variance:
+            return M
+
+        iLk = np.matmul(c['iLchol'], k)
+        S = c['sf2'] + c['sn2'] - (iLk**2).sum(1).T
+        S = S[0] if x.ndim == 1 else S
+        return M, S
+
+    def predict_cg(self, mx):
+        ''' Deterministic predictions, where the predictive variances are
+        computed with conjugate gradients instead of the cholesky factors'''
+        idims = self.D
+        sf2 = self.hyp[:, idims]**2
+        sn2 = self.hyp[:, idims+1]**2
+        x = mx[None, :] if mx.ndim == 1 else mx
+        beta = self.beta
+        if beta is None:
+            # not trained yet; solve for beta with conjugate gradients
+            beta, alpha, cg_beta = utils.linalg.batched_cg(
+                self.kernel_matvec, self.Y.T[:, :, None], self.cg_iters)
+            beta = beta[:, :, 0]
+        k = cov.SEard_batched(self.hyp[:, :idims+1], self.X, x)
+        M = (k*beta[:, :, None]).sum(1)
+        iKk, alpha, beta = utils.linalg.batched_cg(
+            self.kernel_matvec, k, self.cg_iters)
+        S = sf2[:, None] + sn2[:, None] - (k*iKk).sum(1)
+        if mx.ndim == 2:
+            return M.T, S.T
 
         # reshape output variables
         M = M.flatten()
@@ -325,6 +949,9 @@ class GP(BaseRegressor):
         return M, S, V
 
     def train(self, optimizer=None, callback=None):
+        if self.n_restarts > 1 and self.X_cov is None:
+            return self.train_multistart(optimizer, callback)
+
         if optimizer is None:
             optimizer = self.optimizer
 
@@ -333,9 +960,11 @@ class GP(BaseRegressor):
             optimizer.set_objective(loss, self.get_params(symbolic=True),
                                     inps, updts)
 
-        if self.X_cov and not hasattr(self, 'nigp_fn'):
+        if self.X_cov is not None and getattr(self, 'nigp_fn', None) is None:
             nigp_updts = self.nigp_updates()
-            self.nigp_fn = F([], [], updates=updts+nigp_updts,
+            # the mean function uses the beta that was cached on the last
+            # evaluation of the loss
+            self.nigp_fn = F([], [], updates=nigp_updts,
                              name='%s>dM2' % (self.name),
                              allow_input_downcast=True)
 
@@ -357,24 +986,225 @@ class GP(BaseRegressor):
             else:
                 callback = nigp_cb
 
-        optimizer.minimize(callback=callback)
+        jitter_tries = [0]
+
+        def on_failure(e):
+            # the kernel matrices are not numerically positive definite at
+            # the parameters visited by the optimizer; escalate the jitter and
+            # let the optimizer restart from its best parameters
+            if not isinstance(e, np.linalg.LinAlgError)\
+                    or jitter_tries[0] >= self.max_jitter_tries:
+                return False
+            jitter_tries[0] += 1
+            self.increase_jitter()
+            return True
+
+        while True:
+            try:
+                optimizer.minimize(callback=callback, on_failure=on_failure)
+                break
+            except np.linalg.LinAlgError as e:
+                # failure at the initial parameters, before the optimizer
+                # started; retry with a larger jitter
+                if not on_failure(e):
+                    raise
         self.trained = True
+        # the inference cache will be rebuilt on the next fast prediction
+        self.inference_cache = None
+
+    def train_multistart(self, optimizer=None, callback=None):
+        ''' Runs self.n_restarts independent hyperparameter optimizations
+        and keeps the parameters with the lowest loss. The first restart
+        starts from the current parameters, the rest from the points returned
+        by sample_restart_params. If self.n_workers is not 1, the restarts
+        are run in a pool of forked processes, which share the compiled loss
+        function. The index, loss and elapsed time of every restart are
+        stored in self.restart_results'''
+        global _multistart_state
+        if optimizer is None:
+            optimizer = self.optimizer
+        if optimizer.loss_fn is None or self.should_recompile:
+            loss, inps, updts = self.get_loss()
+            optimizer.set_objective(loss, self.get_params(symbolic=True),
+                                    inps, updts)
+
+        params0 = self.get_params(as_dict=True, ignore_fixed=False)
+        seeds = np.random.randint(2**31 - 1, size=self.n_restarts)
+        restarts = [(0, params0, seeds[0])]
+        for i in range(1, self.n_restarts):
+            restarts.append((i, self.sample_restart_params(), seeds[i]))
+
+        n_workers = self.n_workers
+        if n_workers is None:
+            n_workers = min(self.n_restarts, multiprocessing.cpu_count())
+        msg = 'Training with %d restarts (%d workers)'
+        utils.print_with_stamp(msg % (self.n_restarts, n_workers), self.name)
+
+        _multistart_state = (self, optimizer, callback)
+        try:
+            if n_workers > 1:
+                ctx = multiprocessing.get_context('fork')
+                pool = ctx.Pool(n_workers)
+                try:
+                    results = pool.map(_multistart_worker, restarts)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [_multistart_worker(r) for r in restarts]
+        finally:
+            _multistart_state = None
+
+        # keep the best parameters, and update the cached intermediate values
+        best = min(results, key=lambda r: r[1])
+        self.set_params(best[2])
+        optimizer.loss_fn()
+        self.restart_results = [(i, loss, t) for i, loss, p, t in results]
+        for i, loss, t in self.restart_results:
+            msg = 'Restart %d: loss [%f], time [%f s]'
+            utils.print_with_stamp(msg % (i, loss, t), self.name)
+        msg = 'Best restart: %d, loss [%f]'
+        utils.print_with_stamp(msg % (best[0], best[1]), self.name)
+        self.trained = True
+        self.inference_cache = None
 
 
 class GP_UI(GP):
     ''' Gaussian process with uncertain inputs (Deisenroth et al  2009)'''
     def __init__(self, X_dataset=None, Y_dataset=None, name='GP_UI',
                  idims=None, odims=None, **kwargs):
+        if kwargs.get('cg_loss', False):
+            # moment matching needs the inverse kernel matrices (or their
+            # cholesky factors), which the matrix-free loss avoids computing
+            raise ValueError(
+                'cg_loss is not supported for %s, since moment matching '
+                'requires the dense N x N factorizations. Use GP with '
+                'cg_loss for deterministic inputs, or a sparse model (SPGP, '
+                'SVGP) for large datasets' % (self.__class__.__name__))
         super(GP_UI, self).__init__(
             X_dataset, Y_dataset, name=name, idims=idims, odims=odims,
             **kwargs)
 
-    def predict(self, mx, Sx, unroll_scan=False, **kwargs):
+    def first_moments(self, iL, inp, Sx, sf2, beta):
+        ''' Returns the predictive mean and the input-output covariance
+        (times the inverse input covariance), as in Deisenroth's thesis, for
+        all the output dimensions at once. The matrices
+        B = iL Sx iL + I are symmetric positive definite, so the solves and
+        determinants are computed via a batched cholesky decomposition.
+        @param iL E x D x D inverse lengthscale matrices
+        @param inp E x N x D scaled centralized training inputs
+        @param Sx D x D input covariance
+        @param sf2 E signal variances
+        @param beta E x N vectors of weights for the kernel functions
+        @return the tuple (M, V)
+        '''
+        idims = self.D
+        iLdotSx = iL.dot(Sx)
+        B = (iLdotSx[:, :, None, :]*iL[:, None, :, :]).sum(-1) + tt.eye(idims)
+        LB = utils.linalg.batched_cholesky(self.upcast(B))
+        t = utils.linalg.batched_cho_solve(
+            LB, self.upcast(inp.transpose(0, 2, 1))).transpose(0, 2, 1)
+        t = self.downcast(t)
+        logdetB = 2*tt.log(utils.linalg.batched_diagonal(LB)).sum(1)
+        logdetB = self.downcast(logdetB)
+        c = sf2*tt.exp(-0.5*logdetB)
+        l = tt.exp(-0.5*tt.sum(inp*t, 2))
+        lb = l*beta
+        M = tt.sum(lb, 1)*c
+
+        # input output covariance
+        tiL = (t[:, :, None, :]*iL[:, None, :, :]).sum(-1)
+        V = tt.batched_dot(lb, tiL).T*c
+        return M, V
+
+    def output_pairs(self):
+        ''' Returns the output indices (i, j) of the pairs in the upper
+        triangle of the predictive covariance, with the diagonal (i, i)
+        pairs first.
+        @return the tuple of numpy arrays (i, j)
+        '''
+        odims = self.E
+        triu_i, triu_j = np.triu_indices(odims, 1)
+        i = np.concatenate([np.arange(odims), triu_i])
+        j = np.concatenate([np.arange(odims), triu_j])
+        return i, j
+
+    def second_moments(self, Lambda, logk, z_, Sx, pairs=None):
+        ''' Returns the matrices Q_ij from Deisenroth's thesis (Eqs 2.51-2.54)
+        for every output pair (i, j), with i <= j; as a P x N x N tensor,
+        where P = E*(E+1)/2. The pairs are ordered so that the diagonal
+        (i, i) pairs come first. Since the Lambda matrices are diagonal, we
+        compute the R_ij matrices via the symmetric positive definite
+        matrices I + Lambda_ij^1/2 Sx Lambda_ij^1/2, so that all the
+        pairs are handled with a single batched cholesky decomposition.
+        @param Lambda E x D x D inverse squared lengthscales
+        @param logk E x N log kernel values at the input mean
+        @param z_ E x N x D scaled centralized training inputs
+        @param Sx D x D input covariance
+        @param pairs optional tuple (i, j) of index vectors into the first
+               dimension of Lambda, logk and z_. If None, the pairs given by
+               output_pairs are used
+        @return the tuple (Q, i, j), where i and j are the index vectors
+                for every pair
+        '''
+        i, j = self.output_pairs() if pairs is None else pairs
+
+        # Lambda_ij^1/2
+        lambdas = utils.linalg.batched_diagonal(Lambda)
+        sq = tt.sqrt(lambdas[i] + lambdas[j])
+        sqSx = sq[:, :, None]*Sx
+        A = sqSx*sq[:, None, :] + tt.eye(Sx.shape[0])
+        L = utils.linalg.batched_cholesky(self.upcast(A))
+
+        # log(det(R_ij)) = log(det(A_ij))
+        logdetR = 2*tt.log(utils.linalg.batched_diagonal(L)).sum(1)
+        logdetR = self.downcast(logdetR)
+
+        # solve(R_ij, Sx) = Sx - Sx Lambda_ij^1/2 A_ij^-1 Lambda_ij^1/2 Sx
+        iLsqSx = utils.linalg.batched_solve_lower_triangular(
+            L, self.upcast(sqSx))
+        iLsqSx = self.downcast(iLsqSx)
+        iRSx = Sx - tt.batched_dot(iLsqSx.transpose(0, 2, 1), iLsqSx)
+
+        # maha(z_i, -z_j, 0.5*solve(R_ij, Sx)) for all pairs
+        zi, zj = z_[i], z_[j]
+        ziM = tt.batched_dot(zi, 0.5*iRSx)
+        zjM = tt.batched_dot(zj, 0.5*iRSx)
+        n2 = (ziM*zi).sum(-1)[:, :, None] + (zjM*zj).sum(-1)[:, None, :]
+        n2 += 2*tt.batched_dot(ziM, zj.transpose(0, 2, 1))
+        n2 += logk[i][:, :, None] + logk[j][:, None, :]
+
+        Q = tt.exp(n2 - 0.5*logdetR[:, None, None])
+        return Q, i, j
+
+    def predict(self, mx, Sx=None, unroll_scan=False, **kwargs):
+        if Sx is None:
+            # deterministic inputs
+            return super(GP_UI, self).predict(mx, **kwargs)
+        if self.beta is None or self.L is None or (
+                self.cache_iK and self.iK is None):
+            self.update_cached_factorization()
+        return self.moment_matching(self.X, self.beta, self.iK, mx, Sx,
+                                    L=self.L)
+
+    def moment_matching(self, X, beta, iK, mx, Sx, L=None):
+        ''' Returns the predictive mean and covariance, and the input output
+        covariance (times the inverse input covariance), of a GP with
+        training inputs X, weights beta and inverse kernel matrices iK,
+        evaluated at a gaussian input with mean mx and covariance Sx.
+        @param X N x D training inputs
+        @param beta E x N vectors of weights for the kernel functions
+        @param iK E x N x N inverse kernel matrices. If None, the products
+               with the inverse kernel matrices are computed with triangular
+               solves, using the cholesky factors L
+        @param L E x N x N cholesky factors of the kernel matrices
+        @return the tuple (M, S, V)
+        '''
         idims = self.D
         odims = self.E
 
         # centralize inputs
-        zeta = self.X - mx
+        zeta = X - mx
 
         # initialize some variables
         sf2 = self.hyp[:, idims]**2
@@ -382,68 +1212,32 @@ class GP_UI(GP):
         lscales = self.hyp[:, :idims]
         iL = eyeE/lscales.dimshuffle(0, 1, 'x')
 
-        # predictive mean
+        # predictive mean and input output covariance
         inp = iL.dot(zeta.T).transpose(0, 2, 1)
-        iLdotSx = iL.dot(Sx)
-        # TODO vectorize this
-        B = (iLdotSx[:, :, None, :]*iL[:, None, :, :]).sum(-1) + tt.eye(idims)
-        t = tt.stack([solve(B[i].T, inp[i].T).T for i in range(odims)])
-        c = sf2/tt.sqrt(tt.stack([det(B[i]) for i in range(odims)]))
-        l = tt.exp(-0.5*tt.sum(inp*t, 2))
-        lb = l*self.beta  # E x N dot E x N
-        M = tt.sum(lb, 1)*c
-
-        # input output covariance
-        tiL = (t[:, :, None, :]*iL[:, None, :, :]).sum(-1)
-        # tiL = tt.stack([t[i].dot(iL[i]) for i in range(odims)])
-        V = tt.stack([tiL[i].T.dot(lb[i]) for i in range(odims)]).T*c
+        M, V = self.first_moments(iL, inp, Sx, sf2, beta)
 
         # predictive covariance
         logk = (tt.log(sf2))[:, None] - 0.5*tt.sum(inp*inp, 2)
-        logk_r = logk.dimshuffle(0, 'x', 1)
-        logk_c = logk.dimshuffle(0, 1, 'x')
         Lambda = tt.square(iL)
-        LL = (Lambda.dimshuffle(0, 'x', 1, 2) + Lambda).transpose(0, 1, 3, 2)
-        R = tt.dot(LL, Sx).transpose(0, 1, 3, 2) + tt.eye(idims)
         z_ = Lambda.dot(zeta.T).transpose(0, 2, 1)
 
-        M2 = tt.zeros((odims, odims))
-
-        # initialize indices
-        triu_indices = np.triu_indices(odims)
-        indices = [tt.as_index_variable(idx) for idx in triu_indices]
-
-        def second_moments(i, j, M2, beta, iK, sf2, R, logk_c, logk_r, z_, Sx, *args):
-            # This comes from Deisenroth's thesis ( Eqs 2.51- 2.54 )
-            Rij = R[i, j]
-            n2 = logk_c[i] + logk_r[j]
-            n2 += utils.maha(z_[i], -z_[j], 0.5*solve(Rij, Sx))
-
-            Q = tt.exp(n2)/tt.sqrt(det(Rij))
-
-            # Eq 2.55
-            m2 = matrix_dot(beta[i], Q, beta[j])
-
-            m2 = theano.ifelse.ifelse(
-                tt.eq(i, j), m2 - tt.sum(iK[i]*Q) + sf2[i], m2)
-            M2 = tt.set_subtensor(M2[i, j], m2)
-            return M2
-
-        nseq = [self.beta, self.iK, sf2, R, logk_c, logk_r, z_, Sx, self.L]
-        if unroll_scan:
-            from lasagne.utils import unroll_scan
-            [M2_] = unroll_scan(second_moments, indices,
-                                [M2], nseq, len(triu_indices[0]))
-            updts = {}
+        # Eq 2.55, for all the (i, j) output pairs in the upper triangle
+        Q, i, j = self.second_moments(Lambda, logk, z_, Sx)
+        m2 = (beta[i][:, :, None]*Q*beta[j][:, None, :]).sum((1, 2))
+        # the diagonal pairs come first in i, j
+        if iK is None:
+            # tr(iK Q) = tr(L^-1 Q L^-T)
+            L = self.upcast(L)
+            iLQ = utils.linalg.batched_solve_lower_triangular(
+                L, self.upcast(Q[:odims]))
+            iLQiLt = utils.linalg.batched_solve_lower_triangular(
+                L, utils.linalg.batched_transpose(iLQ))
+            tr_iKQ = utils.linalg.batched_diagonal(iLQiLt).sum(1)
+            tr_iKQ = self.downcast(tr_iKQ)
         else:
-            M2_, updts = theano.scan(fn=second_moments,
-                                     sequences=indices,
-                                     outputs_info=[M2],
-                                     non_sequences=nseq,
-                                     allow_gc=False,
-                                     strict=True,
-                                     name="%s>M2_scan" % (self.name))
-        M2 = M2_[-1]
+            tr_iKQ = (iK*Q[:odims]).sum((1, 2))
+        m2 = tt.inc_subtensor(m2[:odims], sf2 - tr_iKQ)
+        M2 = tt.set_subtensor(tt.zeros((odims, odims))[i, j], m2)
         M2 = M2 + tt.triu(M2, k=1).T
         S = M2 - tt.outer(M, M)
 
@@ -463,6 +1257,26 @@ class RBFGP(GP_UI):
         # register additional variables for saving
         self.register(['sat_func'])
         self.register(['iK', 'beta', 'L'])
+        self.sat_fn = None
+
+    def fast_predict(self, x, return_variance=True):
+        ''' Deterministic predictions, evaluated with numpy from the
+        inference cache. Returns the same outputs as the compiled
+        deterministic prediction function; i.e. the n x E (saturated) means
+        and the n x E noise standard deviations'''
+        M = super(RBFGP, self).fast_predict(np.atleast_2d(x), False)
+        if self.sat_func is not None:
+            # the saturating function is symbolic, so we compile it once
+            if self.sat_fn is None:
+                m = tt.matrix('%s>m' % (self.name))
+                self.sat_fn = F([m], self.sat_func(m),
+                                name='%s>sat_fn' % (self.name),
+                                allow_input_downcast=True)
+            M = self.sat_fn(M)
+        if not return_variance:
+            return M
+        sn = np.sqrt(self.inference_cache['sn2'])
+        return M, np.tile(sn, (M.shape[0], 1))
 
     def predict(self, mx, Sx=None, unroll_scan=False, **kwargs):
         idims = self.D
@@ -499,65 +1313,20 @@ class RBFGP(GP_UI):
         # centralize inputs
         zeta = self.X - mx
 
-        # predictive mean
+        # predictive mean and input output covariance
         inp = iL.dot(zeta.T).transpose(0, 2, 1)
-        iLdotSx = iL.dot(Sx)
-        B = (iLdotSx[:, :, None, :]*iL[:, None, :, :]).sum(-1) + tt.eye(idims)
-        t = tt.stack([solve(B[i].T, inp[i].T).T for i in range(odims)])
-        c = sf2/tt.sqrt(tt.stack([det(B[i]) for i in range(odims)]))
-        l = tt.exp(-0.5*tt.sum(inp*t, 2))
-        lb = l*self.beta
-        M = tt.sum(lb, 1)*c
-
-        # input output covariance
-        tiL = tt.stack([t[i].dot(iL[i]) for i in range(odims)])
-        V = tt.stack([tiL[i].T.dot(lb[i]) for i in range(odims)]).T*c
+        M, V = self.first_moments(iL, inp, Sx, sf2, self.beta)
 
         # predictive covariance
         logk = (tt.log(sf2))[:, None] - 0.5*tt.sum(inp*inp, 2)
-        logk_r = logk.dimshuffle(0, 'x', 1)
-        logk_c = logk.dimshuffle(0, 1, 'x')
         Lambda = tt.square(iL)
-        LL = (Lambda.dimshuffle(0, 'x', 1, 2) + Lambda).transpose(0, 1, 3, 2)
-        R = tt.dot(LL, Sx).transpose(0, 1, 3, 2) + tt.eye(idims)
         z_ = Lambda.dot(zeta.T).transpose(0, 2, 1)
 
-        M2 = tt.zeros((odims, odims))
-
-        # initialize indices
-        triu_indices = np.triu_indices(odims)
-        indices = [tt.as_index_variable(idx) for idx in triu_indices]
-
-        def second_moments(i, j, M2, beta, R, logk_c, logk_r, z_, Sx, *args):
-            # This comes from Deisenroth's thesis ( Eqs 2.51- 2.54 )
-            Rij = R[i, j]
-            n2 = logk_c[i] + logk_r[j]
-            n2 += utils.maha(z_[i], -z_[j], 0.5*solve(Rij, Sx))
-            Q = tt.exp(n2)/tt.sqrt(det(Rij))
-
-            # Eq 2.55
-            m2 = matrix_dot(beta[i], Q, beta[j])
-
-            m2 = theano.ifelse.ifelse(tt.eq(i, j), m2 + 1e-6, m2)
-            M2 = tt.set_subtensor(M2[i, j], m2)
-            return M2
-
-        nseq = [self.beta, R, logk_c, logk_r, z_, Sx, self.iK, self.L]
-
-        if unroll_scan:
-            from lasagne.utils import unroll_scan
-            [M2_] = unroll_scan(second_moments, indices,
-                                [M2], nseq, len(triu_indices[0]))
-            updts = {}
-        else:
-            M2_, updts = theano.scan(fn=second_moments,
-                                     sequences=indices,
-                                     outputs_info=[M2],
-                                     non_sequences=nseq,
-                                     allow_gc=False,
-                                     strict=True,
-                                     name="%s>M2_scan" % (self.name))
-        M2 = M2_[-1]
+        # Eq 2.55, for all the (i, j) output pairs in the upper triangle
+        Q, i, j = self.second_moments(Lambda, logk, z_, Sx)
+        m2 = (self.beta[i][:, :, None]*Q*self.beta[j][:, None, :]).sum((1, 2))
+        m2 = m2 + tt.cast(1e-6, floatX)*tt.eq(i, j)
+        M2 = tt.set_subtensor(tt.zeros((odims, odims))[i, j], m2)
         M2 = M2 + tt.triu(M2, k=1).T
         S = M2 - tt.outer(M, M)
 
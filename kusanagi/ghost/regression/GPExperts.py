@@ -0,0 +1,334 @@
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from theano import shared as S
+
+from kusanagi import utils
+from kusanagi.ghost.regression.GP import GP_UI
+floatX = theano.config.floatX
+
+
+class GPExperts(GP_UI):
+    ''' Product of local GP experts (Deisenroth and Ng 2015). The training
+    set is partitioned with k-means into K clusters of (at most) expert_size
+    samples, and each cluster is modelled by a GP. All the experts share the
+    same hyperparameters, which are trained by minimizing the sum of their
+    negative log marginal likelihoods, computed with batched linear algebra
+    ops. Predictions are combined with one of the following rules:
+    'rbcm' (robust Bayesian committee machine), 'bcm', 'gpoe' (generalized
+    product of experts with uniform weights) or 'poe'. The expert losses
+    are always computed with batched ops (batched_loss has no effect), and
+    support the mixed precision and jitter options of GP '''
+    supports_fast_predict = False
+
+    def __init__(self, X_dataset=None, Y_dataset=None, name='GPExperts',
+                 idims=None, odims=None, expert_size=256, method='rbcm',
+                 **kwargs):
+        if method not in ('rbcm', 'bcm', 'gpoe', 'poe'):
+            raise ValueError('Unknown combination method %s' % (method))
+        if kwargs.get('pairwise_cache') is not None:
+            # the experts evaluate their kernels from the partitioned inputs
+            raise ValueError(
+                'pairwise_cache is not supported by %s' % (
+                    self.__class__.__name__))
+        self.expert_size = expert_size
+        self.method = method
+        self.X_e = None  # K x n x D inputs of each expert
+        self.Y_e = None  # K x n x E targets of each expert
+        self.mask_e = None  # K x n, zero for the padding samples
+        GP_UI.__init__(self, X_dataset, Y_dataset, name=name, idims=idims,
+                       odims=odims, **kwargs)
+        self.register(['expert_size', 'method'])
+
+    def set_dataset(self, X_dataset, Y_dataset, X_cov=None, Y_var=None):
+        if X_cov is not None or Y_var is not None:
+            msg = 'X_cov and Y_var are not supported by %s'
+            raise ValueError(msg % (self.__class__.__name__))
+        super(GPExperts, self).set_dataset(X_dataset, Y_dataset)
+        self.partition_dataset()
+
+    def has_cached_factorization(self):
+        # the cached factors are per expert, so they can't be extended with
+        # the rank-H updates of the full GP
+        return False
+
+    def update_cached_factorization(self):
+        ''' Recomputes the cached factorizations of all the experts, for the
+        current hyperparameters, by evaluating the updates of the loss'''
+        utils.print_with_stamp('Updating cached factorization', self.name)
+        loss, inps, updts = self.get_loss()
+        fn = utils.function_cache.function(
+            [], [], updates=updts, allow_input_downcast=True,
+            name='%s>update_factorization' % (self.name))
+        fn()
+
+    def partition_dataset(self):
+        ''' Splits the training set into K = ceil(N/expert_size) clusters of
+        (almost) the same size. The cluster centers are found with
+        mini-batch k-means, and the samples are assigned in rounds: at round
+        r, every unassigned sample proposes to its r-th closest center,
+        which accepts the closest proposers until it is full. Since the
+        total capacity is at least N, every sample is assigned after at most
+        K rounds. The clusters are padded to the same size, so that the
+        losses of all experts can be computed as 3d tensor operations'''
+        X = self.X.get_value()
+        Y = self.Y.get_value()
+        N = X.shape[0]
+        K = int(np.ceil(N/float(self.expert_size)))
+        n = int(np.ceil(N/float(K)))
+        if K > 1:
+            centers = utils.kmeanspp(X, K)
+            centers = utils.minibatch_kmeans(X, centers)
+            d = (X**2).sum(1)[:, None] + (centers**2).sum(1)[None, :]\
+                - 2*X.dot(centers.T)
+            pref = np.argsort(d, 1)
+            counts = np.zeros(K, dtype=np.int64)
+            assignment = -np.ones(N, dtype=np.int64)
+            for r in range(K):
+                idx = np.where(assignment < 0)[0]
+                if idx.size == 0:
+                    break
+                k = pref[idx, r]
+                # group the proposers by center, closest first
+                order = np.lexsort((d[idx, k], k))
+                idx, k = idx[order], k[order]
+                rank = np.arange(k.size) - np.searchsorted(k, k)
+                accept = rank < (n - counts)[k]
+                assignment[idx[accept]] = k[accept]
+                counts += np.bincount(k[accept], minlength=K)
+            clusters = [np.where(assignment == k)[0] for k in range(K)]
+        else:
+            clusters = [np.arange(N)]
+        msg = 'Partitioned %d samples into %d experts'
+        utils.print_with_stamp(msg % (N, K), self.name)
+
+        # the padding samples are copies of the first sample of the cluster,
+        # masked out from the kernel matrices
+        X_e = np.empty((K, n, self.D), dtype=floatX)
+        Y_e = np.zeros((K, n, self.E), dtype=floatX)
+        mask_e = np.zeros((K, n), dtype=floatX)
+        for k, idx in enumerate(clusters):
+            X_e[k] = X[idx[0]]
+            X_e[k, :len(idx)] = X[idx]
+            Y_e[k, :len(idx)] = Y[idx]
+            mask_e[k, :len(idx)] = 1
+
+        if self.X_e is None:
+            self.X_e = S(X_e, name='%s>X_e' % (self.name), borrow=True)
+            self.Y_e = S(Y_e, name='%s>Y_e' % (self.name), borrow=True)
+            self.mask_e = S(mask_e, name='%s>mask_e' % (self.name),
+                            borrow=True)
+        else:
+            self.X_e.set_value(X_e, borrow=True)
+            self.Y_e.set_value(Y_e, borrow=True)
+            self.mask_e.set_value(mask_e, borrow=True)
+
+    def expert_kernel(self, X2=None):
+        ''' Returns the squared exponential kernels between the inputs of
+        each expert and X2 (or themselves, if X2 is None), as a
+        E*K x n x n2 tensor, where the first dimension indexes the
+        (output, expert) pairs. The padding samples are masked out'''
+        idims = self.D
+        K, n = self.X_e.shape[0], self.X_e.shape[1]
+        sf2 = self.hyp[:, idims]**2
+        ls = self.hyp[:, :idims]
+        X1s = self.X_e[None, :, :, :]/ls[:, None, None, :]
+        if X2 is None:
+            X2s = X1s
+        else:
+            X2s = X2[None, None, :, :]/ls[:, None, None, :]
+            X2s += tt.addbroadcast(tt.zeros_like(X1s[:, :, :1, :]), 2)
+        X1s = X1s.reshape((self.E*K, n, idims))
+        X2s = X2s.reshape((self.E*K, X2s.shape[2], idims))
+        D = tt.sum(tt.square(X1s), 2)[:, :, None]\
+            + tt.sum(tt.square(X2s), 2)[:, None, :]\
+            - 2*tt.batched_dot(X1s, X2s.transpose(0, 2, 1))
+        sf2 = tt.repeat(sf2, K)
+        w = self.get_expert_mask()
+        Kf = sf2[:, None, None]*tt.exp(-0.5*D)*w[:, :, None]
+        if X2 is None:
+            Kf *= w[:, None, :]
+        return Kf
+
+    def get_expert_mask(self):
+        ''' Returns the E*K x n mask of the padding samples'''
+        K, n = self.X_e.shape[0], self.X_e.shape[1]
+        return tt.tile(self.mask_e[None, :, :], (self.E, 1, 1)).reshape(
+            (self.E*K, n))
+
+    def get_loss(self, cache_intermediate=True):
+        msg = 'Building local GP experts loss'
+        utils.print_with_stamp(msg, self.name)
+        self.should_recompile = False
+        idims = self.D
+        odims = self.E
+        N = self.X.shape[0].astype(floatX)
+        K, n = self.X_e.shape[0], self.X_e.shape[1]
+        sn2 = tt.repeat(self.hyp[:, idims+1]**2, K)
+
+        # E*K x n x n kernel matrices. The padding samples have unit
+        # variance and zero targets, so they don't contribute to the loss
+        w = self.get_expert_mask()
+        EyeN = tt.eye(n)[None, :, :]*tt.ones((odims*K, 1, 1))
+        Kn = self.expert_kernel()
+        Kn += EyeN*(w*sn2[:, None] + (1 - w))[:, :, None]
+        Y = self.Y_e.transpose(2, 0, 1).reshape((odims*K, n))*w
+
+        # compute chol(K), K^-1 and (K^-1)dot(y) for all experts, in float64
+        # if using mixed precision
+        Kn = self.upcast(Kn) + self.jitter*EyeN
+        L = utils.linalg.batched_cholesky(Kn)
+        rhs = tt.concatenate([EyeN, Y[:, :, None]], axis=2)
+        sol = utils.linalg.batched_cho_solve(L, self.upcast(rhs))
+        iK = sol[:, :, :-1]*w[:, :, None]*w[:, None, :]
+        beta = sol[:, :, -1]*w
+
+        # sum of the negative log marginal likelihoods of the experts
+        loss = 0.5*tt.sum(Y*beta, 1)
+        loss += tt.sum(tt.log(utils.linalg.batched_diagonal(L)), 1)
+        loss = loss.reshape((odims, K)).sum(1) + 0.5*N*tt.log(2*np.pi)
+        # the factorizations are kept in floatX
+        loss = self.downcast(loss)
+        iK, L, beta = self.downcast(iK), self.downcast(L), self.downcast(beta)
+
+        iK = iK.reshape((odims, K, n, n))
+        L = L.reshape((odims, K, n, n))
+        beta = beta.reshape((odims, K, n))
+        if cache_intermediate:
+            # we are going to save the intermediate results in the following
+            # shared variables, so we can use them during prediction without
+            # having to recompute them
+            K, n = self.mask_e.get_value(borrow=True).shape
+            shared = tt.sharedvar.SharedVariable
+            eye = np.tile(np.eye(n, dtype=floatX), (odims, K, 1, 1))
+            if not isinstance(self.iK, shared):
+                self.iK = S(eye, name="%s>iK" % (self.name))
+            if not isinstance(self.L, shared):
+                self.L = S(eye, name="%s>L" % (self.name))
+            if not isinstance(self.beta, shared):
+                self.beta = S(np.ones((odims, K, n), dtype=floatX),
+                              name="%s>beta" % (self.name))
+            updts = [(self.iK, iK), (self.L, L), (self.beta, beta)]
+        else:
+            # save intermediate graphs (in case we require grads wrt params)
+            self.iK, self.L, self.beta = iK, L, beta
+            updts = None
+
+        # we add some penalty to avoid having parameters that are too large
+        if self.snr_penalty is not None:
+            penalty_params = {'log_snr': np.log(1000, dtype=floatX),
+                              'log_ls': np.log(100, dtype=floatX),
+                              'log_std': tt.log(self.X.std(0)*(N/(N-1.0))),
+                              'p': 30}
+            loss += self.snr_penalty(tt.log(self.hyp), **penalty_params)
+        inps = []
+        self.state_changed = True  # for saving
+        return loss.sum(), inps, updts
+
+    def combine(self, means, variances, prior_variance):
+        ''' Combines the predictions of the experts, for every output
+        dimension, with the rule given by self.method.
+        @param means K x E x ... predictive means of the experts
+        @param variances K x E x ... predictive variances of the experts
+        @param prior_variance E prior variances
+        @return the combined mean and variance, and the K x E x ... weights
+                of the experts in the combined mean
+        '''
+        K = means.shape[0]
+        extra_dims = ['x']*(means.ndim - 2)
+        prior_variance = prior_variance.dimshuffle(0, *extra_dims)
+        if self.method == 'rbcm':
+            # differential entropy between prior and posterior
+            beta = 0.5*(tt.log(prior_variance) - tt.log(variances))
+        elif self.method == 'gpoe':
+            beta = tt.ones_like(variances)/K.astype(floatX)
+        else:
+            beta = tt.ones_like(variances)
+        precision = (beta/variances).sum(0)
+        if self.method in ('rbcm', 'bcm'):
+            # correction for the prior being counted K times
+            precision += (1 - beta.sum(0))/prior_variance
+        variance = 1.0/precision
+        weights = variance*beta/variances
+        mean = (weights*means).sum(0)
+        return mean, variance, weights
+
+    def predict(self, mx, Sx=None, *args, **kwargs):
+        idims = self.D
+        odims = self.E
+        sf2 = self.hyp[:, idims]**2
+        K, n = self.X_e.shape[0], self.X_e.shape[1]
+        if self.beta is None:
+            self.update_cached_factorization()
+
+        if Sx is None:
+            x = mx[None, :] if mx.ndim == 1 else mx
+            beta = self.beta.reshape((odims*K, n))
+            iK = self.iK.reshape((odims*K, n, n))
+            k = self.expert_kernel(x)
+            mean = (k*beta[:, :, None]).sum(1)
+            var = tt.repeat(sf2, K)[:, None]
+            var -= (tt.batched_dot(iK, k)*k).sum(1)
+            var = tt.largest(var, 1e-6)
+            # K x E x n_x predictions of the experts
+            mean = mean.reshape((odims, K, -1)).transpose(1, 0, 2)
+            var = var.reshape((odims, K, -1)).transpose(1, 0, 2)
+            M, S, _ = self.combine(mean, var, sf2)
+            if mx.ndim == 1:
+                return M.flatten(), tt.diag(S.flatten()), tt.zeros(
+                    (idims, odims))
+            return M.T, S.T
+
+        # moment matching for every expert, with the (output, expert) pairs
+        # stacked along the first dimension, as in expert_kernel. The
+        # padding samples are removed from the kernel functions
+        w = self.get_expert_mask()
+        beta = self.beta.reshape((odims*K, n))*w
+        iK = self.iK.reshape((odims*K, n, n))*w[:, :, None]*w[:, None, :]
+        sf2_k = tt.repeat(sf2, K)
+        lscales = tt.repeat(self.hyp[:, :idims], K, axis=0)
+        zeta = tt.tile(self.X_e - mx, (odims, 1, 1))
+        iL = tt.eye(idims)[None, :, :]/lscales[:, :, None]
+        inp = zeta/lscales[:, None, :]
+        Mk, Vk = self.first_moments(iL, inp, Sx, sf2_k, beta)
+
+        # Eq 2.55, for the output pairs (i, j) of every expert
+        logk = tt.log(sf2_k)[:, None] - 0.5*tt.sum(inp*inp, 2)
+        z_ = inp/lscales[:, None, :]
+        i_e, j_e = self.output_pairs()
+        k = tt.arange(K)[None, :]
+        pairs = ((i_e[:, None]*K + k).flatten(),
+                 (j_e[:, None]*K + k).flatten())
+        Q, i, j = self.second_moments(tt.square(iL), logk, z_, Sx, pairs)
+        m2 = (beta[i][:, :, None]*Q*beta[j][:, None, :]).sum((1, 2))
+        # the diagonal pairs come first, in the same order as iK
+        tr_iKQ = (iK*Q[:odims*K]).sum((1, 2))
+        m2 = tt.inc_subtensor(m2[:odims*K], sf2_k - tr_iKQ)
+        m2 = m2.reshape((i_e.size, K)).T
+        M2 = tt.set_subtensor(tt.zeros((K, odims, odims))[:, i_e, j_e], m2)
+        M2 = tt.set_subtensor(M2[:, j_e, i_e], m2)
+
+        # K x E predictive means, K x E x E covariances and K x D x E input
+        # output covariances of the experts
+        Mk = Mk.reshape((odims, K)).T
+        Sk = M2 - Mk[:, :, None]*Mk[:, None, :]
+        Vk = Vk.reshape((idims, odims, K)).transpose(2, 0, 1)
+
+        # combine the marginal variances and means of each output dimension
+        idx = tt.arange(odims)
+        vk = tt.largest(Sk[:, idx, idx], 1e-6)
+        M, var, weights = self.combine(Mk, vk, sf2)
+
+        # the input output covariance of a weighted sum of the experts
+        V = (Vk*weights[:, None, :]).sum(0)
+
+        # the correlations between output dimensions are taken from the
+        # average covariance of the experts
+        S_avg = Sk.mean(0)
+        sd = tt.sqrt(tt.largest(S_avg[idx, idx], 1e-6))
+        sd_comb = tt.sqrt(var)
+        S = S_avg*tt.outer(sd_comb/sd, sd_comb/sd)
+        S = tt.set_subtensor(S[idx, idx], var)
+
+        return M, S, V
@@ -86,7 +86,7 @@ class BNN(BaseRegressor):
                  heteroscedastic=True, name='BNN',
                  filename=None, network=None, network_spec=None,
                  likelihood=objectives.gaussian_log_likelihood,
-                 **kwargs):
+                 whitening_tol=1e-2, **kwargs):
         self.D = idims
         self.E = odims
         self.name = name
@@ -126,6 +126,11 @@ class BNN(BaseRegressor):
         self.iXs = None
         self.Ym = None
         self.Ys = None
+        # running moments of the dataset, used to update the whitening
+        # transforms incrementally
+        self.X_moments = None
+        self.Y_moments = None
+        self.whitening_tol = whitening_tol
 
         # filename for saving
         fname = '%s_%d_%d_%s_%s' % (self.name, self.D, self.E,
@@ -203,35 +208,73 @@ class BNN(BaseRegressor):
                                         Y_dataset.astype(floatX))
 
         # extra operations when setting the dataset (specific to this class)
-        self.update_dataset_statistics(self.X.get_value(), self.Y.get_value())
-
-    def update_dataset_statistics(self, X_dataset, Y_dataset):
-        # add small amount of noise for smoothing
-        X_dataset += 1e-6*np.random.randn(*X_dataset.shape)
-        Xm = np.atleast_1d(X_dataset.mean(0).astype(floatX))
-        Xc = np.atleast_2d(
-            (np.cov(X_dataset-Xm, rowvar=False, ddof=1).astype(floatX)))
-        iXs = np.linalg.cholesky(
-            np.linalg.inv(Xc)).astype(floatX)
-        if self.Xm is None:
-            self.Xm = theano.shared(Xm, name='%s>Xm' % (self.name))
-            self.iXs = theano.shared(iXs, name='%s>Xs' % (self.name))
-        else:
-            self.Xm.set_value(Xm)
-            self.iXs.set_value(iXs)
-
-        Ym = np.atleast_1d(Y_dataset.mean(0).astype(floatX))
-        Yc = np.atleast_2d(
-            np.cov(Y_dataset-Ym, rowvar=False, ddof=1).astype(floatX))
-
-        Ys = np.linalg.cholesky(Yc).T.astype(floatX)
-
-        if self.Ym is None:
-            self.Ym = theano.shared(Ym, name='%s>Ym' % (self.name))
-            self.Ys = theano.shared(Ys, name='%s>Ys' % (self.name))
-        else:
-            self.Ym.set_value(Ym)
-            self.Ys.set_value(Ys)
+        self.update_dataset_statistics(X_dataset, Y_dataset, append=True)
+
+    def update_dataset_statistics(self, X_dataset, Y_dataset, append=False):
+        ''' Updates the running mean and covariance of the inputs and
+        targets with the samples in X_dataset and Y_dataset. The whitening
+        transforms (Xm, iXs, Ym, Ys) are only recomputed when the statistics
+        have drifted by more than self.whitening_tol, measured in the
+        whitened space of the current transforms.
+        @param X_dataset n x D matrix of inputs
+        @param Y_dataset n x E matrix of targets
+        @param append if True, the samples are merged with the statistics of
+                      the current dataset. Otherwise, the statistics are
+                      reset.
+        '''
+        if append and getattr(self, 'X_moments', None) is None:
+            # no statistics (e.g. after loading from disk); build them from
+            # the full dataset, which already contains the new samples
+            X_dataset = self.X.get_value(borrow=True)
+            Y_dataset = self.Y.get_value(borrow=True)
+            append = False
+        if not append:
+            self.X_moments = None
+            self.Y_moments = None
+        self.X_moments = utils.update_moments(self.X_moments, X_dataset)
+        self.Y_moments = utils.update_moments(self.Y_moments, Y_dataset)
+
+        # input whitening
+        n, Xm, Xc = self.X_moments
+        Xc = Xc/max(n-1, 1)
+        # small ridge for smoothing (equivalent to adding 1e-6 std noise)
+        Xc += 1e-12*np.eye(Xc.shape[0])
+        if self.Xm is None or self.whitening_drift(
+                Xm, Xc, self.Xm.get_value(), self.iXs.get_value()):
+            iXs = np.linalg.cholesky(np.linalg.inv(Xc)).astype(floatX)
+            Xm = Xm.astype(floatX)
+            if self.Xm is None:
+                self.Xm = theano.shared(Xm, name='%s>Xm' % (self.name))
+                self.iXs = theano.shared(iXs, name='%s>Xs' % (self.name))
+            else:
+                self.Xm.set_value(Xm)
+                self.iXs.set_value(iXs)
+
+        # output whitening
+        n, Ym, Yc = self.Y_moments
+        Yc = Yc/max(n-1, 1)
+        if self.Ym is None or self.whitening_drift(
+                Ym, Yc, self.Ym.get_value(),
+                np.linalg.inv(self.Ys.get_value())):
+            Ys = np.linalg.cholesky(Yc).T.astype(floatX)
+            Ym = Ym.astype(floatX)
+            if self.Ym is None:
+                self.Ym = theano.shared(Ym, name='%s>Ym' % (self.name))
+                self.Ys = theano.shared(Ys, name='%s>Ys' % (self.name))
+            else:
+                self.Ym.set_value(Ym)
+                self.Ys.set_value(Ys)
+
+    def whitening_drift(self, mean, cov, old_mean, old_W):
+        ''' Returns True if data with the given mean and covariance is no
+        longer whitened by the transform x -> (x - old_mean).dot(old_W), i.e.
+        if the whitened mean differs from zero, or the whitened covariance
+        from the identity, by more than self.whitening_tol'''
+        old_W = np.asarray(old_W, dtype=np.float64)
+        dm = (mean - old_mean).dot(old_W)
+        dS = old_W.T.dot(cov).dot(old_W) - np.eye(old_W.shape[1])
+        drift = max(np.abs(dm).max(), np.abs(dS).max())
+        return not np.isfinite(drift) or drift > self.whitening_tol
 
     def build_network(self, network_spec=None, input_shape=None,
                       params={}, return_net=False, name=None):
@@ -295,10 +338,12 @@ class BNN(BaseRegressor):
             for p in network.get_params():
                 p.name = p.name.replace('.', '>')
 
-        # force rebuilding the prediction functions, as they will be
-        # out of date
+        # force rebuilding the prediction and mask update functions, as they
+        # will be out of date
         self.predict_fn = None
         self.predict_ic_fn = None
+        self.predict_batch_fn = None
+        self.update_fn = None
 
         if return_net:
             return network
@@ -456,42 +501,49 @@ class BNN(BaseRegressor):
             return [M, S, C]
 
     def update(self, n_samples=None):
-        ''' Updates the dropout masks'''
+        ''' Resamples the dropout masks. The masks are sampled for the
+        largest number of samples requested so far, and the networks use
+        the first n_samples rows; so changing n_samples only requires
+        resampling the masks, which is done in place by a single compiled
+        function. The pool never shrinks: when n_samples is smaller than the
+        pool (e.g. the callbacks of mc_pilco_polopt in kusanagi/server.py,
+        for a model that was used with more particles), all the masks are
+        resampled and only the first n_samples rows are used'''
         if n_samples is not None:
             if isinstance(n_samples, tt.sharedvar.SharedVariable):
                 self.n_samples = n_samples
-                self.update_fn = None
             else:
                 self.n_samples.set_value(n_samples)
 
-            # increase the size of the masks
-            updts = self.get_updates()
-            for v, updt in updts.items():
-                v_shape = v.shape.eval()
-                if v_shape[0] != n_samples:
-                    v_shape[0] = n_samples
-                    v.set_value(np.zeros(v_shape, dtype=v.dtype))
+        # number of rows in the mask pool
+        n = int(self.n_samples.get_value())
+        if getattr(self, 'n_masks', None) is None:
+            self.n_masks = theano.shared(
+                np.array(n, dtype='int32'), name='%s>n_masks' % (self.name))
+            self.update_fn = None
+        elif n > self.n_masks.get_value():
+            # grow the pool; the new masks are sampled below
+            self.n_masks.set_value(n)
 
         if not hasattr(self, 'update_fn') or self.update_fn is None:
             # get prediction with non deterministic samples
-            mx = tt.zeros((self.n_samples, self.D))
+            mx = tt.zeros((self.n_masks, self.D))
             self.predict(mx, iid_per_eval=False)
 
             # create a function to update the masks manually. Here the dropout
             # masks should be shared variables
             updts = self.get_updates()
             # compile optimmized
-            mode = theano.compile.mode.get_mode('FAST_RUN')
-            self.update_fn = theano.function([], [], updates=updts,
-                                             allow_input_downcast=True,
-                                             mode=mode)
+            self.update_fn = utils.function_cache.function(
+                [], [], updates=updts, allow_input_downcast=True,
+                mode='FAST_RUN')
 
         # draw samples from the networks
         self.update_fn()
 
     def train(self, batch_size=100,
               input_ls=None, hidden_ls=None, lr=1e-4,
-              optimizer=None, callback=None):
+              optimizer=None, callback=None, on_device=True):
         if optimizer is None:
             optimizer = self.optimizer
         if optimizer.loss_fn is None or self.should_recompile:
@@ -509,9 +561,13 @@ class BNN(BaseRegressor):
         if hidden_ls is None:
             hidden_ls = 1.0
 
-        optimizer.minibatch_minimize(self.X.get_value(), self.Y.get_value(),
-                                     input_ls, hidden_ls, lr,
+        # with on_device, the dataset is not copied to the host and the
+        # minibatches are selected in the compiled update function
+        X, Y = self.X, self.Y
+        if not on_device:
+            X, Y = X.get_value(), Y.get_value()
+        optimizer.minibatch_minimize(X, Y, input_ls, hidden_ls, lr,
                                      batch_size=batch_size,
-                                     callback=callback)
+                                     callback=callback, on_device=on_device)
         self.trained = True
         self.update()
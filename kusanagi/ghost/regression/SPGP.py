@@ -4,24 +4,27 @@ import theano.tensor as tt
 
 from functools import partial
 from theano import shared as S
-from theano.tensor.nlinalg import matrix_dot, det
-from theano.tensor.slinalg import (solve_lower_triangular,
-                                   solve_upper_triangular,
-                                   solve,
-                                   cholesky)
 
 from kusanagi import utils
 from kusanagi.ghost.regression import cov
 from kusanagi.ghost.regression.GP import GP, GP_UI
-from scipy.cluster.vq import kmeans
 floatX = theano.config.floatX
 
 
 class SPGP(GP):
     '''Sparse Pseudo Input FITC approximation Snelson and Gharammani 2005'''
+    supports_fast_predict = False
+
     def __init__(self, X_dataset=None, Y_dataset=None, name='SPGP', idims=None,
-                 odims=None, n_inducing=100, **kwargs):
+                 odims=None, n_inducing=100, per_output_inducing=False,
+                 kmeans_batch_size=1000, kmeans_time_budget=None, **kwargs):
         self.X_sp = None  # inducing inputs (symbolic variable)
+        # if True, X_sp is a E x M x D tensor (one set of pseudo inputs per
+        # output dimension). Otherwise it is a M x D matrix
+        self.per_output_inducing = per_output_inducing
+        self.X_sp_init = None  # last value of the inducing inputs
+        self.kmeans_batch_size = kmeans_batch_size
+        self.kmeans_time_budget = kmeans_time_budget
         self.loss_sp_fn = None
         self.dloss_sp_fn = None
         self.beta_sp = None
@@ -38,21 +41,47 @@ class SPGP(GP):
     def init_params(self):
         super(SPGP, self).init_params()
 
-    def init_pseudo_inputs(self):
+    def init_pseudo_inputs(self, warm_start=True):
+        ''' Initializes the pseudo inputs with mini-batch k-means. If
+        warm_start is True and there are previous pseudo inputs (e.g. when
+        the dataset grew), these are used to initialize the cluster centers;
+        otherwise, the centers are initialized with k-means++'''
         msg = "Dataset must have more than n_inducing [ %n ] to enable"
         msg += " inference with sparse pseudo inputs"
         assert self.N >= self.n_inducing, msg % (self.n_inducing)
         self.should_recompile = True
-        # pick initial cluster centers from dataset
         X = self.X.get_value()
-        X_sp_ = utils.kmeanspp(X, self.n_inducing)
+        X_sp_ = self.X_sp_init if self.X_sp is None else self.X_sp.get_value()
+        if self.per_output_inducing:
+            sp_shape = (self.E, self.n_inducing, self.D)
+        else:
+            sp_shape = (self.n_inducing, self.D)
+        warm_start = warm_start and X_sp_ is not None\
+            and X_sp_.shape == sp_shape
 
-        # perform kmeans to get initial cluster centers
         utils.print_with_stamp('Initialising pseudo inputs', self.name)
-        X_sp_, dist = kmeans(X, X_sp_, iter=200, thresh=1e-9)
+        kmeans_kwargs = dict(batch_size=self.kmeans_batch_size,
+                             time_budget=self.kmeans_time_budget,
+                             warm_start=warm_start)
+        if warm_start and self.per_output_inducing:
+            # refine the pseudo inputs of each output dimension separately
+            X_sp_ = np.stack([utils.minibatch_kmeans(X, X_sp_e,
+                                                     **kmeans_kwargs)
+                              for X_sp_e in X_sp_])
+        else:
+            if not warm_start:
+                # pick initial cluster centers from dataset
+                X_sp_ = utils.kmeanspp(X, self.n_inducing)
+            # perform kmeans to get initial cluster centers
+            X_sp_ = utils.minibatch_kmeans(X, X_sp_, **kmeans_kwargs)
+            if self.per_output_inducing:
+                # every output dimension starts from the same pseudo inputs;
+                # they are moved independently during training
+                X_sp_ = np.tile(X_sp_, (self.E, 1, 1))
+
         # initialize symbolic tensor variable if necessary
         # (this will create the self.X_sp atttribute)
-        self.set_params({'X_sp': X_sp_})
+        self.set_params({'X_sp': X_sp_.astype(floatX)})
 
     def set_dataset(self, X_dataset, Y_dataset):
         # set the dataset on the parent class
@@ -61,6 +90,9 @@ class SPGP(GP):
             msg = "Dataset must have more than n_inducing [ %n ] to enable"
             msg + " inference with sparse pseudo inputs"
             utils.print_with_stamp(msg, self.name)
+            if self.X_sp is not None:
+                # keep the pseudo inputs around, for warm starting
+                self.X_sp_init = self.X_sp.get_value()
             self.X_sp = None
             self.loss_sp_fn = None
             self.dloss_sp_fn = None
@@ -90,60 +122,51 @@ class SPGP(GP):
             N = self.X.shape[0].astype(theano.config.floatX)
 
             # initialize the training loss function of the sparse FITC
-            # approximation
-            def nlml(Y, hyp, X, X_sp, EyeM):
-                # TODO allow for different pseudo inputs for each dimension
-                # initialise the (before compilation) kernel function
-                hyps = [hyp[:idims+1], hyp[idims+1]]
-                kernel_func = partial(cov.Sum, hyps, self.covs)
-
-                sf2 = hyp[idims]**2
-                sn2 = hyp[idims+1]**2
-                N = X.shape[0].astype(theano.config.floatX)
-
-                ridge = 1e-6
-                Kmm = kernel_func(X_sp) + ridge*EyeM
-                Kmn = kernel_func(X_sp, X)
-                Lmm = cholesky(Kmm)
-                rhs = tt.concatenate([EyeM, Kmn], axis=1)
-                sol = solve_lower_triangular(Lmm, rhs)
-                iKmm = solve_upper_triangular(Lmm.T, sol[:, :EyeM.shape[0]])
-                Lmn = sol[:, EyeM.shape[0]:]
-                diagQnn = (Lmn**2).sum(0)
-
-                # Gamma = diag(Knn - Qnn) + sn2*I
-                Gamma = sf2 + sn2 - diagQnn
-                Gamma_inv = 1.0/Gamma
-
-                # these operations are done to avoid inverting Qnn+Gamma)
-                sqrtGamma_inv = tt.sqrt(Gamma_inv)
-                Lmn_ = Lmn*sqrtGamma_inv                      # Kmn_*Gamma^-.5
-                Yi = Y*(sqrtGamma_inv)                        # Gamma^-.5* Y
-                # I + Lmn * Gamma^-1 * Lnm
-                Bmm = tt.eye(Kmm.shape[0]) + (Lmn_).dot(Lmn_.T)
-                Amm = cholesky(Bmm)
-                LAmm = Lmm.dot(Amm)
-                Kmn_dotYi = Kmn.dot(Yi*(sqrtGamma_inv))
-                rhs = tt.concatenate([EyeM, Kmn_dotYi[:, None]], axis=1)
-                sol = solve_upper_triangular(
-                    LAmm.T, solve_lower_triangular(LAmm, rhs))
-                iBmm = sol[:, :-1]
-                beta_sp = sol[:, -1]
-
-                log_det_K_sp = tt.sum(tt.log(Gamma))
-                log_det_K_sp += 2*tt.sum(tt.log(tt.diag(Amm)))
-
-                loss_sp = Yi.dot(Yi) - Kmn_dotYi.dot(beta_sp)
-                loss_sp += log_det_K_sp + N*np.log(2*np.pi)
-                loss_sp *= 0.5
-
-                return loss_sp, iKmm, Lmm, Amm, iBmm, beta_sp
-
-            r_outs, updts = theano.scan(
-                fn=nlml, sequences=[self.Y.T, self.hyp],
-                non_sequences=[self.X, self.X_sp, tt.eye(self.X_sp.shape[0])],
-                allow_gc=False, return_list=True)
-            (loss_sp, iKmm, Lmm, Amm, iBmm, beta_sp) = r_outs
+            # approximation, for all the output dimensions at once
+            hyps = (self.hyp[:, :idims+1], self.hyp[:, idims+1])
+            kernel_func = partial(cov.Sum_batched, hyps, self.batched_covs)
+            sf2 = self.hyp[:, idims]**2
+            sn2 = self.hyp[:, idims+1]**2
+            M = self.X_sp.shape[-2]
+            EyeM = tt.unbroadcast(tt.tile(tt.eye(M)[None], (odims, 1, 1)), 0)
+
+            ridge = 1e-6
+            Kmm = kernel_func(self.X_sp) + ridge*EyeM
+            Kmn = kernel_func(self.X_sp, self.X)
+            Lmm = utils.linalg.batched_cholesky(Kmm)
+            rhs = tt.concatenate([EyeM, Kmn], axis=2)
+            sol = utils.linalg.batched_solve_lower_triangular(Lmm, rhs)
+            iKmm = utils.linalg.batched_solve_upper_triangular(
+                utils.linalg.batched_transpose(Lmm), sol[:, :, :M])
+            Lmn = sol[:, :, M:]
+            diagQnn = (Lmn**2).sum(1)
+
+            # Gamma = diag(Knn - Qnn) + sn2*I
+            Gamma = sf2[:, None] + sn2[:, None] - diagQnn
+            Gamma_inv = 1.0/Gamma
+
+            # these operations are done to avoid inverting Qnn+Gamma)
+            sqrtGamma_inv = tt.sqrt(Gamma_inv)
+            Lmn_ = Lmn*sqrtGamma_inv[:, None, :]          # Kmn_*Gamma^-.5
+            Yi = self.Y.T*(sqrtGamma_inv)                 # Gamma^-.5* Y
+            # I + Lmn * Gamma^-1 * Lnm
+            Bmm = EyeM + tt.batched_dot(
+                Lmn_, utils.linalg.batched_transpose(Lmn_))
+            Amm = utils.linalg.batched_cholesky(Bmm)
+            LAmm = tt.batched_dot(Lmm, Amm)
+            Kmn_dotYi = (Kmn*(Yi*sqrtGamma_inv)[:, None, :]).sum(2)
+            rhs = tt.concatenate([EyeM, Kmn_dotYi[:, :, None]], axis=2)
+            sol = utils.linalg.batched_cho_solve(LAmm, rhs)
+            iBmm = sol[:, :, :-1]
+            beta_sp = sol[:, :, -1]
+
+            log_det_K_sp = tt.sum(tt.log(Gamma), 1)
+            log_det_K_sp += 2*tt.sum(
+                tt.log(utils.linalg.batched_diagonal(Amm)), 1)
+
+            loss_sp = (Yi**2).sum(1) - (Kmn_dotYi*beta_sp).sum(1)
+            loss_sp += log_det_K_sp + N*np.log(2*np.pi)
+            loss_sp *= 0.5
 
             if cache_intermediate:
                 # we are going to save the intermediate results in the
@@ -179,7 +202,7 @@ class SPGP(GP):
                 penalty_params = {'log_snr': np.log(1000),
                                   'log_ls': np.log(100),
                                   'log_std': tt.log(
-                                      self.X_sp.std(0)*(N/(N-1.0))),
+                                      self.X_sp.std(-2)*(N/(N-1.0))),
                                   'p': 30}
                 loss_sp += self.snr_penalty(self.hyp, **penalty_params)
 
@@ -188,34 +211,29 @@ class SPGP(GP):
             return loss_sp.sum(), inps, updts
 
     def predict(self, mx, Sx=None, *args, **kwargs):
-        if Sx is None:
-            Sx = tt.eye(mx.shape[-1])*1e-2
         if self.N < self.n_inducing:
             # stick with the full GP
-            return super(SPGP, self).predict(mx, Sx)
+            return GP.predict(self, mx)
 
         idims = self.D
         odims = self.E
 
-        # compute the mean and variance for each output dimension
-        def predict_odim(Lmm, Amm, beta_sp, hyp, X_sp, x):
-            hyps = (hyp[:idims+1], hyp[idims+1])
-            kernel_func = partial(cov.Sum, hyps, self.covs)
-
-            k = kernel_func(x, X_sp).flatten()
-            mean = k.dot(beta_sp)
-            kL = solve_lower_triangular(Lmm, k)
-            kA = solve_lower_triangular(Amm, Lmm.T.dot(k))
-            variance = kernel_func(x, all_pairs=False)
-            variance += -(kL.dot(kL) + kA.dot(kA))
-            variance = tt.largest(variance, 0.0) + 1e-3
-
-            return mean, variance
+        # compute the mean and variance for all output dimensions
+        sf2 = self.hyp[:, idims]**2
+        sn2 = self.hyp[:, idims+1]**2
         x = mx[None, :] if mx.ndim == 1 else mx
-        seq = [self.Lmm, self.Amm, self.beta_sp, self.hyp]
-        nseq = [self.X_sp, x]
-        (M, S), updts = theano.scan(
-            fn=predict_odim, sequences=seq, non_sequences=nseq, allow_gc=False)
+        k = cov.SEard_batched(self.hyp[:, :idims+1], self.X_sp, x)
+        M = (k*self.beta_sp[:, :, None]).sum(1)
+        kL = utils.linalg.batched_solve_lower_triangular(self.Lmm, k)
+        kA = utils.linalg.batched_solve_lower_triangular(
+            self.Amm, tt.batched_dot(
+                utils.linalg.batched_transpose(self.Lmm), k))
+        S = sf2[:, None] + sn2[:, None]
+        S += -((kL**2).sum(1) + (kA**2).sum(1))
+        S = tt.largest(S, 0.0) + 1e-3
+        if mx.ndim == 2:
+            # n x E means and variances, for a batch of inputs
+            return M.T, S.T
 
         # reshape output variables
         M = M.flatten()
@@ -235,12 +253,18 @@ class SPGP(GP):
 class SPGP_UI(SPGP, GP_UI):
     def __init__(self, X_dataset=None, Y_dataset=None, name='SPGP_UI',
                  idims=None, odims=None, n_inducing=100,
-                 **kwargs):
+                 per_output_inducing=False, kmeans_batch_size=1000,
+                 kmeans_time_budget=None, **kwargs):
         SPGP.__init__(self, X_dataset, Y_dataset, name=name, idims=idims,
                       odims=odims, n_inducing=n_inducing,
-                      **kwargs)
+                      per_output_inducing=per_output_inducing,
+                      kmeans_batch_size=kmeans_batch_size,
+                      kmeans_time_budget=kmeans_time_budget, **kwargs)
 
-    def predict(self, mx, Sx, *args, **kwargs):
+    def predict(self, mx, Sx=None, *args, **kwargs):
+        if Sx is None:
+            # deterministic inputs
+            return SPGP.predict(self, mx)
         if self.N < self.n_inducing:
             # stick with the full GP
             return GP_UI.predict(self, mx, Sx)
@@ -248,8 +272,10 @@ class SPGP_UI(SPGP, GP_UI):
         idims = self.D
         odims = self.E
 
-        # centralize inputs
+        # centralize inputs (E x M x D)
         zeta = self.X_sp - mx
+        if zeta.ndim == 2:
+            zeta = zeta[None, :, :]
 
         # initialize some variables
         sf2 = self.hyp[:, idims]**2
@@ -257,59 +283,25 @@ class SPGP_UI(SPGP, GP_UI):
         lscales = self.hyp[:, :idims]
         iL = eyeE/lscales.dimshuffle(0, 1, 'x')
 
-        # predictive mean
-        inp = iL.dot(zeta.T).transpose(0, 2, 1)
-        iLdotSx = iL.dot(Sx)
-        B = (iLdotSx[:, :, None, :]*iL[:, None, :, :]).sum(-1) + tt.eye(idims)
-        t = tt.stack([solve(B[i].T, inp[i].T).T for i in range(odims)])
-        c = sf2/tt.sqrt(tt.stack([det(B[i]) for i in range(odims)]))
-        l_ = tt.exp(-0.5*tt.sum(inp*t, 2))
-        lb = l_*self.beta_sp
-        M = tt.sum(lb, 1)*c
-
-        # input output covariance
-        tiL = tt.stack([t[i].dot(iL[i]) for i in range(odims)])
-        V = tt.stack([tiL[i].T.dot(lb[i]) for i in range(odims)]).T*c
+        # predictive mean and input output covariance
+        inp = zeta/lscales[:, None, :]
+        M, V = self.first_moments(iL, inp, Sx, sf2, self.beta_sp)
 
         # predictive covariance
         logk = (tt.log(sf2))[:, None] - 0.5*tt.sum(inp*inp, 2)
-        logk_r = logk.dimshuffle(0, 'x', 1)
-        logk_c = logk.dimshuffle(0, 1, 'x')
         Lambda = tt.square(iL)
-        LL = (Lambda.dimshuffle(0, 'x', 1, 2) + Lambda).transpose(0, 1, 3, 2)
-        R = tt.dot(LL, Sx.T).transpose(0, 1, 3, 2) + tt.eye(idims)
-        z_ = Lambda.dot(zeta.T).transpose(0, 2, 1)
-
-        M2 = tt.zeros((odims, odims))
-
-        # initialize indices
-        triu_indices = np.triu_indices(odims)
-        indices = [tt.as_index_variable(idx) for idx in triu_indices]
-
-        def second_moments(i, j, M2, beta, iK, sf2, R, logk_c, logk_r, z_, Sx):
-            # This comes from Deisenroth's thesis ( Eqs 2.51- 2.54 )
-            Rij = R[i, j]
-            n2 = logk_c[i] + logk_r[j]
-            n2 += utils.maha(z_[i], -z_[j], 0.5*solve(Rij, Sx))
-
-            Q = tt.exp(n2)/tt.sqrt(det(Rij))
-
-            # Eq 2.55
-            m2 = matrix_dot(beta[i], Q, beta[j])
-
-            m2 = theano.ifelse.ifelse(
-                tt.eq(i, j), m2 - tt.sum(iK[i]*Q) + sf2[i], m2)
-            M2 = tt.set_subtensor(M2[i, j], m2)
-            M2 = theano.ifelse.ifelse(
-                tt.eq(i, j), M2 + 1e-6, tt.set_subtensor(M2[j, i], m2))
-            return M2
-
-        nseq = [self.beta_sp, (self.iKmm - self.iBmm), sf2,
-                R, logk_c, logk_r, z_, Sx]
-        M2_, updts = theano.scan(
-            fn=second_moments, sequences=indices, outputs_info=[M2],
-            non_sequences=nseq, allow_gc=False)
-        M2 = M2_[-1]
+        z_ = zeta/tt.square(lscales)[:, None, :]
+
+        # Eq 2.55, for all the (i, j) output pairs in the upper triangle
+        Q, i, j = self.second_moments(Lambda, logk, z_, Sx)
+        m2 = (self.beta_sp[i][:, :, None]*Q*self.beta_sp[j][:, None, :]).sum(
+            (1, 2))
+        # the diagonal pairs come first in i, j
+        iK = self.iKmm - self.iBmm
+        m2 = tt.inc_subtensor(
+            m2[:odims], sf2 + 1e-6 - (iK*Q[:odims]).sum((1, 2)))
+        M2 = tt.set_subtensor(tt.zeros((odims, odims))[i, j], m2)
+        M2 = M2 + tt.triu(M2, k=1).T
         S = M2 - tt.outer(M, M)
 
         return M, S, V
@@ -16,8 +16,10 @@ floatX = theano.config.floatX
 class SSGP(GP):
     ''' Sparse Spectrum Gaussian Process Regression Lazaro-Gredilla
     et al 2010'''
+    supports_fast_predict = False
+
     def __init__(self, X_dataset=None, Y_dataset=None, name='SSGP', idims=None,
-                 odims=None, n_inducing=100, **kwargs):
+                 odims=None, n_inducing=100, online=False, **kwargs):
         self.w = None
         self.sr = None
         self.Lmm = None
@@ -26,9 +28,17 @@ class SSGP(GP):
         self.loss_ss_fn = None
         self.dloss_ss_fn = None
         self.n_inducing = n_inducing
+        # in online mode, the loss is computed from sufficient statistics of
+        # the dataset that are accumulated as new data is appended. These are
+        # only valid for fixed spectral points (w and lengthscales)
+        self.online = online
+        self.ss_stats = None
+        self.ss_stats_sr = None
         GP.__init__(self, X_dataset, Y_dataset,
                     name=name, idims=idims, odims=odims,
                     **kwargs)
+        if self.online and 'w' not in self.fixed_params:
+            self.fixed_params.append('w')
 
     def init_params(self):
         super(SSGP, self).init_params()
@@ -48,6 +58,76 @@ class SSGP(GP):
             self.sr = self.w/(self.hyp[:, :idims])
             self.sr = self.sr.transpose(1, 0, 2)
 
+    def get_sr_value(self):
+        ''' Returns the current value of the scaled spectral points, as an
+        E x n_inducing x D numpy array'''
+        idims = self.D
+        eps = np.finfo(np.__dict__[floatX]).eps
+        hyp = np.logaddexp(0, self.unconstrained_hyp.get_value()) + eps
+        sr = self.w.get_value()/hyp[:, :idims]
+        return sr.transpose(1, 0, 2)
+
+    def get_ss_stats(self, X, Y, chunk_size=1000):
+        ''' Returns the sufficient statistics of the SSGP loss for the
+        dataset (X, Y), at the current spectral points: Phi_f Phi_f^T,
+        Phi_f Y, Y^T Y, the number of samples and the first and second
+        moments of the inputs (for the snr penalty). The features are
+        computed chunk_size samples at a time'''
+        sr = self.get_sr_value()
+        Mi = 2*sr.shape[1]
+        Phi_f = np.zeros((self.E, Mi, Mi))
+        phi_f_dotY = np.zeros((self.E, Mi))
+        for i in range(0, X.shape[0], chunk_size):
+            srdotX = sr.dot(X[i:i+chunk_size].T)
+            phi_f = np.concatenate([np.sin(srdotX), np.cos(srdotX)], axis=1)
+            Phi_f += np.einsum('emn,ekn->emk', phi_f, phi_f)
+            phi_f_dotY += np.einsum('emn,ne->em', phi_f, Y[i:i+chunk_size])
+        return [Phi_f, phi_f_dotY, (Y**2).sum(0), np.array(X.shape[0]),
+                X.sum(0), (X**2).sum(0)]
+
+    def update_ss_stats(self, X=None, Y=None):
+        ''' Recomputes the sufficient statistics for the whole dataset, or
+        adds the statistics of the new samples (X, Y) to the current ones.
+        The statistics are recomputed whenever the spectral points have
+        changed since they were last computed.'''
+        sr = self.get_sr_value()
+        if X is None or self.ss_stats is None or not np.array_equal(
+                sr, self.ss_stats_sr):
+            utils.print_with_stamp(
+                'Computing sufficient statistics for online SSGP', self.name)
+            stats = self.get_ss_stats(self.X.get_value(), self.Y.get_value())
+        else:
+            stats = [s.get_value() + s_new for s, s_new in zip(
+                self.ss_stats, self.get_ss_stats(X, Y))]
+        stats = [st.astype(floatX) for st in stats]
+        if self.ss_stats is None:
+            names = ['Phi_f', 'phi_f_dotY', 'YdotY', 'N', 'Xsum', 'X2sum']
+            self.ss_stats = [
+                S(st, name='%s>ss_%s' % (self.name, n))
+                for st, n in zip(stats, names)]
+        else:
+            for s, st in zip(self.ss_stats, stats):
+                s.set_value(st)
+        self.ss_stats_sr = sr
+
+    def set_dataset(self, X_dataset, Y_dataset, X_cov=None, Y_var=None,
+                    update_ss_stats=True):
+        super(SSGP, self).set_dataset(X_dataset, Y_dataset, X_cov, Y_var)
+        if self.online and update_ss_stats:
+            self.update_ss_stats()
+
+    def append_dataset(self, X_dataset, Y_dataset, X_cov=None, Y_var=None):
+        if not self.online or self.X is None:
+            return super(SSGP, self).append_dataset(
+                X_dataset, Y_dataset, X_cov, Y_var)
+        # accumulate the sufficient statistics of the new samples only
+        X_dataset = X_dataset.astype(self.X.dtype)
+        Y_dataset = Y_dataset.astype(self.Y.dtype)
+        X_ = np.vstack((self.X.get_value(), X_dataset))
+        Y_ = np.vstack((self.Y.get_value(), Y_dataset))
+        self.set_dataset(X_, Y_, update_ss_stats=False)
+        self.update_ss_stats(X_dataset, Y_dataset)
+
     def get_loss(self, unroll_scan=False, cache_intermediate=True):
         utils.print_with_stamp('Building Sparse Spectrum loss', self.name)
         idims = self.D
@@ -57,20 +137,29 @@ class SSGP(GP):
             self.sr = self.sr.transpose(1, 0, 2)
 
         # init variables
-        N = self.X.shape[0].astype(floatX)
         M = self.sr.shape[1].astype(floatX)
         Mi = 2*self.sr.shape[1]
         EyeM = tt.eye(Mi)
         sf2 = self.hyp[:, idims]**2
         sf2M = (sf2/M).dimshuffle(0, 'x', 'x')
         sn2 = (self.hyp[:, idims+1]**2).dimshuffle(0, 'x', 'x')
-        srdotX = self.sr.dot(self.X.T)
 
-        phi_f = tt.concatenate([tt.sin(srdotX), tt.cos(srdotX)], axis=1)
-        Phi_f = tt.batched_dot(phi_f, phi_f.transpose(0, 2, 1))
+        if self.online:
+            # the loss only depends on the sufficient statistics
+            if self.ss_stats is None:
+                self.update_ss_stats()
+            Phi_f, phi_f_dotY, YdotY, N, Xsum, X2sum = self.ss_stats
+            Xstd = tt.sqrt(X2sum/N - (Xsum/N)**2)
+        else:
+            N = self.X.shape[0].astype(floatX)
+            srdotX = self.sr.dot(self.X.T)
+            phi_f = tt.concatenate([tt.sin(srdotX), tt.cos(srdotX)], axis=1)
+            Phi_f = tt.batched_dot(phi_f, phi_f.transpose(0, 2, 1))
+            phi_f_dotY = tt.batched_dot(phi_f, self.Y.T)
+            YdotY = tt.sum(self.Y**2, 0)
+            Xstd = self.X.std(0)
         A = sf2M*Phi_f
         A += (sn2 + 1e-6)*EyeM
-        phi_f_dotY = tt.batched_dot(phi_f, self.Y.T)
 
         def nlml(A, phidotY, EyeM):
             Lmm = cholesky(A)
@@ -99,7 +188,6 @@ class SSGP(GP):
         beta_ss *= sf2M[:, :, 0]
 
         # And finally, the negative log marginal likelihood
-        YdotY = tt.sum(self.Y**2, 0)
         Ydotphidotbeta = tt.sum(phi_f_dotY*beta_ss, -1)
         loss_ss = 0.5*(YdotY - Ydotphidotbeta)/sn2
         idx = [theano.tensor.arange(Lmm.shape[i]) for i in [1, 2]]
@@ -131,13 +219,20 @@ class SSGP(GP):
         if self.snr_penalty is not None:
             penalty_params = {'log_snr': np.log(1000, dtype=floatX),
                               'log_ls': np.log(100, dtype=floatX),
-                              'log_std': tt.log(self.X.std(0)*(N/(N-1.0))),
+                              'log_std': tt.log(Xstd*(N/(N-1.0))),
                               'p': 30}
-            loss_ss += self.snr_penalty(tt.log(self.hyp), **penalty_params)
-
-        # add a penalty for high frequencies
-        freq_penalty = tt.square(self.w).sum(-1).mean(0)
-        loss_ss = loss_ss + freq_penalty
+            loghyp = tt.log(self.hyp)
+            if self.online:
+                # the lengthscales are kept fixed in online mode
+                loghyp = tt.concatenate([
+                    theano.gradient.disconnected_grad(loghyp[:, :idims]),
+                    loghyp[:, idims:]], axis=1)
+            loss_ss += self.snr_penalty(loghyp, **penalty_params)
+
+        if not self.online:
+            # add a penalty for high frequencies
+            freq_penalty = tt.square(self.w).sum(-1).mean(0)
+            loss_ss = loss_ss + freq_penalty
 
         inps = []
         self.state_changed = True  # for saving
@@ -179,27 +274,110 @@ class SSGP(GP):
             utils.print_with_stamp('Restoring full dataset', self.name)
             self.set_dataset(X_full, Y_full)
 
-    def resample_ss(self, iters=100):
-        self.set_ss_samples()
-        if self.optimizer.loss_fn is not None:
-            loss_fn = self.optimizer.loss_fn
-            loss = loss_fn()
-            best_w = self.w.get_value()
-            # try a couple spectrum samples and pick the one with the
-            # lowest loss
-            # TODO do this test per output dimension
-            for i in range(iters):
-                self.set_ss_samples()
-                loss_i = loss_fn()
-                if loss_i < loss:
-                    loss = loss_i
-                    best_w = self.w.get_value()
-            self.set_ss_samples(best_w)
+    def sample_restart_params(self, scale=0.5):
+        ''' Returns a random starting point for a restart of the
+        hyperparameter optimization, with perturbed hyperparameters and a new
+        sample of spectral points'''
+        params = super(SSGP, self).sample_restart_params(scale)
+        if self.online:
+            # keep the spectral points fixed
+            hyp = self.unconstrained_hyp.get_value()
+            params['unconstrained_hyp'][:, :self.D] = hyp[:, :self.D]
+            params['w'] = self.w.get_value()
+        elif 'w' in params:
+            w = np.random.randn(*params['w'].shape)
+            params['w'] = w.astype(floatX)
+        return params
+
+    def get_ss_candidates_loss(self):
+        ''' Returns the symbolic loss of a stack of candidate (unscaled)
+        spectral samples, evaluated independently for every output
+        dimension. All the candidates and output dimensions are evaluated as
+        a single batch of cholesky factorizations and solves.
+        @return the tuple (loss, W), where W is the C x n_inducing x E x D
+                tensor of candidates and loss the C x E matrix of losses
+        '''
+        idims = self.D
+        odims = self.E
+        W = tt.tensor4('%s>W' % (self.name))
+        C = W.shape[0]
+
+        # C*E x M x D scaled spectral points
+        sr = W/self.hyp[:, :idims]
+        sr = sr.transpose(0, 2, 1, 3).reshape(
+            (C*odims, sr.shape[1], idims))
+
+        N = self.X.shape[0].astype(floatX)
+        M = sr.shape[1].astype(floatX)
+        EyeM = tt.eye(2*sr.shape[1])
+        ones = tt.ones((C, 1))
+        sf2M = (ones*(self.hyp[:, idims]**2/M)).flatten()
+        sn2 = (ones*(self.hyp[:, idims+1]**2)).flatten()
+        Y = (ones[:, :, None]*self.Y.T).reshape((C*odims, self.X.shape[0]))
+
+        srdotX = sr.dot(self.X.T)
+        phi_f = tt.concatenate([tt.sin(srdotX), tt.cos(srdotX)], axis=1)
+        Phi_f = tt.batched_dot(phi_f, phi_f.transpose(0, 2, 1))
+        A = sf2M[:, None, None]*Phi_f + (sn2 + 1e-6)[:, None, None]*EyeM
+        phi_f_dotY = tt.batched_dot(phi_f, Y)
+        Lmm = utils.linalg.batched_cholesky(A)
+        beta_ss = utils.linalg.batched_cho_solve(Lmm, phi_f_dotY)
+        beta_ss *= sf2M[:, None]
+
+        # the same negative log marginal likelihood as in get_loss
+        YdotY = tt.sum(Y**2, -1)
+        Ydotphidotbeta = tt.sum(phi_f_dotY*beta_ss, -1)
+        loss = 0.5*(YdotY - Ydotphidotbeta)/sn2
+        loss += tt.log(utils.linalg.batched_diagonal(Lmm)).sum(-1)
+        loss += (0.5*N - M)*tt.log(sn2)
+        loss += 0.5*N*np.log(2*np.pi, dtype=floatX)
+        loss = loss.reshape((C, odims))
+
+        # penalty for high frequencies
+        loss += tt.square(W).sum(-1).mean(1)
+        return loss, W
+
+    def resample_ss(self, iters=100, batch_size=10):
+        ''' Draws iters random samples of spectral points and keeps, for
+        every output dimension, the one with the lowest loss. The candidates
+        are evaluated batch_size at a time'''
+        if self.loss_ss_fn is None:
+            loss, W = self.get_ss_candidates_loss()
+            self.loss_ss_fn = theano.function(
+                [W], loss, name='%s>loss_ss' % (self.name),
+                allow_input_downcast=True)
+
+        w_shape = (self.n_inducing, self.E, self.D)
+        best_w = np.random.randn(*w_shape).astype(floatX)
+        best_loss = self.loss_ss_fn(best_w[None])[0]
+        for start in range(0, iters, batch_size):
+            n = min(batch_size, iters - start)
+            W = np.random.randn(n, *w_shape).astype(floatX)
+            loss = self.loss_ss_fn(W)
+            idx = loss.argmin(0)
+            for e in range(self.E):
+                if loss[idx[e], e] < best_loss[e]:
+                    best_loss[e] = loss[idx[e], e]
+                    best_w[:, e, :] = W[idx[e], :, e, :]
+        self.set_ss_samples(best_w)
 
     def train(self, pretrain_full=False):
+        ''' Trains the SSGP hyperparameters. In online mode, the spectral
+        points are only resampled the first time this method is called, and
+        only the signal and noise variances are optimized; i.e. the
+        lengthscales are never fitted, unless pretrain_full is True (which
+        fits them with a full GP on a subsample of the dataset). The
+        sufficient statistics accumulated by append_dataset are reused as
+        long as the spectral points do not change'''
         if pretrain_full:
             self.pretrain_full()
-        self.resample_ss(100)
+        if not self.online or self.ss_stats is None:
+            self.resample_ss(100)
+        if self.online and (self.ss_stats is None or not np.array_equal(
+                self.get_sr_value(), self.ss_stats_sr)):
+            # the spectral points changed (after resampling or pretraining),
+            # so the statistics have to be recomputed for the whole dataset
+            self.update_ss_stats()
         super(SSGP, self).train()
 
     def predict(self, mx, Sx):
@@ -0,0 +1,186 @@
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi import utils
+from kusanagi.ghost.optimizers import SGDOptimizer
+from kusanagi.ghost.regression import cov
+from kusanagi.ghost.regression.GP import GP_UI
+floatX = theano.config.floatX
+
+
+class SVGP(GP_UI):
+    ''' Stochastic variational sparse GP (Hensman et al 2013), trained with
+    minibatches. The inducing outputs are whitened, i.e. u = Lmm v with
+    q(v) = N(q_mu, q_sqrt q_sqrt^T) and Lmm = chol(Kmm). Supports moment
+    matching for uncertain inputs, with the same interface as SPGP_UI'''
+    supports_fast_predict = False
+
+    def __init__(self, X_dataset=None, Y_dataset=None, name='SVGP',
+                 idims=None, odims=None, n_inducing=100, **kwargs):
+        self.X_sp = None  # inducing inputs (symbolic variable)
+        self.q_mu = None
+        self.q_sqrt = None
+        self.n_inducing = n_inducing
+        min_method = kwargs.pop('min_method', 'ADAM')
+        max_evals = kwargs.pop('max_evals', 5000)
+        GP_UI.__init__(self, X_dataset, Y_dataset, name=name, idims=idims,
+                       odims=odims, **kwargs)
+        self.optimizer = SGDOptimizer(min_method, max_evals,
+                                      name=self.name+'_opt')
+
+    def init_params(self):
+        super(SVGP, self).init_params()
+        # initialize the inducing inputs with a random subset of the dataset
+        # and q(v) with the prior N(0, I)
+        X = self.X.get_value()
+        M = self.n_inducing
+        idx = np.random.choice(X.shape[0], M, replace=X.shape[0] < M)
+        X_sp = X[idx] + 1e-3*X.std(0)*np.random.randn(M, self.D)
+        q_mu = np.zeros((self.E, M))
+        q_sqrt = np.tile(np.eye(M), (self.E, 1, 1))
+        self.set_params({'X_sp': X_sp.astype(floatX),
+                         'q_mu': q_mu.astype(floatX),
+                         'q_sqrt': q_sqrt.astype(floatX)})
+
+    def get_Lmm(self):
+        ''' Returns the E x M x M cholesky factors of the covariance of the
+        inducing inputs'''
+        idims = self.D
+        ridge = 1e-6
+        Kmm = cov.SEard_batched(self.hyp[:, :idims+1], self.X_sp)
+        Kmm += ridge*tt.eye(self.X_sp.shape[0])
+        return utils.linalg.batched_cholesky(Kmm)
+
+    def get_predictive_factors(self):
+        ''' Returns beta = Kmm^-1 m_u and iK = Kmm^-1 - Kmm^-1 S_u Kmm^-1,
+        where m_u and S_u are the mean and covariance of q(u). These take
+        the place of beta and iK in the GP prediction equations'''
+        Lmm = self.get_Lmm()
+        q_sqrt = utils.linalg.batched_tril(self.q_sqrt)
+        LmmT = utils.linalg.batched_transpose(Lmm)
+        beta = utils.linalg.batched_solve_upper_triangular(LmmT, self.q_mu)
+        EyeM = tt.eye(self.X_sp.shape[0])*tt.ones_like(Lmm)
+        iLmm = utils.linalg.batched_solve_lower_triangular(Lmm, EyeM)
+        LqT_iLmm = tt.batched_dot(
+            utils.linalg.batched_transpose(q_sqrt), iLmm)
+        iK = tt.batched_dot(utils.linalg.batched_transpose(iLmm), iLmm)
+        iK -= tt.batched_dot(
+            utils.linalg.batched_transpose(LqT_iLmm), LqT_iLmm)
+        return beta, iK
+
+    def get_loss(self, cache_intermediate=True):
+        ''' Returns the negative evidence lower bound, per training sample,
+        for a minibatch of inputs and targets'''
+        utils.print_with_stamp('Building SVGP loss', self.name)
+        self.should_recompile = False
+        idims = self.D
+        train_inputs = tt.matrix('%s>train_inputs' % (self.name))
+        train_targets = tt.matrix('%s>train_targets' % (self.name))
+        N = self.X.shape[0].astype(floatX)
+        B = train_inputs.shape[0].astype(floatX)
+        M = self.X_sp.shape[0].astype(floatX)
+
+        sf2 = self.hyp[:, idims]**2
+        sn2 = self.hyp[:, idims+1]**2
+        Lmm = self.get_Lmm()
+        q_sqrt = utils.linalg.batched_tril(self.q_sqrt)
+
+        # marginals of q(f) at the minibatch inputs
+        Kmn = cov.SEard_batched(
+            self.hyp[:, :idims+1], self.X_sp, train_inputs)
+        A = utils.linalg.batched_solve_lower_triangular(Lmm, Kmn)
+        mean = (A*self.q_mu[:, :, None]).sum(1)
+        LqTA = tt.batched_dot(utils.linalg.batched_transpose(q_sqrt), A)
+        var = sf2[:, None] - (A**2).sum(1) + (LqTA**2).sum(1)
+
+        # expected log likelihood
+        ell = -0.5*tt.log(2*np.pi*sn2)[:, None]
+        ell -= 0.5*(tt.square(train_targets.T - mean) + var)/sn2[:, None]
+
+        # KL(q(v) || p(v))
+        logdet = tt.log(
+            tt.square(utils.linalg.batched_diagonal(q_sqrt))).sum(1)
+        kl = 0.5*(tt.square(q_sqrt).sum((1, 2))
+                  + tt.square(self.q_mu).sum(1) - M - logdet)
+
+        loss = -ell.sum(1)/B + kl/N
+
+        # we add some penalty to avoid having parameters that are too large
+        if self.snr_penalty is not None:
+            penalty_params = {'log_snr': np.log(1000, dtype=floatX),
+                              'log_ls': np.log(100, dtype=floatX),
+                              'log_std': tt.log(
+                                  self.X.std(0)*(N/(N-1.0))),
+                              'p': 30}
+            loss += self.snr_penalty(tt.log(self.hyp), **penalty_params)/N
+
+        inps = [train_inputs, train_targets]
+        updts = theano.updates.OrderedUpdates()
+        self.state_changed = True  # for saving
+        return loss.sum(), inps, updts
+
+    def predict(self, mx, Sx=None, *args, **kwargs):
+        idims = self.D
+        odims = self.E
+        sf2 = self.hyp[:, idims]**2
+        beta, iK = self.get_predictive_factors()
+
+        if Sx is None:
+            x = mx[None, :] if mx.ndim == 1 else mx
+            k = cov.SEard_batched(self.hyp[:, :idims+1], x, self.X_sp)
+            M = (k*beta[:, None, :]).sum(-1)
+            # the variances include the observation noise, as in GP.predict
+            sn2 = self.hyp[:, idims+1]**2
+            S = sf2[:, None] + sn2[:, None]\
+                - (tt.batched_dot(k, iK)*k).sum(-1)
+            if mx.ndim == 1:
+                return M.flatten(), tt.diag(S.flatten()), tt.zeros(
+                    (idims, odims))
+            return M.T, S.T
+
+        # centralize inputs
+        zeta = self.X_sp - mx
+
+        # initialize some variables
+        eyeE = tt.tile(tt.eye(idims), (odims, 1, 1))
+        lscales = self.hyp[:, :idims]
+        iL = eyeE/lscales.dimshuffle(0, 1, 'x')
+
+        # predictive mean and input output covariance
+        inp = iL.dot(zeta.T).transpose(0, 2, 1)
+        M, V = self.first_moments(iL, inp, Sx, sf2, beta)
+
+        # predictive covariance
+        logk = (tt.log(sf2))[:, None] - 0.5*tt.sum(inp*inp, 2)
+        Lambda = tt.square(iL)
+        z_ = Lambda.dot(zeta.T).transpose(0, 2, 1)
+
+        # Eq 2.55, for all the (i, j) output pairs in the upper triangle
+        Q, i, j = self.second_moments(Lambda, logk, z_, Sx)
+        m2 = (beta[i][:, :, None]*Q*beta[j][:, None, :]).sum((1, 2))
+        # the diagonal pairs come first in i, j
+        m2 = tt.inc_subtensor(
+            m2[:odims], sf2 + 1e-6 - (iK*Q[:odims]).sum((1, 2)))
+        M2 = tt.set_subtensor(tt.zeros((odims, odims))[i, j], m2)
+        M2 = M2 + tt.triu(M2, k=1).T
+        S = M2 - tt.outer(M, M)
+
+        return M, S, V
+
+    def train(self, batch_size=100, lr=1e-3, optimizer=None, callback=None):
+        if optimizer is None:
+            optimizer = self.optimizer
+        if optimizer.loss_fn is None or self.should_recompile:
+            loss, inps, updts = self.get_loss()
+            # we pass the learning rate as an input, and as a parameter to the
+            # updates method
+            learning_rate = theano.tensor.scalar('lr')
+            inps.append(learning_rate)
+            optimizer.set_objective(loss, self.get_params(symbolic=True),
+                                    inps, updts, learning_rate=learning_rate)
+
+        optimizer.minibatch_minimize(self.X.get_value(), self.Y.get_value(),
+                                     lr, batch_size=batch_size,
+                                     callback=callback)
+        self.trained = True
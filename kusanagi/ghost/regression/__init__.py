@@ -3,3 +3,6 @@ from .GP import *
 from .SPGP import *
 from .SSGP import *
 from .NN import *
+from .EnsembleNN import *
+from .SVGP import *
+from .GPExperts import *
@@ -55,3 +55,42 @@ def Sum(hyp_l, cov_l, X1, X2=None, all_pairs=True):
     K = sum([cov_l[i](hyp_l[i], X1, X2, all_pairs=all_pairs)
              for i in range(len(cov_l))])
     return K
+
+
+def SEard_batched(hyp, X1, X2=None):
+    ''' Squared exponential kernel with diagonal scaling matrix, evaluated for
+        a stack of hyperparameter vectors (one per output dimension). Returns
+        a E x N1 x N2 tensor, where E is the number of rows in hyp. X1 and X2
+        can be matrices (shared by all the output dimensions) or E x N x D
+        tensors (one set of inputs per output dimension)'''
+    idims = X1.shape[-1]
+    sf2 = hyp[:, idims]**2
+    ls = hyp[:, :idims]
+    X1s = (X1 if X1.ndim == 3 else X1[None, :, :])/ls[:, None, :]
+    if X2 is None:
+        X2s = X1s
+    else:
+        X2s = (X2 if X2.ndim == 3 else X2[None, :, :])/ls[:, None, :]
+    D = tt.sum(tt.square(X1s), 2)[:, :, None]\
+        + tt.sum(tt.square(X2s), 2)[:, None, :]\
+        - 2*tt.batched_dot(X1s, X2s.transpose(0, 2, 1))
+    K = sf2[:, None, None]*tt.exp(-0.5*D)
+    return K
+
+
+def Noise_batched(hyp, X1, X2=None):
+    ''' Noise kernel, evaluated for a stack of noise hyperparameters (one per
+    output dimension). Returns a E x N1 x N2 tensor'''
+    sn2 = hyp**2
+    if X2 is None or X1 is X2:
+        K = tt.eye(X1.shape[-2])[None, :, :]*sn2[:, None, None]
+        return K
+    else:
+        return 0
+
+
+def Sum_batched(hyp_l, cov_l, X1, X2=None):
+    ''' Returns the sum of multiple batched covariance functions'''
+    K = sum([cov_l[i](hyp_l[i], X1, X2)
+             for i in range(len(cov_l))])
+    return K
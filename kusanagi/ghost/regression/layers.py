@@ -216,6 +216,16 @@ class DenseDropoutLayer(lasagne.layers.DenseLayer):
 
         return noise
 
+    def get_fixed_noise(self, n):
+        ''' Returns the shared noise samples for the first n inputs. The
+        shared variable may hold samples for more inputs than n; e.g. when
+        it is resampled for the largest number of particles in use'''
+        shared_axes = tuple(a if a >= 0 else a + self.noise.ndim
+                            for a in self.shared_axes)
+        if 0 in shared_axes:
+            return self.noise
+        return self.noise[:n]
+
     def sample_noise(self, input):
         # get noise_shape
         noise_shape = self.input_shape
@@ -262,7 +272,7 @@ class DenseDropoutLayer(lasagne.layers.DenseLayer):
 
                 # store updates so we can control when to get new samples
                 self.updates[self.noise] = noise
-                noise = self.noise
+                noise = self.get_fixed_noise(input.shape[0])
 
             input = self.apply_noise(input, noise)
 
@@ -466,7 +476,7 @@ class DenseAdditiveGaussianDropoutLayer(DenseGaussianDropoutLayer):
 
                 # store updates so we can control when to get new samples
                 self.updates[self.noise] = noise
-                noise = self.noise
+                noise = self.get_fixed_noise(input.shape[0])
 
             activation = m_act + noise*tt.sqrt(S_act)
 
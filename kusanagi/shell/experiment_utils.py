@@ -130,18 +130,21 @@ def setup_mc_pilco_experiment(params, pol=None, dyn=None):
 
     # init dynmodel
     if dyn is None:
-        dyn = regression.BNN(**params['dynamics_model'])
-        if dyn_spec is None:
-            odims = 2*dyn.E if dyn.heteroscedastic else dyn.E
-            dyn_spec = regression.dropout_mlp(
-                input_dims=dyn.D,
-                output_dims=odims,
-                hidden_dims=[200]*2,
-                p=0.1, p_input=0.1,
-                nonlinearities=nonlinearities.rectify,
-                dropout_class=regression.layers.DenseLogNormalDropoutLayer,
-                name=dyn.name)
-        dyn.network = dyn.build_network(dyn_spec)
+        dynmodel_class = params.get('dynmodel_class', regression.BNN)
+        dyn = dynmodel_class(**params['dynamics_model'])
+        # the members of an EnsembleNN are built by its constructor
+        if not isinstance(dyn, regression.EnsembleNN):
+            if dyn_spec is None:
+                odims = 2*dyn.E if dyn.heteroscedastic else dyn.E
+                dyn_spec = regression.dropout_mlp(
+                    input_dims=dyn.D,
+                    output_dims=odims,
+                    hidden_dims=[200]*2,
+                    p=0.1, p_input=0.1,
+                    nonlinearities=nonlinearities.rectify,
+                    dropout_class=regression.layers.DenseLogNormalDropoutLayer,
+                    name=dyn.name)
+            dyn.network = dyn.build_network(dyn_spec)
 
     # create experience dataset
     exp = ExperienceDataset()
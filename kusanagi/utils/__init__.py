@@ -1,3 +1,5 @@
 from . import updates
 from . import distributions
+from . import linalg
+from . import function_cache
 from .utils_ import *
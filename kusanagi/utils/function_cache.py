@@ -0,0 +1,246 @@
+'''
+Persistent on-disk cache of compiled theano functions. The cache key is a
+hash of the computation graph (including the updates and givens), the types
+of the inputs and shared variables, the values of the constants in the graph
+and the compilation flags. When a function with the same key has been
+compiled before (e.g. in a previous run of the same experiment), the
+compiled function is loaded from disk and rebound to the shared variables of
+the current graph, skipping the graph optimization step.
+
+The cache is disabled by default. It is enabled by setting the cache
+directory via the $KUSANAGI_FUNCTION_CACHE environment variable (or
+set_function_cache_dir); an empty string disables it again. The total size of
+the cache is bounded by $KUSANAGI_FUNCTION_CACHE_MB (1024 MB by default); the
+least recently used functions are removed when the bound is exceeded.
+
+WARNING: the cached functions are stored as pickles, and any file in the
+cache directory with a matching name is unpickled when the corresponding
+function is requested. Unpickling can execute arbitrary code, so only point
+the cache to a directory that is not writable by untrusted users.
+'''
+import hashlib
+import numpy as np
+import os
+import pickle
+import sys
+import theano
+
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof import Constant, graph
+from .utils_ import print_with_stamp
+
+
+def get_function_cache_dir():
+    ''' Returns the folder where the compiled functions are stored, as set
+    via the $KUSANAGI_FUNCTION_CACHE environment variable. If not set, or set
+    to an empty string, the cache is disabled and this method returns an
+    empty string. The directory will be created by this method, if it does
+    not exist. Note that the files in this directory are unpickled when
+    loading cached functions.'''
+    cache_dir = os.environ.get('KUSANAGI_FUNCTION_CACHE', '')
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    return cache_dir
+
+
+def set_function_cache_dir(new_path):
+    ''' Sets the folder where the compiled functions are stored, enabling
+    the cache. Pass an empty string to disable the cache'''
+    os.environ['KUSANAGI_FUNCTION_CACHE'] = new_path
+
+
+def get_function_cache_size():
+    ''' Returns the maximum size of the function cache, in bytes. This can be
+    set via the $KUSANAGI_FUNCTION_CACHE_MB environment variable, in
+    megabytes (1024 by default)'''
+    size_mb = float(os.environ.get('KUSANAGI_FUNCTION_CACHE_MB', 1024))
+    return int(size_mb*2**20)
+
+
+def evict(cache_dir, max_size=None):
+    ''' Removes the least recently used functions (by modification time,
+    which is refreshed whenever a function is loaded) from cache_dir, until
+    the total size of the cached functions is below max_size bytes.
+    @param cache_dir the function cache directory
+    @param max_size maximum size in bytes. If None, the value returned by
+           get_function_cache_size is used
+    '''
+    if max_size is None:
+        max_size = get_function_cache_size()
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if not fname.endswith('.pkl'):
+            continue
+        path = os.path.join(cache_dir, fname)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # removed by another process
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _as_pairs(d):
+    if d is None:
+        return []
+    if hasattr(d, 'items'):
+        return list(d.items())
+    return list(d)
+
+
+def _mode_key(mode):
+    if mode is None or isinstance(mode, str):
+        return mode
+    # only the predefined modes can be identified across runs
+    for name, predefined in theano.compile.mode.predefined_modes.items():
+        if mode is predefined:
+            return name
+    raise ValueError('Cannot hash compilation mode %s' % (str(mode)))
+
+
+def function_key(inputs, outputs, updates=None, givens=None, **kwargs):
+    '''
+    Returns a hash that identifies the function that would be compiled by
+    theano.function with the same arguments, and the list of the shared
+    variables that the function depends on, in a canonical order. Only the
+    types of the shared variables are used for the key (not their values or
+    shapes), since the compiled functions do not depend on them.
+    '''
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    updates = _as_pairs(updates)
+    givens = _as_pairs(givens)
+    variables = list(inputs) + list(outputs)
+    variables += [v for pair in updates + givens for v in pair]
+
+    # the string representation of the graph
+    h = hashlib.sha1()
+    graph_str = theano.printing.debugprint(
+        variables, file='str', ids='CHAR', print_type=True)
+    h.update(graph_str.encode())
+
+    # the shared variables and constants that the graph depends on
+    shared = []
+    for v in graph.inputs(variables):
+        if isinstance(v, SharedVariable):
+            if v not in shared:
+                shared.append(v)
+            h.update(str((v.name, v.type)).encode())
+        elif isinstance(v, Constant):
+            try:
+                h.update(np.asarray(v.data).tobytes())
+            except Exception:
+                h.update(repr(v.data).encode())
+
+    # which shared variables are updated
+    h.update(str([shared.index(k) for k, u in updates]).encode())
+
+    # compilation flags
+    kwargs['mode'] = _mode_key(kwargs.get('mode'))
+    flags = [(k, str(kwargs[k])) for k in sorted(kwargs.keys())]
+    flags += [theano.__version__, theano.config.floatX, theano.config.device,
+              theano.config.mode, theano.config.linker,
+              theano.config.optimizer, sys.version]
+    h.update(str(flags).encode())
+
+    return h.hexdigest(), shared
+
+
+def save_function(fn, shared, path):
+    ''' Stores the compiled function fn, along with the position of each of
+    its shared variables in the canonical list returned by function_key'''
+    implicit = [i.variable for i in fn.maker.inputs if i.implicit]
+    shared_idx = []
+    for v in implicit:
+        idx = [k for k, s in enumerate(shared) if s is v]
+        if len(idx) == 0:
+            # a shared variable we can't rebind later
+            return False
+        shared_idx.append(idx[0])
+
+    rec_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(rec_limit, 100000))
+    try:
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'fn': fn, 'shared_idx': shared_idx}, f, -1)
+        os.replace(tmp_path, path)
+    finally:
+        sys.setrecursionlimit(rec_limit)
+    return True
+
+
+def load_function(shared, path):
+    ''' Loads a compiled function from path, and rebinds it to the current
+    shared variables. Returns None if the function could not be loaded'''
+    rec_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(rec_limit, 100000))
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    finally:
+        sys.setrecursionlimit(rec_limit)
+    fn, shared_idx = state['fn'], state['shared_idx']
+    implicit = [i.variable for i in fn.maker.inputs if i.implicit]
+    if len(implicit) != len(shared_idx) or any(
+            k >= len(shared) for k in shared_idx):
+        return None
+    swap = dict((v, shared[k]) for v, k in zip(implicit, shared_idx))
+    return fn.copy(swap=swap, name=fn.name)
+
+
+def function(inputs, outputs=None, **kwargs):
+    '''
+    Drop-in replacement for theano.function, that stores the compiled
+    function in the function cache and reuses it whenever a function with
+    the same graph, types and flags is requested.
+    '''
+    cache_dir = get_function_cache_dir()
+    name = kwargs.get('name')
+    name = 'function_cache' if name is None else name
+    path = None
+    if cache_dir:
+        try:
+            key, shared = function_key(inputs, outputs, **kwargs)
+            path = os.path.join(cache_dir, '%s.pkl' % (key))
+        except Exception as e:
+            print_with_stamp('Not caching function (%s)' % (str(e)), name)
+
+    if path is not None and os.path.isfile(path):
+        try:
+            fn = load_function(shared, path)
+            if fn is not None:
+                # mark as recently used, for eviction
+                os.utime(path, None)
+                print_with_stamp('Loaded compiled function from %s' % (path),
+                                 name)
+                return fn
+        except Exception as e:
+            print_with_stamp(
+                'Failed loading compiled function (%s)' % (str(e)), name)
+
+    fn = theano.function(inputs, outputs, **kwargs)
+
+    if path is not None:
+        try:
+            if save_function(fn, shared, path):
+                print_with_stamp('Saved compiled function to %s' % (path),
+                                 name)
+                evict(cache_dir)
+        except Exception as e:
+            print_with_stamp(
+                'Failed saving compiled function (%s)' % (str(e)), name)
+    return fn
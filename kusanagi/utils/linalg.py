@@ -0,0 +1,278 @@
+'''
+Batched linear algebra operations. Every op in this module operates on
+stacks of matrices (the first axis is the batch axis), so that operations
+that are done once per output dimension in the regression models can be
+expressed as a single node in the computation graph, instead of a scan or a
+python loop over output dimensions.
+'''
+import numpy as np
+import scipy.linalg
+import theano
+import theano.tensor as tt
+
+from theano.gof import Op, Apply
+
+
+def batched_tril(x, k=0):
+    ''' Lower triangular part of every matrix in the stack x'''
+    mask = tt.tri(x.shape[-2], x.shape[-1], k=k, dtype=x.dtype)
+    return x*mask
+
+
+def batched_triu(x, k=0):
+    ''' Upper triangular part of every matrix in the stack x'''
+    mask = 1 - tt.tri(x.shape[-2], x.shape[-1], k=k-1, dtype=x.dtype)
+    return x*mask
+
+
+def batched_diagonal(x):
+    ''' Returns the diagonal of every matrix in the stack x'''
+    idx = tt.arange(x.shape[-1])
+    return x[:, idx, idx]
+
+
+def batched_transpose(x):
+    ''' Transposes every matrix in the stack x'''
+    return x.transpose(0, 2, 1)
+
+
+class BatchedCholesky(Op):
+    '''
+    Returns the lower triangular Cholesky factor of every matrix in a stack
+    of symmetric positive definite matrices.
+    '''
+    __props__ = ()
+
+    def make_node(self, x):
+        x = tt.as_tensor_variable(x)
+        assert x.ndim == 3
+        return Apply(self, [x], [x.type()])
+
+    def perform(self, node, inputs, outputs):
+        x, = inputs
+        # numpy's cholesky broadcasts over the leading axes
+        outputs[0][0] = np.linalg.cholesky(x).astype(x.dtype)
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0]]
+
+    def L_op(self, inputs, outputs, gradients):
+        x, = inputs
+        L, = outputs
+        dz, = gradients
+        return [BatchedCholeskyGrad()(x, L, dz)]
+
+
+class BatchedCholeskyGrad(Op):
+    '''
+    Gradient of the batched Cholesky decomposition. This is the batched
+    version of theano.tensor.slinalg.CholeskyGrad (Murray, 2016).
+    '''
+    __props__ = ()
+
+    def make_node(self, x, L, dz):
+        x = tt.as_tensor_variable(x)
+        L = tt.as_tensor_variable(L)
+        dz = tt.as_tensor_variable(dz)
+        assert x.ndim == 3 and L.ndim == 3 and dz.ndim == 3
+        return Apply(self, [x, L, dz], [x.type()])
+
+    def perform(self, node, inputs, outputs):
+        x, L, dz = inputs
+        grad = np.empty_like(x)
+        for i in range(x.shape[0]):
+            phi = np.tril(L[i].T.dot(dz[i]))
+            phi[np.diag_indices_from(phi)] *= 0.5
+            # s = L^-T phi L^-1
+            s = scipy.linalg.solve_triangular(
+                L[i], phi.T, lower=True, trans='T')
+            s = scipy.linalg.solve_triangular(
+                L[i], s.T, lower=True, trans='T')
+            grad[i] = np.tril(s + s.T) - np.diag(np.diag(s))
+        outputs[0][0] = grad
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0]]
+
+
+class BatchedSolveTriangular(Op):
+    '''
+    Solves A[i] x[i] = b[i] for every triangular matrix A[i] in a stack.
+    b can be a stack of vectors (2d tensor) or a stack of matrices
+    (3d tensor).
+    '''
+    __props__ = ('lower',)
+
+    def __init__(self, lower=True):
+        self.lower = lower
+
+    def make_node(self, A, b):
+        A = tt.as_tensor_variable(A)
+        b = tt.as_tensor_variable(b)
+        assert A.ndim == 3
+        assert b.ndim in (2, 3)
+        dtype = theano.scalar.upcast(A.dtype, b.dtype)
+        x = tt.TensorType(dtype, b.broadcastable)()
+        return Apply(self, [A, b], [x])
+
+    def perform(self, node, inputs, outputs):
+        A, b = inputs
+        dtype = node.outputs[0].dtype
+        x = np.empty(b.shape, dtype=dtype)
+        for i in range(A.shape[0]):
+            x[i] = scipy.linalg.solve_triangular(
+                A[i], b[i], lower=self.lower)
+        outputs[0][0] = x
+
+    def infer_shape(self, node, shapes):
+        return [shapes[1]]
+
+    def L_op(self, inputs, outputs, gradients):
+        A, b = inputs
+        x, = outputs
+        xbar, = gradients
+        # b_bar = A^-T x_bar
+        bbar = BatchedSolveTriangular(not self.lower)(
+            batched_transpose(A), xbar)
+        # A_bar = -b_bar x^T (only the triangular part is used by this op)
+        if b.ndim == 2:
+            Abar = -bbar[:, :, None]*x[:, None, :]
+        else:
+            Abar = -tt.batched_dot(bbar, batched_transpose(x))
+        Abar = batched_tril(Abar) if self.lower else batched_triu(Abar)
+        return [Abar, bbar]
+
+
+batched_cholesky = BatchedCholesky()
+batched_solve_lower_triangular = BatchedSolveTriangular(lower=True)
+batched_solve_upper_triangular = BatchedSolveTriangular(lower=False)
+
+
+def batched_cho_solve(L, b):
+    ''' Solves (L[i] L[i]^T) x[i] = b[i] for every lower triangular
+    Cholesky factor in the stack L'''
+    return batched_solve_upper_triangular(
+        batched_transpose(L), batched_solve_lower_triangular(L, b))
+
+
+def cholesky_append(L11, K12, K22):
+    '''
+    Block update of a stack of Cholesky factors (numpy arrays), for kernel
+    matrices that grow by H rows and columns; i.e. given L11 = chol(K11),
+    returns chol([[K11, K12], [K12^T, K22]]) in O(N^2 H) operations.
+    @param L11 E x N x N lower triangular cholesky factors of K11
+    @param K12 E x N x H cross covariance matrices
+    @param K22 E x H x H covariance matrices of the new rows
+    @return L E x (N+H) x (N+H) lower triangular cholesky factors and the
+            E x H x H cholesky factors of the schur complement of K11
+    '''
+    E, N, H = K12.shape
+    L = np.zeros((E, N+H, N+H), dtype=L11.dtype)
+    L22 = np.zeros((E, H, H), dtype=L11.dtype)
+    for i in range(E):
+        L21 = scipy.linalg.solve_triangular(L11[i], K12[i], lower=True).T
+        L22[i] = np.linalg.cholesky(K22[i] - L21.dot(L21.T))
+        L[i, :N, :N] = L11[i]
+        L[i, N:, :N] = L21
+        L[i, N:, N:] = L22[i]
+    return L, L22
+
+
+def inverse_append(iK11, K12, L22):
+    '''
+    Block update of a stack of inverse kernel matrices (numpy arrays), for
+    kernel matrices that grow by H rows and columns. Uses the cholesky
+    factors of the schur complement returned by cholesky_append.
+    @param iK11 E x N x N inverse kernel matrices
+    @param K12 E x N x H cross covariance matrices
+    @param L22 E x H x H cholesky factors of the schur complement of K11
+    @return iK E x (N+H) x (N+H) inverse kernel matrices
+    '''
+    E, N, H = K12.shape
+    iK = np.empty((E, N+H, N+H), dtype=iK11.dtype)
+    eyeH = np.eye(H, dtype=iK11.dtype)
+    for i in range(E):
+        iS = scipy.linalg.cho_solve((L22[i], True), eyeH)
+        iK11K12 = iK11[i].dot(K12[i])
+        iK12 = -iK11K12.dot(iS)
+        iK[i, :N, :N] = iK11[i] - iK12.dot(iK11K12.T)
+        iK[i, :N, N:] = iK12
+        iK[i, N:, :N] = iK12.T
+        iK[i, N:, N:] = iS
+    return iK
+
+
+def batched_cg(matvec, B, n_iters=50, tol=1e-12):
+    '''
+    Solves the systems A[i] X[i] = B[i] with (multiple right hand side)
+    batched conjugate gradients, for symmetric positive definite matrices
+    that are only accessed through matrix-vector products (mBCG, Gardner et
+    al 2018). Runs a fixed number of iterations; the columns whose relative
+    residual falls below tol stop being updated.
+    @param matvec function that takes a E x N x R tensor V and returns the
+           E x N x R products A[i] V[i]
+    @param B E x N x R right hand sides
+    @param n_iters number of iterations
+    @param tol threshold on the squared norm of the residuals, relative to
+           the squared norm of B
+    @return the E x N x R solutions, and the n_iters x E x R step sizes
+            (alpha) and conjugate direction coefficients (beta) of every
+            iteration, which determine the Lanczos tridiagonal matrices
+    '''
+    rr0 = (B*B).sum(1)
+
+    def cg_step(X, R, P, rr, rr0):
+        AP = matvec(P)
+        converged = rr <= tol*rr0
+        pAP = tt.switch(converged, 1, (P*AP).sum(1))
+        alpha = tt.switch(converged, 0, rr/pAP)
+        X = X + alpha[:, None, :]*P
+        R = R - alpha[:, None, :]*AP
+        rr_new = (R*R).sum(1)
+        beta = tt.switch(converged, 0, rr_new/tt.switch(converged, 1, rr))
+        P = R + beta[:, None, :]*P
+        return X, R, P, rr_new, alpha, beta
+
+    outs, updts = theano.scan(
+        fn=cg_step, outputs_info=[tt.zeros_like(B), B, B, rr0, None, None],
+        non_sequences=[rr0], n_steps=n_iters, name='batched_cg')
+    X, alpha, beta = outs[0][-1], outs[4], outs[5]
+    return X, alpha, beta
+
+
+def lanczos_logdet(alpha, beta, z_norm2):
+    '''
+    Stochastic Lanczos quadrature estimate of log|A[i]|, from the
+    coefficients returned by batched_cg when solving A[i] u = z for a set
+    of random probe vectors z with E[z z^T] = I (Ubaru et al 2017).
+    @param alpha m x E x T step sizes of the CG iterations
+    @param beta m x E x T conjugate direction coefficients
+    @param z_norm2 E x T squared norms of the probe vectors
+    @return the E log determinant estimates
+    '''
+    m, E, T = alpha.shape[0], alpha.shape[1], alpha.shape[2]
+    # the iterations after convergence are decoupled from the first
+    # lanczos vector, so they don't contribute to the quadrature
+    valid = alpha > 0
+    a = tt.switch(valid, alpha, 1)
+    d = 1.0/a
+    d = tt.inc_subtensor(d[1:], beta[:-1]/a[:-1])
+    d = tt.switch(valid, d, 1)
+    e = tt.switch(valid[1:], tt.sqrt(beta[:-1])/a[:-1], 0)
+
+    # E*T x m x m lanczos tridiagonal matrices
+    d = d.reshape((m, E*T)).T
+    e = e.reshape((m-1, E*T)).T
+    idx = tt.arange(m)
+    Tm = tt.zeros((E*T, m, m))
+    Tm = tt.set_subtensor(Tm[:, idx, idx], d)
+    Tm = tt.set_subtensor(Tm[:, idx[:-1], idx[1:]], e)
+    Tm = tt.set_subtensor(Tm[:, idx[1:], idx[:-1]], e)
+
+    def quadrature(Tm):
+        w, V = tt.nlinalg.eigh(Tm)
+        return (V[0]**2*tt.log(tt.largest(w, 1e-12))).sum()
+
+    q, updts = theano.scan(fn=quadrature, sequences=[Tm],
+                           name='lanczos_quadrature')
+    return (q.reshape((E, T))*z_norm2).mean(1)
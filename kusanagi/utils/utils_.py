@@ -5,7 +5,6 @@ import lasagne
 import math
 import numpy as np
 import os
-import random
 import theano
 import time
 import sys
@@ -150,27 +149,106 @@ def print_with_stamp(message, name=None, same_line=False, use_log=True):
         os.system('chmod 666 %s' % (logfile))
 
 
-def kmeanspp(X, k):
+def kmeanspp(X, k, rng=None):
     '''
-    Initializer for kmeans
+    Initializer for kmeans (k-means++ seeding). We only keep track of the
+    squared distance from every point to its closest center, so adding a
+    center costs O(N) time and memory
     '''
+    rng = np.random if rng is None else rng
     N = X.shape[0]
-    c = [X[random.randint(0, N)]]
-    d = np.full((k, N), np.inf)
-    while len(c) < k:
-        i = len(c) - 1
-        # get distance from dataset to latest center
-        d[i] = np.sum((X-c[i])**2, 1)
-        # get minimum distances
-        min_dists = d[:i+1].min(0)
-        # select next center with probability proportional to the inverse
+    idx = np.empty(k, dtype=np.int64)
+    idx[0] = rng.randint(N)
+    min_dists = np.sum((X - X[idx[0]])**2, 1)
+    for i in range(1, k):
+        # select next center with probability proportional to the squared
         # minimum distance
-        selection_prob = np.cumsum(min_dists/min_dists.sum())
-        r = random.uniform(0, 1)
-        j = np.searchsorted(selection_prob, r)
-        c.append(X[j])
+        cum_dists = np.cumsum(min_dists)
+        if cum_dists[-1] > 0:
+            r = rng.uniform(0, cum_dists[-1])
+            j = min(np.searchsorted(cum_dists, r), N-1)
+        else:
+            j = rng.randint(N)
+        idx[i] = j
+        # update minimum distances with the latest center
+        np.minimum(min_dists, np.sum((X - X[j])**2, 1), out=min_dists)
+
+    return X[idx]
+
 
-    return np.array(c)
+def nearest_center(X, centers, chunk_size=1000):
+    '''
+    Returns the index of the closest center for every row of X. The distances
+    are evaluated in chunks of chunk_size rows
+    '''
+    sq_centers = np.sum(centers**2, 1)
+    idx = np.empty(X.shape[0], dtype=np.int64)
+    for i in range(0, X.shape[0], chunk_size):
+        x = X[i:i+chunk_size]
+        d = sq_centers[None, :] - 2*x.dot(centers.T)
+        idx[i:i+chunk_size] = d.argmin(1)
+    return idx
+
+
+def minibatch_kmeans(X, centers, batch_size=1000, max_iters=200,
+                     time_budget=None, tol=1e-6, warm_start=False, rng=None):
+    '''
+    Mini-batch k-means (Sculley 2010). Refines the initial centers using
+    mini-batches sampled (with replacement) from the dataset, until the
+    centers stop moving, the maximum number of iterations is reached or the
+    time budget runs out.
+    @param X dataset (N x D)
+    @param centers initial centers (k x D)
+    @param batch_size number of samples per iteration
+    @param max_iters maximum number of iterations
+    @param time_budget maximum time in seconds (None means no limit)
+    @param tol convergence threshold on the squared displacement of the
+           centers, relative to the total variance of the dataset
+    @param warm_start if True, the initial centers are assumed to be the
+           result of a previous run (e.g. on a subset of X). The per-center
+           counts are initialized with the number of points assigned to
+           each center, so the centers move less on the first iterations
+    @return the final centers (k x D)
+    '''
+    rng = np.random if rng is None else rng
+    start_time = time.time()
+    N = X.shape[0]
+    centers = np.array(centers, dtype=X.dtype)
+    k = centers.shape[0]
+    batch_size = min(batch_size, N)
+    if warm_start:
+        counts = np.bincount(nearest_center(X, centers), minlength=k)
+        counts = counts.astype(X.dtype)
+    else:
+        counts = np.zeros(k, dtype=X.dtype)
+    thr = tol*np.sum(X.var(0))
+
+    for i in range(max_iters):
+        if batch_size < N:
+            batch = X[rng.randint(0, N, batch_size)]
+        else:
+            batch = X
+        # assign the samples in the batch to their closest centers
+        idx = nearest_center(batch, centers, chunk_size=batch_size)
+        batch_counts = np.bincount(idx, minlength=k)
+        batch_sums = np.zeros_like(centers)
+        np.add.at(batch_sums, idx, batch)
+
+        # move each center towards the mean of its assigned samples, with a
+        # per-center learning rate of (batch count / total count)
+        m = batch_counts > 0
+        counts[m] += batch_counts[m]
+        eta = (batch_counts[m]/counts[m])[:, None]
+        batch_means = batch_sums[m]/batch_counts[m][:, None]
+        delta = eta*(batch_means - centers[m])
+        centers[m] += delta
+
+        if np.sum(delta**2) <= thr:
+            break
+        if time_budget is not None and time.time() - start_time > time_budget:
+            break
+
+    return centers
 
 
 def gTrig(x, angi, D=None):
@@ -404,6 +482,36 @@ def unwrap_params(P, parameter_shapes):
     return p
 
 
+def update_moments(moments, X):
+    ''' Merges the running moments of a dataset with the moments of the rows
+    of X (the batch version of Welford's algorithm, by Chan et al), without
+    revisiting the previous samples.
+    @param moments tuple (n, mean, M2) with the number of samples, the mean
+                   and the sum of the outer products of the deviations from
+                   the mean. If None, the moments of X are returned
+    @param X n x D matrix of new samples
+    @return the updated (n, mean, M2) tuple. The sample covariance is
+            M2/(n-1)
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    if X.ndim == 1:
+        X = X[:, None]
+    n_b = X.shape[0]
+    if n_b == 0 and moments is not None:
+        return moments
+    mean_b = X.mean(0)
+    dX = X - mean_b
+    M2_b = dX.T.dot(dX)
+    if moments is None or moments[0] == 0:
+        return n_b, mean_b, M2_b
+    n_a, mean_a, M2_a = moments
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta*(float(n_b)/n)
+    M2 = M2_a + M2_b + np.outer(delta, delta)*(float(n_a*n_b)/n)
+    return n, mean, M2
+
+
 class MemoizeJac(object):
     def __init__(self, fun, args=()):
         self.fun = fun
@@ -412,19 +520,23 @@ class MemoizeJac(object):
         self.args = tuple(args)
 
     def _compute(self, x, *args):
-        self.x = np.asarray(x).copy()
+        # reuse the buffer for the last evaluation point
+        if self.x is None or self.x.shape != np.shape(x):
+            self.x = np.array(x)
+        else:
+            np.copyto(self.x, x)
         args += self.args
         self.value, self.jac = self.fun(x, *args)
 
     def __call__(self, x, *args):
-        if self.value is not None and np.alltrue(x == self.x):
+        if self.value is not None and np.array_equal(x, self.x):
             return self.value
         else:
             self._compute(x, *args)
             return self.value
 
     def derivative(self, x, *args):
-        if self.jac is not None and np.alltrue(x == self.x):
+        if self.jac is not None and np.array_equal(x, self.x):
             return self.jac
         else:
             self._compute(x, *args)
@@ -0,0 +1,302 @@
+import argparse
+import numpy as np
+import theano
+from functools import partial
+from time import time
+
+from kusanagi.ghost import regression, control, algorithms
+from kusanagi.shell import cartpole
+from kusanagi import utils
+from testGPRegressor import build_dataset
+
+np.set_printoptions(linewidth=500, precision=6, suppress=True)
+
+
+def time_fn(fn, n_evals=10, *args):
+    ''' Returns the average time per call of fn (after a warmup call)'''
+    fn(*args)
+    start_time = time()
+    for i in range(n_evals):
+        fn(*args)
+    return (time() - start_time)/n_evals
+
+
+def benchmark_loss(n_train_list, odims_list, idims=4, n_evals=10):
+    ''' Compares the evaluation time of the GP loss and its gradients, when
+    computed with a scan over output dimensions and with batched linear
+    algebra ops'''
+    results = []
+    for odims in odims_list:
+        for n_train in n_train_list:
+            train_dataset, test_dataset = build_dataset(
+                idims=idims, odims=odims, n_train=n_train, n_test=1,
+                rand_seed=31337)
+            times = []
+            for batched_loss in [False, True]:
+                gp = regression.GP(
+                    train_dataset[0], train_dataset[1], idims=idims,
+                    odims=odims, batched_loss=batched_loss)
+                loss, inps, updts = gp.get_loss()
+                params = gp.get_params(symbolic=True)
+                dloss = theano.grad(loss, params)
+                start_time = time()
+                fn = theano.function(
+                    inps, [loss]+dloss, updates=updts,
+                    allow_input_downcast=True)
+                compile_time = time() - start_time
+                times.append((compile_time, time_fn(fn, n_evals)))
+            (c_scan, t_scan), (c_batched, t_batched) = times
+            results.append((n_train, odims, c_scan, c_batched,
+                            t_scan, t_batched))
+            msg = 'N: %d, E: %d, compile (scan/batched): %f / %f s, '
+            msg += 'loss+grad (scan/batched): %f / %f s, speedup: %f'
+            utils.print_with_stamp(
+                msg % (n_train, odims, c_scan, c_batched,
+                       t_scan, t_batched, t_scan/t_batched),
+                'benchmark_loss')
+    return results
+
+
+def benchmark_cg_loss(n_train_list, odims_list, idims=4, n_evals=10):
+    ''' Compares the evaluation time and value of the GP loss and its
+    gradients, when computed with batched cholesky decompositions and with
+    conjugate gradients (matrix-free)'''
+    results = []
+    for odims in odims_list:
+        for n_train in n_train_list:
+            train_dataset, test_dataset = build_dataset(
+                idims=idims, odims=odims, n_train=n_train, n_test=1,
+                rand_seed=31337)
+            times = []
+            for cg_loss in [False, True]:
+                gp = regression.GP(
+                    train_dataset[0], train_dataset[1], idims=idims,
+                    odims=odims, batched_loss=True, cg_loss=cg_loss)
+                loss, inps, updts = gp.get_loss()
+                params = gp.get_params(symbolic=True)
+                dloss = theano.grad(loss, params)
+                fn = theano.function(
+                    inps, [loss]+dloss, updates=updts,
+                    allow_input_downcast=True)
+                times.append((fn()[0], time_fn(fn, n_evals)))
+            (l_chol, t_chol), (l_cg, t_cg) = times
+            results.append((n_train, odims, l_chol, l_cg, t_chol, t_cg))
+            msg = 'N: %d, E: %d, loss (cholesky/cg): %f / %f, '
+            msg += 'loss+grad (cholesky/cg): %f / %f s, speedup: %f'
+            utils.print_with_stamp(
+                msg % (n_train, odims, l_chol, l_cg, t_chol, t_cg,
+                       t_chol/t_cg),
+                'benchmark_cg_loss')
+    return results
+
+
+def nlml_float64(gp):
+    ''' Reference negative log marginal likelihood (without the
+    hyperparameter penalty), computed with numpy in float64'''
+    idims = gp.D
+    hyp = gp.hyp.eval().astype(np.float64)
+    X = gp.X.get_value().astype(np.float64)
+    Y = gp.Y.get_value().astype(np.float64)
+    nlml = 0
+    for i in range(gp.E):
+        Xs = X/hyp[i, :idims]
+        sq = np.sum(Xs**2, 1)
+        K = sq[:, None] + sq[None, :] - 2*Xs.dot(Xs.T)
+        K = hyp[i, idims]**2*np.exp(-0.5*K)
+        K += hyp[i, idims+1]**2*np.eye(X.shape[0])
+        L = np.linalg.cholesky(K)
+        beta = np.linalg.solve(L.T, np.linalg.solve(L, Y[:, i]))
+        nlml += 0.5*Y[:, i].dot(beta) + np.log(np.diag(L)).sum()
+        nlml += 0.5*X.shape[0]*np.log(2*np.pi)
+    return nlml
+
+
+def benchmark_mixed_precision(n_train_list, odims_list, idims=4,
+                              n_evals=10):
+    ''' Compares the evaluation time and accuracy of the GP loss and its
+    gradients, when computed fully in floatX and when the factorizations are
+    done in float64 (mixed precision). The accuracy is measured against a
+    float64 numpy implementation. Run with THEANO_FLAGS=floatX=float32 to
+    compare mixed precision against pure float32, and with floatX=float64 to
+    get the pure float64 timings'''
+    results = []
+    for odims in odims_list:
+        for n_train in n_train_list:
+            train_dataset, test_dataset = build_dataset(
+                idims=idims, odims=odims, n_train=n_train, n_test=1,
+                rand_seed=31337)
+            times = []
+            for mixed_precision in [False, True]:
+                gp = regression.GP(
+                    train_dataset[0], train_dataset[1], idims=idims,
+                    odims=odims, batched_loss=True, snr_penalty=None,
+                    mixed_precision=mixed_precision)
+                loss, inps, updts = gp.get_loss()
+                params = gp.get_params(symbolic=True)
+                dloss = theano.grad(loss, params)
+                fn = theano.function(
+                    inps, [loss]+dloss, updates=updts,
+                    allow_input_downcast=True)
+                try:
+                    loss_ref = nlml_float64(gp)
+                    rel_err = abs(fn()[0] - loss_ref)/abs(loss_ref)
+                    times.append((rel_err, time_fn(fn, n_evals)))
+                except np.linalg.LinAlgError:
+                    times.append((np.nan, np.nan))
+            (e_fx, t_fx), (e_mp, t_mp) = times
+            results.append((n_train, odims, e_fx, e_mp, t_fx, t_mp))
+            msg = 'N: %d, E: %d, loss rel. error (%s/mixed): %e / %e, '
+            msg += 'loss+grad (%s/mixed): %f / %f s'
+            utils.print_with_stamp(
+                msg % (n_train, odims, theano.config.floatX, e_fx, e_mp,
+                       theano.config.floatX, t_fx, t_mp),
+                'benchmark_mixed_precision')
+    return results
+
+
+def benchmark_predict(odims_list, n_train=100, idims=4, n_evals=10,
+                      reg_class=regression.GP_UI):
+    ''' Measures the compile and evaluation time of the moment matching
+    prediction (predictive mean, covariance and input-output covariance) and
+    its gradients wrt the input distribution, for varying output dimensions'''
+    results = []
+    for odims in odims_list:
+        train_dataset, test_dataset = build_dataset(
+            idims=idims, odims=odims, n_train=n_train, n_test=1,
+            rand_seed=31337)
+        gp = reg_class(train_dataset[0], train_dataset[1], idims=idims,
+                       odims=odims)
+        # initialize the cached intermediate values
+        loss, inps, updts = gp.get_loss()
+        theano.function(inps, loss, updates=updts)()
+
+        mx = theano.tensor.vector('mx')
+        Sx = theano.tensor.matrix('Sx')
+        M, S, V = gp.predict(mx, Sx)
+        dM = theano.grad(M.sum() + S.sum() + V.sum(), [mx, Sx])
+        start_time = time()
+        fn = theano.function([mx, Sx], [M, S, V] + dM,
+                             allow_input_downcast=True)
+        compile_time = time() - start_time
+        t = time_fn(fn, n_evals, test_dataset[0][0], test_dataset[2][0])
+        results.append((odims, compile_time, t))
+        utils.print_with_stamp(
+            'E: %d, compile: %f s, predict+grad: %f s' % (
+                odims, compile_time, t), 'benchmark_predict')
+    return results
+
+
+def benchmark_batch_predict(n_test_list, odims=2, n_train=100, idims=4,
+                            reg_class=regression.GP):
+    ''' Compares the time for evaluating deterministic predictions at n_test
+    inputs, one input per call and with a single batched call'''
+    train_dataset, test_dataset = build_dataset(
+        idims=idims, odims=odims, n_train=n_train, n_test=max(n_test_list),
+        rand_seed=31337)
+    gp = reg_class(train_dataset[0], train_dataset[1], idims=idims,
+                   odims=odims)
+    # initialize the cached intermediate values
+    loss, inps, updts = gp.get_loss()
+    theano.function(inps, loss, updates=updts)()
+
+    results = []
+    for n_test in n_test_list:
+        X = test_dataset[0][:n_test]
+        # warm up (compiles the prediction functions)
+        gp(X[0])
+        gp(X)
+        start_time = time()
+        single = [gp(x) for x in X]
+        t_single = time() - start_time
+        start_time = time()
+        M, S = gp(X)
+        t_batch = time() - start_time
+        err = max(np.abs(M - np.array([r[0] for r in single])).max(),
+                  np.abs(S - np.array([np.diag(r[1]) for r in single])).max())
+        results.append((n_test, t_single, t_batch, err))
+        msg = 'n: %d, predict (single/batch): %f / %f s, speedup: %f, '
+        msg += 'max abs diff: %e'
+        utils.print_with_stamp(
+            msg % (n_test, t_single, t_batch, t_single/t_batch, err),
+            'benchmark_batch_predict')
+    return results
+
+
+def benchmark_rollout(horizons, n_train=100, n_evals=10,
+                      dynmodel_class=regression.GP_UI):
+    ''' Measures the evaluation time of the PILCO loss and its gradients, for
+    the cartpole task, using an RBF policy and a dynamics model trained on
+    random transitions'''
+    params = cartpole.default_params()
+    pol = control.RBFPolicy(**params['policy'])
+    dyn_params = params['dynamics_model']
+    X = np.random.randn(n_train, dyn_params['idims'])
+    Y = 0.1*np.random.randn(n_train, dyn_params['odims'])
+    dyn = dynmodel_class(
+        X, Y, idims=dyn_params['idims'], odims=dyn_params['odims'])
+    # initialize the cached intermediate values of the dynamics model
+    loss, inps, updts = dyn.get_loss()
+    theano.function(inps, loss, updates=updts)()
+
+    cost = partial(cartpole.cartpole_loss, **params['cost'])
+    loss, inps, updts = algorithms.pilco.get_loss(
+        pol, dyn, cost, params['angle_dims'])
+    dloss = theano.grad(loss, pol.get_params(symbolic=True))
+    start_time = time()
+    fn = theano.function(inps, [loss]+dloss, updates=updts,
+                         allow_input_downcast=True)
+    compile_time = time() - start_time
+    utils.print_with_stamp('compile: %f s' % (compile_time),
+                           'benchmark_rollout')
+
+    p0 = params['state0_dist']
+    results = []
+    for H in horizons:
+        t = time_fn(fn, n_evals, p0.mean, p0.cov, H, 1.0)
+        results.append((H, compile_time, t))
+        utils.print_with_stamp('H: %d, loss+grad: %f s' % (H, t),
+                               'benchmark_rollout')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--benchmark', nargs='?', default='loss',
+        help='Which benchmark to run [loss, cg, mixed, predict, '
+        'batch_predict, rollout]. Default: loss. For batch_predict, n_train '
+        'is the list of numbers of test inputs')
+    parser.add_argument(
+        '--n_train', nargs='+', type=int,
+        help='Number of training samples. Default: 100 200 400 800.',
+        default=[100, 200, 400, 800])
+    parser.add_argument(
+        '--idims', nargs='?', type=int, help='Input dimensions. Default: 4',
+        default=4)
+    parser.add_argument(
+        '--odims', nargs='+', type=int,
+        help='Output dimensions. Default: 1 2 4 6', default=[1, 2, 4, 6])
+    parser.add_argument(
+        '--n_evals', nargs='?', type=int,
+        help='Number of function evaluations per timing. Default: 10',
+        default=10)
+    parser.add_argument(
+        '--horizon', nargs='+', type=int,
+        help='Rollout horizons. Default: 25 50 75 100',
+        default=[25, 50, 75, 100])
+    args = parser.parse_args()
+
+    if args.benchmark == 'loss':
+        benchmark_loss(args.n_train, args.odims, args.idims, args.n_evals)
+    elif args.benchmark == 'cg':
+        benchmark_cg_loss(args.n_train, args.odims, args.idims, args.n_evals)
+    elif args.benchmark == 'mixed':
+        benchmark_mixed_precision(args.n_train, args.odims, args.idims,
+                                  args.n_evals)
+    elif args.benchmark == 'predict':
+        benchmark_predict(args.odims, args.n_train[0], args.idims,
+                          args.n_evals)
+    elif args.benchmark == 'batch_predict':
+        benchmark_batch_predict(args.n_train, args.odims[0], 100, args.idims)
+    elif args.benchmark == 'rollout':
+        benchmark_rollout(args.horizon, args.n_train[0], args.n_evals)
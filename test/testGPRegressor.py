@@ -78,6 +78,307 @@ def write_profile_files(gp):
     d3viz.d3viz(gp.predict_fn, 'predict.html')
 
 
+# tolerance for the comparisons against numpy (in float64)
+RTOL = 1e-6 if theano.config.floatX == 'float64' else 1e-3
+
+
+def check_batched_loss(idims=3, odims=2, n_train=50):
+    ''' The batched cholesky loss (batched_loss=True) has to match the scan
+    over output dimensions, for the same dataset and hyperparameters (loss,
+    gradients and cached factorizations)'''
+    train_dataset, test_dataset = build_dataset(
+        idims=idims, odims=odims, n_train=n_train, n_test=1,
+        rand_seed=31337)
+    X, Y = train_dataset
+    rets = []
+    params = None
+    for batched_loss in [False, True]:
+        gp = regression.GP(X, Y, idims=idims, odims=odims,
+                           batched_loss=batched_loss)
+        if params is None:
+            params = gp.get_params(as_dict=True, ignore_fixed=False)
+        else:
+            gp.set_params(params)
+        loss, inps, updts = gp.get_loss()
+        dloss = theano.tensor.grad(loss, gp.get_params(symbolic=True))
+        loss_fn = theano.function(inps, [loss] + dloss, updates=updts)
+        rets.append(loss_fn() + [gp.iK.get_value(), gp.L.get_value(),
+                                 gp.beta.get_value()])
+    for a, b in zip(*rets):
+        np.testing.assert_allclose(a, b, rtol=RTOL,
+                                   atol=RTOL*np.abs(a).max())
+    utils.print_with_stamp('OK', 'check_batched_loss')
+
+
+def moment_matching_np(hyp, X, beta, iK, mx, Sx):
+    ''' Reference (numpy) implementation of the uncertain input predictions
+    of a GP with SE kernels (Deisenroth's thesis, Eqs 2.43-2.55), looping
+    over the output dimensions and every pair of output dimensions'''
+    N, idims = X.shape
+    odims = hyp.shape[0]
+    zeta = X - mx
+    M = np.empty(odims)
+    V = np.empty((idims, odims))
+    logk, z_ = [], []
+    for a in range(odims):
+        iL = np.diag(1.0/hyp[a, :idims])
+        sf2 = hyp[a, idims]**2
+        inp = zeta.dot(iL)
+        B = iL.dot(Sx).dot(iL) + np.eye(idims)
+        t = np.linalg.solve(B, inp.T).T
+        c = sf2/np.sqrt(np.linalg.det(B))
+        lb = np.exp(-0.5*np.sum(inp*t, 1))*beta[a]
+        M[a] = c*lb.sum()
+        V[:, a] = c*t.dot(iL).T.dot(lb)
+        logk.append(np.log(sf2) - 0.5*np.sum(inp*inp, 1))
+        z_.append(zeta.dot(iL**2))
+
+    S = np.empty((odims, odims))
+    for a in range(odims):
+        for b in range(odims):
+            Lambda = np.diag(hyp[a, :idims]**-2 + hyp[b, :idims]**-2)
+            R = Sx.dot(Lambda) + np.eye(idims)
+            iRSx = 0.5*np.linalg.solve(R, Sx)
+            za, zb = z_[a].dot(iRSx), z_[b].dot(iRSx)
+            n2 = (za*z_[a]).sum(1)[:, None] + (zb*z_[b]).sum(1)[None, :]
+            n2 += 2*za.dot(z_[b].T) + logk[a][:, None] + logk[b][None, :]
+            Q = np.exp(n2)/np.sqrt(np.linalg.det(R))
+            S[a, b] = beta[a].dot(Q).dot(beta[b])
+            if a == b:
+                S[a, a] += hyp[a, idims]**2 - np.sum(iK[a]*Q)
+    S -= np.outer(M, M)
+    return M, S, V
+
+
+def check_moment_matching(idims=3, odims=3, n_train=50, n_test=5,
+                          rand_seed=31337):
+    ''' Compares the uncertain input predictions of GP_UI, where all the
+    output pairs are handled with a single batched cholesky decomposition,
+    with the per output pair reference implementation; at random input
+    means and covariances. The products with the inverse kernel matrices
+    are checked with and without caching them (cache_iK)'''
+    train_dataset, test_dataset = build_dataset(
+        idims=idims, odims=odims, n_train=n_train, n_test=1,
+        rand_seed=rand_seed)
+    X, Y = train_dataset
+    rng = np.random.RandomState(rand_seed)
+    mx, Sx = theano.tensor.vector('mx'), theano.tensor.matrix('Sx')
+    for cache_iK in [True, False]:
+        gp = regression.GP_UI(X, Y, idims=idims, odims=odims,
+                              cache_iK=cache_iK)
+        gp.update_cached_factorization()
+        pred_fn = theano.function([mx, Sx], list(gp.predict(mx, Sx)),
+                                  allow_input_downcast=True)
+        hyp = gp.hyp.eval().astype(np.float64)
+        X_ = gp.X.get_value().astype(np.float64)
+        beta = gp.beta.get_value().astype(np.float64)
+        L = gp.L.get_value().astype(np.float64)
+        iK = np.linalg.inv(np.matmul(L, L.transpose(0, 2, 1)))
+        for i in range(n_test):
+            # random inputs near the training data
+            mx_ = X_[rng.randint(n_train)] + 0.1*rng.randn(idims)
+            A = rng.randn(idims, idims)
+            Sx_ = 0.1*A.dot(A.T)/idims + 0.01*np.eye(idims)
+            ret = pred_fn(mx_, Sx_)
+            ret_np = moment_matching_np(hyp, X_, beta, iK, mx_, Sx_)
+            for a, b in zip(ret_np, ret):
+                np.testing.assert_allclose(b, a, rtol=10*RTOL,
+                                           atol=10*RTOL*np.abs(a).max())
+    utils.print_with_stamp('OK', 'check_moment_matching')
+
+
+def check_first_moments(idims=3, odims=3, n_train=20, rand_seed=31337):
+    ''' Compares the batched predictive mean and input output covariance
+    (GP_UI.first_moments) with a per output dimension loop, as in the
+    previous implementation, for random inputs. Also checks that
+    output_pairs lists the diagonal pairs first, followed by the rest of the
+    upper triangle'''
+    rng = np.random.RandomState(rand_seed)
+    floatX = theano.config.floatX
+    gp = regression.GP_UI(idims=idims, odims=odims)
+    iL = np.stack([np.diag(1.0/rng.uniform(0.5, 2, idims))
+                   for e in range(odims)])
+    inp = rng.randn(odims, n_train, idims)
+    A = rng.randn(idims, idims)
+    Sx = 0.1*A.dot(A.T)/idims + 0.01*np.eye(idims)
+    sf2 = rng.uniform(0.5, 2, odims)
+    beta = rng.randn(odims, n_train)
+
+    tt = theano.tensor
+    args = [tt.tensor3('iL'), tt.tensor3('inp'), tt.matrix('Sx'),
+            tt.vector('sf2'), tt.matrix('beta')]
+    fn = theano.function(args, list(gp.first_moments(*args)),
+                         allow_input_downcast=True)
+    M, V = fn(iL, inp, Sx, sf2, beta)
+
+    M_np = np.empty(odims)
+    V_np = np.empty((idims, odims))
+    for e in range(odims):
+        B = iL[e].dot(Sx).dot(iL[e]) + np.eye(idims)
+        t = np.linalg.solve(B, inp[e].T).T
+        c = sf2[e]/np.sqrt(np.linalg.det(B))
+        lb = np.exp(-0.5*np.sum(inp[e]*t, 1))*beta[e]
+        M_np[e] = c*lb.sum()
+        V_np[:, e] = c*t.dot(iL[e].T).T.dot(lb)
+    np.testing.assert_allclose(M, M_np.astype(floatX), rtol=10*RTOL,
+                               atol=10*RTOL*np.abs(M_np).max())
+    np.testing.assert_allclose(V, V_np.astype(floatX), rtol=10*RTOL,
+                               atol=10*RTOL*np.abs(V_np).max())
+
+    i, j = gp.output_pairs()
+    assert (i[:odims] == j[:odims]).all()
+    assert sorted(zip(i, j)) == sorted(zip(*np.triu_indices(odims)))
+    utils.print_with_stamp('OK', 'check_first_moments')
+
+
+def se_kernel(hyp, X1, X2):
+    ''' Squared exponential kernel (numpy), for a single output dimension
+    with hyperparameters [lengthscales, signal std, noise std]'''
+    idims = X1.shape[1]
+    X1s, X2s = X1/hyp[:idims], X2/hyp[:idims]
+    r2 = (X1s**2).sum(1)[:, None] + (X2s**2).sum(1)[None, :]
+    r2 -= 2*X1s.dot(X2s.T)
+    return hyp[idims]**2*np.exp(-0.5*np.maximum(r2, 0))
+
+
+def check_svgp_elbo(idims=3, odims=2, n_train=50):
+    ''' With the inducing inputs at the training inputs and the optimal
+    variational distribution, the SVGP bound (evaluated on the full dataset)
+    has to match the exact negative log marginal likelihood'''
+    train_dataset, test_dataset = build_dataset(
+        idims=idims, odims=odims, n_train=n_train, n_test=1,
+        rand_seed=31337)
+    X, Y = train_dataset
+    svgp = regression.SVGP(X, Y, idims=idims, odims=odims,
+                           n_inducing=n_train, snr_penalty=None)
+    X = svgp.X.get_value().astype(np.float64)
+    Y = svgp.Y.get_value().astype(np.float64)
+    hyp = svgp.hyp.eval()
+
+    q_mu = np.empty((odims, n_train))
+    q_sqrt = np.empty((odims, n_train, n_train))
+    nlml = 0
+    for e in range(odims):
+        Kmm = se_kernel(hyp[e], X, X) + 1e-6*np.eye(n_train)
+        Lmm = np.linalg.cholesky(Kmm)
+        Kn = Kmm + hyp[e, idims+1]**2*np.eye(n_train)
+        # exact posterior of the inducing outputs, in the whitened space
+        A = np.linalg.solve(Kn, Kmm)
+        m_u = A.T.dot(Y[:, e])
+        S_u = Kmm - Kmm.dot(A)
+        iLmm = np.linalg.inv(Lmm)
+        q_mu[e] = iLmm.dot(m_u)
+        S_v = iLmm.dot(S_u).dot(iLmm.T)
+        q_sqrt[e] = np.linalg.cholesky(S_v + 1e-10*np.eye(n_train))
+        L = np.linalg.cholesky(Kn)
+        nlml += 0.5*Y[:, e].dot(np.linalg.solve(Kn, Y[:, e]))
+        nlml += np.log(np.diag(L)).sum() + 0.5*n_train*np.log(2*np.pi)
+
+    floatX = theano.config.floatX
+    svgp.set_params({'X_sp': X.astype(floatX), 'q_mu': q_mu.astype(floatX),
+                     'q_sqrt': q_sqrt.astype(floatX)})
+    loss, inps, updts = svgp.get_loss()
+    loss_fn = theano.function(inps, loss, allow_input_downcast=True)
+    # the loss is per training sample
+    np.testing.assert_allclose(n_train*loss_fn(X, Y), nlml, rtol=10*RTOL)
+    utils.print_with_stamp('OK', 'check_svgp_elbo')
+
+
+def check_gp_experts(idims=3, odims=2, n_train=50, n_test=5):
+    ''' A product of experts with a single expert has to match the full GP
+    (loss, and deterministic and moment matching predictions). With more
+    experts, every sample has to be assigned to one expert, and no expert
+    can take more than its capacity'''
+    train_dataset, test_dataset = build_dataset(
+        idims=idims, odims=odims, n_train=n_train, n_test=n_test,
+        rand_seed=31337)
+    X, Y = train_dataset
+    gp = regression.GP_UI(X, Y, idims=idims, odims=odims, snr_penalty=None)
+    experts = regression.GPExperts(
+        X, Y, idims=idims, odims=odims, expert_size=n_train, method='poe',
+        snr_penalty=None)
+    experts.set_params(gp.get_params(as_dict=True, ignore_fixed=False))
+
+    losses = []
+    for model in [gp, experts]:
+        loss, inps, updts = model.get_loss()
+        losses.append(theano.function([], loss, updates=updts)())
+        model.update_cached_factorization()
+    np.testing.assert_allclose(losses[0], losses[1], rtol=RTOL)
+
+    mx, Sx = theano.tensor.vector('mx'), theano.tensor.matrix('Sx')
+    x = theano.tensor.matrix('x')
+    preds = []
+    for model in [gp, experts]:
+        M = model.predict(x)[0]
+        preds.append(theano.function(
+            [x, mx, Sx], [M] + list(model.predict(mx, Sx)),
+            allow_input_downcast=True, on_unused_input='ignore'))
+    for i in range(n_test):
+        ret_gp = preds[0](test_dataset[0], test_dataset[0][i],
+                          test_dataset[2][i])
+        ret_experts = preds[1](test_dataset[0], test_dataset[0][i],
+                               test_dataset[2][i])
+        for a, b in zip(ret_gp, ret_experts):
+            np.testing.assert_allclose(a, b, rtol=10*RTOL,
+                                       atol=10*RTOL*np.abs(a).max())
+
+    # partition into K = 4 experts of at most ceil(N/K) samples; every
+    # sample must appear exactly once
+    experts = regression.GPExperts(
+        X, Y, idims=idims, odims=odims, expert_size=n_train//3)
+    mask = experts.mask_e.get_value()
+    X_e = experts.X_e.get_value()
+    assert mask.sum() == n_train
+    X_assigned = X_e[mask > 0]
+    order = np.lexsort(X_assigned.T)
+    np.testing.assert_allclose(
+        X_assigned[order], experts.X.get_value()[np.lexsort(
+            experts.X.get_value().T)])
+    utils.print_with_stamp('OK', 'check_gp_experts')
+
+
+def check_nigp_derivative(idims=3, odims=2, n_train=50, h=1e-4):
+    ''' Compares the analytic derivatives of the posterior mean used for
+    the NIGP input noise correction with central finite differences'''
+    train_dataset, test_dataset = build_dataset(
+        idims=idims, odims=odims, n_train=n_train, n_test=1,
+        rand_seed=31337)
+    X, Y = train_dataset
+    X_cov = np.tile(0.01*np.eye(idims), (n_train, 1, 1))
+    gp = regression.GP(idims=idims, odims=odims)
+    gp.set_dataset(X, Y, X_cov)
+    gp.update_cached_factorization()
+    nigp_fn = theano.function([], gp.nigp_updates()[0][1])
+
+    hyp, beta = gp.hyp.eval(), gp.beta.get_value()
+    X = gp.X.get_value().astype(np.float64)
+
+    def mean(x):
+        return np.stack([beta[e].dot(se_kernel(hyp[e], X, x))
+                         for e in range(odims)])
+
+    dM = np.empty((odims, n_train, idims))
+    for d in range(idims):
+        dx = np.zeros(idims)
+        dx[d] = h
+        dM[:, :, d] = (mean(X + dx) - mean(X - dx))/(2*h)
+    nigp = np.einsum('eid,ide,eie->ei', dM, X_cov, dM)
+    # the finite differences are accurate to about 1e-8
+    tol = 10*RTOL + 1e-5
+    np.testing.assert_allclose(nigp_fn(), nigp, rtol=tol,
+                               atol=tol*np.abs(nigp).max())
+    utils.print_with_stamp('OK', 'check_nigp_derivative')
+
+
+CHECKS = {'batched_loss': check_batched_loss,
+          'moment_matching': check_moment_matching,
+          'first_moments': check_first_moments,
+          'svgp': check_svgp_elbo,
+          'experts': check_gp_experts,
+          'nigp': check_nigp_derivative}
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -106,8 +407,16 @@ if __name__ == '__main__':
     parser.add_argument(
         '--func', nargs='?', type=int, help='Test function to use (default 0)',
         default=0)
+    parser.add_argument(
+        '--check', nargs='*', choices=sorted(CHECKS.keys()),
+        help='Run correctness checks (all, if no names are given) and exit')
     args = parser.parse_args()
 
+    if args.check is not None:
+        for name in (args.check or sorted(CHECKS.keys())):
+            CHECKS[name]()
+        exit(0)
+
     idims = args.idims
     odims = args.odims
     n_train = args.n_train
@@ -0,0 +1,139 @@
+import argparse
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi import utils
+from kusanagi.utils import linalg
+
+np.set_printoptions(linewidth=500, precision=17, suppress=True)
+floatX = theano.config.floatX
+# tolerance for the comparisons against numpy (in float64)
+RTOL = 1e-6 if floatX == 'float64' else 1e-3
+
+
+def random_spd(E, N, rng, scale=1.0):
+    ''' Returns a stack of E well conditioned N x N SPD matrices'''
+    A = rng.randn(E, N, N)
+    return scale*(np.matmul(A, A.transpose(0, 2, 1))/N + np.eye(N))
+
+
+def check_batched_cholesky(E=3, N=6, rand_seed=31337):
+    ''' Compares the batched cholesky op against numpy, and checks its
+    gradients (BatchedCholeskyGrad) with finite differences'''
+    rng = np.random.RandomState(rand_seed)
+    K = random_spd(E, N, rng)
+    x = tt.tensor3('x')
+    fn = theano.function([x], linalg.batched_cholesky(x),
+                         allow_input_downcast=True)
+    np.testing.assert_allclose(fn(K), np.linalg.cholesky(K), rtol=RTOL,
+                               atol=RTOL)
+
+    # the gradient only looks at the lower triangle, so we differentiate
+    # with respect to a matrix that is used to build an SPD input
+    def chol(A):
+        K = tt.batched_dot(A, A.transpose(0, 2, 1)) + N*tt.eye(N)
+        return linalg.batched_cholesky(K)
+    theano.gradient.verify_grad(chol, [rng.randn(E, N, N)], rng=rng)
+    utils.print_with_stamp('OK', 'check_batched_cholesky')
+
+
+def check_batched_solve_triangular(E=3, N=6, R=4, rand_seed=31337):
+    ''' Compares the batched triangular solves against numpy, for stacks of
+    vectors and matrices, and checks their gradients with finite
+    differences'''
+    rng = np.random.RandomState(rand_seed)
+    A = np.tril(rng.randn(E, N, N)) + 3*np.eye(N)
+    A_ = tt.tensor3('A')
+    for lower in [True, False]:
+        solve = linalg.BatchedSolveTriangular(lower=lower)
+        At = A if lower else A.transpose(0, 2, 1)
+        for b in [rng.randn(E, N), rng.randn(E, N, R)]:
+            b_ = tt.matrix('b') if b.ndim == 2 else tt.tensor3('b')
+            fn = theano.function([A_, b_], solve(A_, b_),
+                                 allow_input_downcast=True)
+            x = np.stack([np.linalg.solve(At[i], b[i]) for i in range(E)])
+            np.testing.assert_allclose(fn(At, b), x, rtol=RTOL, atol=RTOL)
+
+            def solve_fn(A, b):
+                # keep the diagonal away from zero
+                tri = linalg.batched_tril if lower else linalg.batched_triu
+                return solve(tri(A) + 3*tt.eye(N), b)
+            theano.gradient.verify_grad(solve_fn, [At, b], rng=rng)
+    utils.print_with_stamp('OK', 'check_batched_solve_triangular')
+
+
+def check_factorization_append(E=2, N=20, H=5, rand_seed=31337):
+    ''' Compares the block updates of the cholesky factors and the inverse
+    kernel matrices against a full refactorization'''
+    rng = np.random.RandomState(rand_seed)
+    K = random_spd(E, N+H, rng)
+    K11, K12, K22 = K[:, :N, :N], K[:, :N, N:], K[:, N:, N:]
+    L11 = np.linalg.cholesky(K11)
+    L, L22 = linalg.cholesky_append(L11, K12, K22)
+    np.testing.assert_allclose(L, np.linalg.cholesky(K), rtol=1e-8,
+                               atol=1e-10)
+    iK = linalg.inverse_append(np.linalg.inv(K11), K12, L22)
+    np.testing.assert_allclose(iK, np.linalg.inv(K), rtol=1e-8, atol=1e-10)
+    utils.print_with_stamp('OK', 'check_factorization_append')
+
+
+def check_cg(E=2, N=30, R=3, rand_seed=31337):
+    ''' Compares the batched conjugate gradients solutions against numpy,
+    and the lanczos log determinant estimate against slogdet. Running N
+    iterations with the probes sqrt(N)*e_i, the quadrature is exact and
+    the estimate is the trace of log(A)'''
+    rng = np.random.RandomState(rand_seed)
+    A = random_spd(E, N, rng)
+    A_ = theano.shared(A.astype(floatX))
+
+    def matvec(V):
+        return tt.batched_dot(A_, V)
+
+    B = tt.tensor3('B')
+    X, alpha, beta = linalg.batched_cg(matvec, B, n_iters=N)
+    fn = theano.function([B], X, allow_input_downcast=True)
+    b = rng.randn(E, N, R)
+    x = np.stack([np.linalg.solve(A[i], b[i]) for i in range(E)])
+    np.testing.assert_allclose(fn(b), x, rtol=10*RTOL, atol=10*RTOL)
+
+    Z = np.sqrt(N)*np.tile(np.eye(N), (E, 1, 1))
+    logdet = linalg.lanczos_logdet(alpha, beta, tt.sum(B**2, 1))
+    fn = theano.function([B], logdet, allow_input_downcast=True)
+    np.testing.assert_allclose(fn(Z), np.linalg.slogdet(A)[1],
+                               rtol=10*RTOL)
+    utils.print_with_stamp('OK', 'check_cg')
+
+
+def check_update_moments(N=1000, D=4, batch_size=137, rand_seed=31337):
+    ''' Compares the running moments, accumulated over batches of different
+    sizes (including an empty one), with the moments of the full dataset'''
+    rng = np.random.RandomState(rand_seed)
+    X = rng.randn(N, D).dot(rng.randn(D, D)) + 3
+    moments = None
+    for i in range(0, N, batch_size):
+        moments = utils.update_moments(moments, X[i:i+batch_size])
+    moments = utils.update_moments(moments, X[:0])
+    n, mean, M2 = moments
+    assert n == N
+    np.testing.assert_allclose(mean, X.mean(0), rtol=1e-10)
+    np.testing.assert_allclose(M2/(n-1), np.cov(X, rowvar=False),
+                               rtol=1e-10)
+    utils.print_with_stamp('OK', 'check_update_moments')
+
+
+CHECKS = {'cholesky': check_batched_cholesky,
+          'solve_triangular': check_batched_solve_triangular,
+          'append': check_factorization_append,
+          'cg': check_cg,
+          'moments': check_update_moments}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--check', nargs='*', choices=sorted(CHECKS.keys()),
+        help='Checks to run. Default: all', default=sorted(CHECKS.keys()))
+    args = parser.parse_args()
+    for name in args.check:
+        CHECKS[name]()